@@ -0,0 +1,133 @@
+"""Benchmarks for ccbb_pyutils.basic_fastq readers.
+
+Run from the repository root with:
+    PYTHONPATH=. python benchmarks/bench_basic_fastq.py [num_reads]
+"""
+
+# standard libraries
+import os
+import random
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+from ccbb_pyutils.basic_fastq import BasicFastqPool, FastqHandler
+
+__author__ = "Amanda Birmingham"
+__maintainer__ = "Amanda Birmingham"
+__email__ = "abirmingham@ucsd.edu"
+__status__ = "development"
+
+
+def write_random_fastq(output_fp, num_reads, read_len=150, seed=42):
+    rng = random.Random(seed)
+    quality = "I" * read_len
+    with open(output_fp, 'w') as output_f:
+        for curr_index in range(num_reads):
+            curr_seq = "".join(rng.choice("ACGT") for _ in range(read_len))
+            output_f.write("@read{0} 1:N:0:1\n{1}\n+\n{2}\n".format(curr_index, curr_seq, quality))
+
+
+def count_records_line_at_a_time(fastq_fp):
+    handler = FastqHandler(fastq_fp)
+    num_records = 0
+    try:
+        while True:
+            handler.get_next()
+            if handler.is_done:
+                num_records += 1
+                handler.clear_record()
+                handler.is_done = False
+    except StopIteration:
+        pass
+    handler.close()
+    return num_records
+
+
+def count_records_by_record(fastq_fp):
+    handler = FastqHandler(fastq_fp)
+    num_records = 0
+    try:
+        while True:
+            handler.get_next_record()
+            num_records += 1
+    except StopIteration:
+        pass
+    handler.close()
+    return num_records
+
+
+def count_records_by_batch(fastq_fp):
+    handler = FastqHandler(fastq_fp)
+    num_records = 0
+    try:
+        while True:
+            num_records += len(handler.get_next_batch())
+    except StopIteration:
+        pass
+    handler.close()
+    return num_records
+
+
+class ListOfLinesFastq:
+    # the list-of-lines record layout BasicFastq used before it got __slots__, kept here for comparison
+    def __init__(self, record_lines):
+        self.lines = list(record_lines)
+
+    @property
+    def sequence(self):
+        return self.lines[1].strip()
+
+    @property
+    def quality(self):
+        return self.lines[3].strip()
+
+
+def report_record_memory(label, record_factory, fastq_fp, num_records):
+    # total bytes held per in-flight record, including its strings, once the reader's batches are released
+    tracemalloc.start()
+    handler = FastqHandler(fastq_fp)
+    records = []
+    try:
+        while len(records) < num_records:
+            records.extend([record_factory(x) for x in handler.get_next_batch()])
+    except StopIteration:
+        pass
+    handler.close()
+    bytes_per_record = tracemalloc.get_traced_memory()[0] / len(records)
+    tracemalloc.stop()
+
+    # net new memory blocks from reading sequence and quality once per record, i.e. allocations per read
+    start_blocks = sys.getallocatedblocks()
+    sequences = [x.sequence for x in records]
+    qualities = [x.quality for x in records]
+    blocks_per_read = (sys.getallocatedblocks() - start_blocks) / len(records)
+    print("{0}: {1:.0f} bytes per in-flight record, {2:.2f} allocations per sequence+quality read".format(
+        label, bytes_per_record, blocks_per_read))
+    del sequences, qualities
+
+
+def report_throughput(label, func, fastq_fp):
+    num_mb = os.path.getsize(fastq_fp) / (1024 * 1024)
+    start_time = timeit.default_timer()
+    num_records = func(fastq_fp)
+    elapsed_seconds = timeit.default_timer() - start_time
+    print("{0}: {1} records in {2:.2f} s, {3:.1f} MB/s".format(label, num_records, elapsed_seconds,
+                                                               num_mb / elapsed_seconds))
+
+
+def main(num_reads):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fastq_fp = os.path.join(temp_dir, "bench.fastq")
+        write_random_fastq(fastq_fp, num_reads)
+        report_throughput("get_next (line at a time)", count_records_line_at_a_time, fastq_fp)
+        report_throughput("get_next_record", count_records_by_record, fastq_fp)
+        report_throughput("get_next_batch", count_records_by_batch, fastq_fp)
+
+        report_record_memory("list-of-lines record", ListOfLinesFastq, fastq_fp, 100000)
+        report_record_memory("BasicFastq (__slots__)", BasicFastqPool().acquire, fastq_fp, 100000)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,57 @@
+"""Benchmarks for ccbb_pyutils.bio_seq_utilities reverse-complement functions.
+
+Run from the repository root with:
+    PYTHONPATH=. python benchmarks/bench_bio_seq_utilities.py [num_reads] [read_len]
+"""
+
+# standard libraries
+import sys
+import timeit
+
+# third-party libraries
+import numpy
+
+from ccbb_pyutils.bio_seq_utilities import rev_comp_canonical_dna_seq, rev_comp_dna_seq, rev_comp_dna_seqs_array
+
+__author__ = "Amanda Birmingham"
+__maintainer__ = "Amanda Birmingham"
+__email__ = "abirmingham@ucsd.edu"
+__status__ = "development"
+
+
+def dict_rev_comp_canonical_dna_seq(dna_seq):
+    # the per-character dict lookup rev_comp_canonical_dna_seq used before, kept here for comparison
+    complement_dict = {"A": "T", "C": "G", "G": "C", "T": "A", "a": "t", "c": "g", "g": "c", "t": "a"}
+    reversed_seq = dna_seq[::-1]
+    rev_complement_chars = [complement_dict[x] if x in complement_dict else x for x in reversed_seq]
+    return "".join(rev_complement_chars)
+
+
+def make_random_reads(num_reads, read_len, seed=42):
+    rng = numpy.random.default_rng(seed)
+    bases = numpy.frombuffer(b"ACGTN", dtype=numpy.uint8)
+    base_matrix = bases[rng.integers(0, len(bases), size=(num_reads, read_len))]
+    return base_matrix.view("S{0}".format(read_len)).reshape(num_reads)
+
+
+def report_time(label, func, num_reads):
+    start_time = timeit.default_timer()
+    func()
+    elapsed_seconds = timeit.default_timer() - start_time
+    print("{0}: {1:.2f} s, {2:.0f} reads/s".format(label, elapsed_seconds, num_reads / elapsed_seconds))
+
+
+def main(num_reads, read_len):
+    reads_array = make_random_reads(num_reads, read_len)
+    reads_list = [x.decode() for x in reads_array.tolist()]
+
+    report_time("dict lookup (previous rev_comp_canonical_dna_seq)",
+                lambda: [dict_rev_comp_canonical_dna_seq(x) for x in reads_list], num_reads)
+    report_time("rev_comp_canonical_dna_seq", lambda: [rev_comp_canonical_dna_seq(x) for x in reads_list],
+                num_reads)
+    report_time("rev_comp_dna_seq", lambda: [rev_comp_dna_seq(x) for x in reads_list], num_reads)
+    report_time("rev_comp_dna_seqs_array", lambda: rev_comp_dna_seqs_array(reads_array), num_reads)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000000, int(sys.argv[2]) if len(sys.argv) > 2 else 150)
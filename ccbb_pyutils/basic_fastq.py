@@ -1,103 +1,516 @@
 # standard libraries
+import collections
 import io
 
+# third-party libraries
+import numpy
+
+from ccbb_pyutils.compressed_files import open_decompressed_binary, open_decompressed_text
+
 __author__ = "Amanda Birmingham"
 __maintainer__ = "Amanda Birmingham"
 __email__ = "abirmingham@ucsd.edu"
 __status__ = "prototype"
 
 
+FastqPairBatch = collections.namedtuple("FastqPairBatch",
+                                        ["fw_sequences", "fw_qualities", "rv_sequences", "rv_qualities"])
+
+
+class UnfinishedFastqRecordError(ValueError):
+    def __init__(self, filepath):
+        self.filepath = filepath
+        super().__init__("{0} terminated with unfinished record".format(filepath))
+
+
+class FastqRecordsOutOfSyncError(ValueError):
+    def __init__(self, fw_filepath, rv_filepath, num_pairs_read):
+        self.fw_filepath = fw_filepath
+        self.rv_filepath = rv_filepath
+        self.num_pairs_read = num_pairs_read
+        super().__init__("fastq records in {0} and {1} aren't in sync after {2} read pairs".format(
+            fw_filepath, rv_filepath, num_pairs_read))
+
+
 class BasicFastq:
+    # Fields are stored already stripped of line endings, so reading sequence/quality allocates nothing and
+    # clear() resets the same object instead of building a new list.  Header and separator keep any other
+    # whitespace, so to_string() reproduces the lines that were read.
+    __slots__ = ("header", "_sequence", "separator", "_quality", "_num_lines")
+    _line_fields = ("header", "_sequence", "separator", "_quality")
+
     def __init__(self):
         self.clear()
 
     def add_line(self, new_line):
-        self.lines.append(new_line)
-        result = True if len(self.lines) >= 4 else False
+        if self._num_lines >= 4:
+            raise ValueError("fastq record already has four lines; can't add another: {0}".format(new_line))
+        # sequence and quality lose all surrounding whitespace; header and separator just the line ending
+        new_value = new_line.strip() if self._num_lines % 2 == 1 else new_line.rstrip("\r\n")
+        setattr(self, self._line_fields[self._num_lines], new_value)
+        self._num_lines += 1
+        result = True if self._num_lines >= 4 else False
         return result
 
+    def set_lines(self, record_lines):
+        header, sequence, separator, quality = record_lines
+        self.header = header.rstrip("\r\n")
+        self._sequence = sequence.strip()
+        self.separator = separator.rstrip("\r\n")
+        self._quality = quality.strip()
+        self._num_lines = 4
+
+    @property
+    def lines(self):
+        # A tuple built on each access, not the record's storage: change lines through the setters,
+        # set_lines, or by assigning a whole new sequence of lines to this property.
+        return tuple(getattr(self, x) + "\n" for x in self._line_fields[:self._num_lines])
+
+    @lines.setter
+    def lines(self, value):
+        self.clear()
+        for curr_line in value:
+            self.add_line(curr_line)
+
     @property
     def sequence(self):
-        return self.lines[1].strip()
+        return self._sequence
 
     @sequence.setter
     def sequence(self, value):
-        self.lines[1] = value + "\n"
+        self._sequence = value
 
 
     @property
     def quality(self):
-        return self.lines[3].strip()
+        return self._quality
 
     @quality.setter
     def quality(self, value):
-        self.lines[3] = value + "\n"
+        self._quality = value
 
     def to_string(self):
         return "".join(self.lines)
 
+    def copy(self):
+        result = BasicFastq()
+        result.header, result._sequence, result.separator, result._quality, result._num_lines = \
+            self.header, self._sequence, self.separator, self._quality, self._num_lines
+        return result
+
     def clear(self):
-        self.lines = []
+        self.header = self._sequence = self.separator = self._quality = None
+        self._num_lines = 0
+
+
+class BasicFastqPool:
+    """Free list of BasicFastq objects, for callers that hold many records in flight at once."""
+
+    def __init__(self):
+        self._free_records = []
+
+    def __len__(self):
+        return len(self._free_records)
+
+    def acquire(self, record_lines=None):
+        result = self._free_records.pop() if self._free_records else BasicFastq()
+        if record_lines is not None:
+            result.set_lines(record_lines)
+        return result
+
+    def release(self, basic_fastq):
+        basic_fastq.clear()
+        self._free_records.append(basic_fastq)
 
 
 class FastqHandler:
     file_suffix = "fastq"
+    default_block_size = 256 * 1024  # characters read per block; larger blocks are slower (cache misses)
 
-    def __init__(self, file_path, input_is_fastq_string=False):
+    def __init__(self, file_path, input_is_fastq_string=False, block_size=None, num_decompress_threads=None):
         if not input_is_fastq_string:
             self.filepath = file_path
-            self.generator = open(self.filepath, 'r')
+            # gzip, BGZF, and zstd inputs are decompressed on the fly
+            self.generator = open_decompressed_text(self.filepath, num_decompress_threads)
         else:
             self.filepath = None
             self.generator = io.StringIO(file_path)
 
+        self.block_size = self.default_block_size if block_size is None else block_size
         self.basic_fastq = BasicFastq()
         self.is_done = False
+        self.has_unfinished_record = False
+        self._record_batches = None
+        self._curr_batch = []
+        self._curr_batch_index = 0
 
     def get_next(self):
+        # NB: reads a single line; don't mix with get_next_record/get_next_batch on the same handler
         curr_line = next(self.generator)
         self.is_done = self.basic_fastq.add_line(curr_line)
 
+    def get_next_record(self):
+        """Load the next complete four-line record into basic_fastq.
+
+        Raises:
+            StopIteration: If the input is exhausted.  If the input ended partway through a record, is_done is
+                False afterwards.
+        """
+        if self._curr_batch_index >= len(self._curr_batch):
+            self._curr_batch = self._get_next_parsed_batch()
+            self._curr_batch_index = 0
+
+        self.basic_fastq.set_lines(self._curr_batch[self._curr_batch_index])
+        self._curr_batch_index += 1
+        self.is_done = True
+
+    def get_next_batch(self):
+        """Return the complete records parsed from the next block of the input.
+
+        Returns:
+            list(tuple(str, str, str, str)): One tuple of four newline-terminated lines per fastq record.
+
+        Raises:
+            StopIteration: If the input is exhausted.  If the input ended partway through a record, is_done is
+                False afterwards.
+        """
+        if self._curr_batch_index < len(self._curr_batch):
+            result = self._curr_batch[self._curr_batch_index:]
+        else:
+            result = self._get_next_parsed_batch()
+
+        self._curr_batch = []
+        self._curr_batch_index = 0
+        return result
+
     def clear_record(self):
         self.basic_fastq.clear()
 
     def close(self):
         self.generator.close()
 
+    def _get_next_parsed_batch(self):
+        if self._record_batches is None:
+            self._record_batches = self._generate_record_batches()
+        return next(self._record_batches)
+
+    def _generate_record_batches(self):
+        # Read big blocks and split them with C-level string methods rather than pulling one line per call;
+        # any trailing partial record is carried over to the front of the next block.
+        remainder = ""
+        while True:
+            block = self.generator.read(self.block_size)
+            if block == "":
+                break
+
+            block = remainder + block
+            last_newline_index = block.rfind("\n")
+            if last_newline_index < 0:
+                remainder = block
+                continue
+
+            lines = block[:last_newline_index + 1].splitlines(True)
+            num_record_lines = len(lines) - (len(lines) % 4)
+            remainder = "".join(lines[num_record_lines:]) + block[last_newline_index + 1:]
+            del lines[num_record_lines:]
+            if num_record_lines > 0:
+                yield _group_lines_into_records(lines)
+
+        lines = remainder.splitlines(True)
+        if len(lines) > 0 and not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+        num_record_lines = len(lines) - (len(lines) % 4)
+        if num_record_lines > 0:
+            yield _group_lines_into_records(lines[:num_record_lines])
+        if num_record_lines < len(lines):
+            self.is_done = False
+            self.has_unfinished_record = True
+
+
+def _group_lines_into_records(lines):
+    lines_iter = iter(lines)
+    return list(zip(lines_iter, lines_iter, lines_iter, lines_iter))
+
+
+def sequences_to_uint8_matrix(sequences_array):
+    """Return a zero-copy (num_sequences, max_length) uint8 view of a numpy bytes ("S") array.
+
+    Sequences shorter than the longest sequence in the array are padded with zero bytes.
+    """
+    return sequences_array.view(numpy.uint8).reshape(len(sequences_array), sequences_array.itemsize)
+
+
+def fastq_batch_generator(fastq_handler, batch_size=100000):
+    """Yield batches of single-end reads as numpy bytes arrays.
+
+    Args:
+        fastq_handler (FastqHandler): Handler for the fastq to read.
+        batch_size (Optional[int]): Maximum number of reads per batch.  Default is 100000.
+
+    Yields:
+        tuple(numpy.ndarray, numpy.ndarray): Upper-cased sequences and qualities, each of dtype "S".
+
+    Raises:
+        UnfinishedFastqRecordError: If the input ends partway through a record.
+    """
+    pending_records = []
+    is_exhausted = False
+    try:
+        while not is_exhausted or len(pending_records) > 0:
+            while not is_exhausted and len(pending_records) < batch_size:
+                try:
+                    pending_records.extend(fastq_handler.get_next_batch())
+                except StopIteration:
+                    is_exhausted = True
+                    if fastq_handler.has_unfinished_record:
+                        raise UnfinishedFastqRecordError(fastq_handler.filepath)
+
+            if len(pending_records) > 0:
+                yield _records_to_arrays(pending_records[:batch_size])
+                del pending_records[:batch_size]
+    finally:
+        fastq_handler.close()
+
+
+def paired_fastq_batch_generator(fw_fastq_handler, rv_fastq_handler, batch_size=100000):
+    """Yield batches of read pairs as numpy bytes arrays for vectorized processing.
+
+    Sequences are upper-cased, as in paired_fastq_generator.  Every batch holds batch_size pairs except possibly
+    the last.  Use sequences_to_uint8_matrix to get a per-base uint8 view of any of the arrays.
+
+    Args:
+        fw_fastq_handler (FastqHandler): Handler for the forward-read fastq.
+        rv_fastq_handler (FastqHandler): Handler for the reverse-read fastq.
+        batch_size (Optional[int]): Maximum number of read pairs per batch.  Default is 100000.
+
+    Yields:
+        FastqPairBatch: Forward sequences, forward qualities, reverse sequences, and reverse qualities, each a
+            numpy array of dtype "S".
+
+    Raises:
+        UnfinishedFastqRecordError: If either input ends partway through a record.
+        FastqRecordsOutOfSyncError: If one input runs out of records before the other.
+    """
+    for fw_records, rv_records in paired_fastq_chunk_generator(fw_fastq_handler, rv_fastq_handler, batch_size):
+        batch_arrays = list(_records_to_arrays(fw_records))
+        batch_arrays.extend(_records_to_arrays(rv_records))
+        yield FastqPairBatch(*batch_arrays)
+
+
+def paired_fastq_chunk_generator(fw_fastq_handler, rv_fastq_handler, chunk_size=100000):
+    """Yield chunks of unparsed read pairs, keeping the forward and reverse inputs in sync.
+
+    Args:
+        fw_fastq_handler (FastqHandler): Handler for the forward-read fastq.
+        rv_fastq_handler (FastqHandler): Handler for the reverse-read fastq.
+        chunk_size (Optional[int]): Maximum number of read pairs per chunk.  Default is 100000.
+
+    Yields:
+        tuple(list, list): The forward and reverse records of the chunk, each record a tuple of four
+            newline-terminated lines.  Both lists have the same length: chunk_size except possibly for the last
+            chunk.
+
+    Raises:
+        UnfinishedFastqRecordError: If either input ends partway through a record.
+        FastqRecordsOutOfSyncError: If one input runs out of records before the other.
+    """
+    fastq_handlers = [fw_fastq_handler, rv_fastq_handler]
+    pending_records = [[], []]
+    is_exhausted = [False, False]
+    num_pairs_read = 0
+
+    try:
+        while True:
+            for handler_index, curr_handler in enumerate(fastq_handlers):
+                while not is_exhausted[handler_index] and len(pending_records[handler_index]) < chunk_size:
+                    try:
+                        pending_records[handler_index].extend(curr_handler.get_next_batch())
+                    except StopIteration:
+                        is_exhausted[handler_index] = True
+                        if curr_handler.has_unfinished_record:
+                            raise UnfinishedFastqRecordError(curr_handler.filepath)
+
+            num_pairs = min(chunk_size, len(pending_records[0]), len(pending_records[1]))
+            if num_pairs == 0:
+                if len(pending_records[0]) != len(pending_records[1]):
+                    raise FastqRecordsOutOfSyncError(fw_fastq_handler.filepath, rv_fastq_handler.filepath,
+                                                     num_pairs_read)
+                break
+
+            result = (pending_records[0][:num_pairs], pending_records[1][:num_pairs])
+            for curr_records in pending_records:
+                del curr_records[:num_pairs]
+            num_pairs_read += num_pairs
+            yield result
+    finally:
+        for curr_handler in fastq_handlers:
+            curr_handler.close()
+
+
+def paired_fastq_text_chunk_generator(fw_fastq_fp, rv_fastq_fp, chunk_size=100000, num_decompress_threads=None):
+    """Yield chunks of raw fastq text, cut at record boundaries, keeping the forward and reverse inputs in sync.
+
+    Unlike paired_fastq_chunk_generator, this doesn't split lines or build records: it only locates newlines
+    (with numpy) to find where each chunk ends, so a single reading process can keep many parsing processes
+    busy.  Turn a chunk into records with fastq_text_to_records.
+
+    Args:
+        fw_fastq_fp (str): Path to the forward-read fastq (may be compressed).
+        rv_fastq_fp (str): Path to the reverse-read fastq (may be compressed).
+        chunk_size (Optional[int]): Maximum number of read pairs per chunk.  Default is 100000.
+        num_decompress_threads (Optional[int]): Threads to request from any external decompressor.
+
+    Yields:
+        tuple(bytes, bytes): The forward and reverse text of the chunk; each holds chunk_size whole records
+            except possibly in the last chunk.
+
+    Raises:
+        UnfinishedFastqRecordError: If either input ends partway through a record.
+        FastqRecordsOutOfSyncError: If one input runs out of records before the other.
+    """
+    record_readers = [_FastqRecordTextReader(x, num_decompress_threads) for x in [fw_fastq_fp, rv_fastq_fp]]
+    num_pairs_read = 0
+    try:
+        while True:
+            (fw_text, fw_num_records), (rv_text, rv_num_records) = [x.read_records(chunk_size)
+                                                                    for x in record_readers]
+            if fw_num_records != rv_num_records:
+                raise FastqRecordsOutOfSyncError(fw_fastq_fp, rv_fastq_fp,
+                                                 num_pairs_read + min(fw_num_records, rv_num_records))
+            if fw_num_records == 0:
+                break
+
+            num_pairs_read += fw_num_records
+            yield fw_text, rv_text
+    finally:
+        for curr_reader in record_readers:
+            curr_reader.close()
+
+
+def fastq_text_to_records(fastq_text):
+    """Split a chunk from paired_fastq_text_chunk_generator into records like paired_fastq_chunk_generator's.
+
+    Returns:
+        list(tuple(str, str, str, str)): One tuple of four newline-terminated lines per fastq record.
+    """
+    lines = io.StringIO(fastq_text.decode("utf-8"), newline=None).readlines()
+    if len(lines) > 0 and not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    return _group_lines_into_records(lines)
+
+
+class _FastqRecordTextReader:
+    block_size = 4 * 1024 * 1024
+
+    def __init__(self, file_path, num_decompress_threads=None):
+        self.filepath = file_path
+        self._input_f = open_decompressed_binary(file_path, num_decompress_threads)
+        # each block is scanned for newlines once, when read; calls then just advance through it
+        self._block = b""
+        self._block_start = 0
+        self._newline_indices = None
+        self._next_newline = 0
+
+    def read_records(self, num_records):
+        """Return (text, number of records) for the next num_records records, or all that are left."""
+        num_lines_needed = 4 * num_records
+        pieces = []
+        while num_lines_needed > 0:
+            if self._block_start >= len(self._block):
+                self._block = self._input_f.read(self.block_size)
+                self._block_start = 0
+                self._next_newline = 0
+                if len(self._block) == 0:
+                    break
+                self._newline_indices = numpy.flatnonzero(
+                    numpy.frombuffer(self._block, dtype=numpy.uint8) == ord("\n"))
+
+            num_newlines_left = len(self._newline_indices) - self._next_newline
+            if num_newlines_left >= num_lines_needed:
+                self._next_newline += num_lines_needed
+                end_index = int(self._newline_indices[self._next_newline - 1]) + 1
+                num_lines_needed = 0
+            else:
+                self._next_newline += num_newlines_left
+                end_index = len(self._block)
+                num_lines_needed -= num_newlines_left
+            pieces.append(self._block[self._block_start:end_index])
+            self._block_start = end_index
+
+        result = b"".join(pieces)
+        num_lines = 4 * num_records - num_lines_needed
+        if num_lines_needed > 0:
+            # the input ran out; its last line may lack a newline
+            if len(result) > 0 and not result.endswith(b"\n"):
+                num_lines += 1
+            if num_lines % 4 != 0:
+                raise UnfinishedFastqRecordError(self.filepath)
+        return result, num_lines // 4
+
+    def close(self):
+        self._input_f.close()
+
+
+def records_to_read_pairs(fw_records, rv_records, get_full_record=False):
+    """Convert a chunk from paired_fastq_chunk_generator into the items paired_fastq_generator would yield.
+
+    Args:
+        fw_records (list): Forward records, each a tuple of four lines.
+        rv_records (list): Reverse records, each a tuple of four lines.
+        get_full_record (Optional[bool]): True to return pairs of BasicFastq objects, False to return pairs of
+            upper-cased sequences.  Default is False.
+
+    Returns:
+        list(tuple): One (forward, reverse) tuple per read pair.
+    """
+    if get_full_record:
+        pool = BasicFastqPool()
+        return [(pool.acquire(x), pool.acquire(y)) for x, y in zip(fw_records, rv_records)]
+
+    fw_sequences = "".join([x[1] for x in fw_records]).upper().splitlines()
+    rv_sequences = "".join([x[1] for x in rv_records]).upper().splitlines()
+    return list(zip(fw_sequences, rv_sequences))
+
+
+def _records_to_arrays(records):
+    # join/split the whole batch at once rather than stripping and upper-casing each line separately
+    sequences = "".join([x[1] for x in records]).upper().splitlines()
+    qualities = "".join([x[3] for x in records]).splitlines()
+    return numpy.array(sequences, dtype=bytes), numpy.array(qualities, dtype=bytes)
+
 
 def paired_fastq_generator(fw_fastq_handler, rv_fastq_handler, get_full_record=False):
     fastq_handlers = [fw_fastq_handler, rv_fastq_handler]
 
     while True:
-        try:
-            for curr_handler in fastq_handlers:
-                curr_handler.get_next()
-        except StopIteration:
+        num_exhausted = 0
+        for curr_handler in fastq_handlers:
+            try:
+                curr_handler.get_next_record()
+            except StopIteration:
+                num_exhausted += 1
+
+        if num_exhausted > 0:
             for curr_handler in fastq_handlers:
                 if not curr_handler.is_done:
                     print(("Error: {0} generator terminated"
                            "with unfinished record").format(
                         curr_handler.filepath))
+            if num_exhausted < len(fastq_handlers):
+                # at least one handler still has records when another has run out
+                print("Error--fastq records aren't in sync")
             break
 
-        done_booleans = [x.is_done for x in fastq_handlers]
-        if True in done_booleans:
-            # at least one handler thinks its record is done
-            if False in done_booleans:
-                # at least one handler DOESN'T think its record is done
-                print("Error--fastq records aren't in sync")
-                break
-            else:
-                if get_full_record:
-                    result = (fw_fastq_handler.basic_fastq, rv_fastq_handler.basic_fastq)
-                else:
-                    result = (fw_fastq_handler.basic_fastq.sequence.upper(),
-                              rv_fastq_handler.basic_fastq.sequence.upper())
-                yield result
+        if get_full_record:
+            result = (fw_fastq_handler.basic_fastq, rv_fastq_handler.basic_fastq)
+        else:
+            result = (fw_fastq_handler.basic_fastq.sequence.upper(),
+                      rv_fastq_handler.basic_fastq.sequence.upper())
+        yield result
 
-                # prepare for next fastq record
-                for curr_handler in fastq_handlers:
-                    curr_handler.clear_record()
+        # prepare for next fastq record
+        for curr_handler in fastq_handlers:
+            curr_handler.clear_record()
 
     for curr_handler in fastq_handlers:
-        curr_handler.close()
\ No newline at end of file
+        curr_handler.close()
@@ -1,9 +1,21 @@
 # standard libraries
+import collections
+import concurrent.futures
+import csv
+import gzip
+import hashlib
+import io
 import logging
 import os
-import shutil
+import re
+import zlib
 
-from ccbb_pyutils.files_and_paths import get_filepaths_from_wildcard, group_files, make_file_path
+# third-party libraries
+import numpy
+
+from ccbb_pyutils.basic_fastq import fastq_batch_generator, sequences_to_uint8_matrix
+from ccbb_pyutils.compressed_files import BGZF_COMPRESSION, GZIP_COMPRESSION, get_compression_type
+from ccbb_pyutils.files_and_paths import concatenate_files, get_filepaths_from_wildcard, group_files, make_file_path
 
 __author__ = "Amanda Birmingham"
 __maintainer__ = "Amanda Birmingham"
@@ -11,18 +23,70 @@ __email__ = "abirmingham@ucsd.edu"
 __status__ = "prototype"
 
 
+_MERGE_MANIFEST_FIELDS = ["sample", "read", "filepath", "num_lanes", "num_records", "num_bytes", "md5"]
+
+_CANONICAL_DNA_BASES = "ACGTacgt"
+_CANONICAL_DNA_COMPLEMENTS = "TGCAtgca"
+_IUPAC_DNA_BASES = "ACGTRYSWKMBDHVNacgtryswkmbdhvn"
+_IUPAC_DNA_COMPLEMENTS = "TGCAYRSWMKVHDBNtgcayrswmkvhdbn"
+
+_CANONICAL_DNA_STR_TABLE = str.maketrans(_CANONICAL_DNA_BASES, _CANONICAL_DNA_COMPLEMENTS)
+_CANONICAL_DNA_BYTES_TABLE = bytes.maketrans(_CANONICAL_DNA_BASES.encode(), _CANONICAL_DNA_COMPLEMENTS.encode())
+_IUPAC_DNA_STR_TABLE = str.maketrans(_IUPAC_DNA_BASES, _IUPAC_DNA_COMPLEMENTS)
+_IUPAC_DNA_BYTES_TABLE = bytes.maketrans(_IUPAC_DNA_BASES.encode(), _IUPAC_DNA_COMPLEMENTS.encode())
+
+
 def rev_comp_canonical_dna_seq(dna_seq):
-    complement_dict = {"A": "T",
-                       "C": "G",
-                       "G": "C",
-                       "T": "A",
-                       "a": "t",
-                       "c": "g",
-                       "g": "c",
-                       "t": "a"}
-    reversed_seq = dna_seq[::-1]
-    rev_complement_chars = [complement_dict[x] if x in complement_dict else x for x in reversed_seq]
-    return "".join(rev_complement_chars)
+    # complements only A, C, G, and T (either case); all other characters are reversed but left as-is
+    table = _CANONICAL_DNA_BYTES_TABLE if isinstance(dna_seq, bytes) else _CANONICAL_DNA_STR_TABLE
+    return dna_seq[::-1].translate(table)
+
+
+def rev_comp_dna_seq(dna_seq):
+    """Reverse-complement a DNA sequence, including IUPAC ambiguity codes such as N, R, and Y.
+
+    Args:
+        dna_seq (str or bytes): The sequence to reverse-complement; case is preserved.
+
+    Returns:
+        str or bytes: The reverse complement, of the same type as the input.
+    """
+    table = _IUPAC_DNA_BYTES_TABLE if isinstance(dna_seq, bytes) else _IUPAC_DNA_STR_TABLE
+    return dna_seq[::-1].translate(table)
+
+
+def rev_comp_dna_seqs_array(dna_seqs_array):
+    """Reverse-complement every sequence in a numpy bytes array at once.
+
+    Complements follow rev_comp_dna_seq.  Sequences may have different lengths; each is reversed within its own
+    length, so zero padding stays at the end.
+
+    Args:
+        dna_seqs_array (numpy.ndarray): A one-dimensional array of dtype "S", such as the sequences in a
+            basic_fastq.FastqPairBatch.
+
+    Returns:
+        numpy.ndarray: A new array of the same dtype holding the reverse complements.
+    """
+    dna_seqs_array = numpy.ascontiguousarray(dna_seqs_array)
+    if len(dna_seqs_array) == 0 or dna_seqs_array.itemsize == 0:
+        return dna_seqs_array.copy()
+
+    base_matrix = sequences_to_uint8_matrix(dna_seqs_array)
+    max_len = base_matrix.shape[1]
+    seq_lens = numpy.count_nonzero(base_matrix, axis=1)
+    if numpy.all(seq_lens == max_len):
+        reversed_matrix = base_matrix[:, ::-1]
+    else:
+        # position j of each reversed row comes from position (length - 1 - j) of the original row
+        source_positions = seq_lens[:, numpy.newaxis] - 1 - numpy.arange(max_len)[numpy.newaxis, :]
+        is_padding = source_positions < 0
+        reversed_matrix = numpy.take_along_axis(base_matrix, numpy.maximum(source_positions, 0), axis=1)
+        reversed_matrix[is_padding] = 0
+
+    # one bytes.translate over the whole contiguous buffer beats a numpy fancy-indexed lookup table
+    result_buffer = bytearray(numpy.ascontiguousarray(reversed_matrix)).translate(_IUPAC_DNA_BYTES_TABLE)
+    return numpy.frombuffer(result_buffer, dtype=dna_seqs_array.dtype)
 
 
 def expand_possible_mismatches(perfect_seq, position_alphabet, include_perfect=False):
@@ -30,7 +94,7 @@ def expand_possible_mismatches(perfect_seq, position_alphabet, include_perfect=F
     if include_perfect:
         result.append(perfect_seq)
 
-    perfect_seq_chars = perfect_seq.split()
+    perfect_seq_chars = list(perfect_seq)
     for curr_position in range(0, len(perfect_seq_chars)):
         perfect_seq_char = perfect_seq_chars[curr_position]
         for possible_char in position_alphabet:
@@ -74,25 +138,269 @@ def trim_seq(input_seq, retain_len, retain_5p_end):
         return input_seq[-retain_len:]
 
 
-def merge_igm_files_by_lane_read_set(input_files_dir, output_files_dir, file_suffix):
+def trim_seqs_array(seqs_array, retain_len, retain_5p_end, quals_array=None):
+    """Trim every sequence (and, optionally, its quality string) in a numpy bytes array at once.
+
+    Unlike trim_seq, sequences shorter than retain_len do not raise an error; they are flagged in the returned
+    mask and come back as empty strings.
+
+    Args:
+        seqs_array (numpy.ndarray): A one-dimensional array of dtype "S".
+        retain_len (int): Number of bases to keep.
+        retain_5p_end (bool): True to keep the first retain_len bases, False to keep the last retain_len bases.
+        quals_array (Optional[numpy.ndarray]): Quality strings matching seqs_array, trimmed the same way.
+
+    Returns:
+        tuple(numpy.ndarray, numpy.ndarray or None, numpy.ndarray): The trimmed sequences and qualities (None if
+            no qualities were given), each of dtype "S{retain_len}", and a boolean array that is True for each
+            sequence that was too short to trim.
+    """
+    seqs_array = numpy.ascontiguousarray(seqs_array)
+    seq_lens = numpy.count_nonzero(sequences_to_uint8_matrix(seqs_array), axis=1)
+    is_too_short = seq_lens < retain_len
+
+    trimmed_seqs = _trim_bytes_array(seqs_array, seq_lens, retain_len, retain_5p_end, is_too_short)
+    trimmed_quals = None
+    if quals_array is not None:
+        trimmed_quals = _trim_bytes_array(numpy.ascontiguousarray(quals_array), seq_lens, retain_len,
+                                          retain_5p_end, is_too_short)
+    return trimmed_seqs, trimmed_quals, is_too_short
+
+
+def _trim_bytes_array(bytes_array, seq_lens, retain_len, retain_5p_end, is_too_short):
+    base_matrix = sequences_to_uint8_matrix(bytes_array)
+    if retain_len > base_matrix.shape[1]:
+        # every sequence is too short
+        return numpy.zeros(len(bytes_array), dtype="S{0}".format(retain_len))
+
+    if retain_5p_end:
+        trimmed_matrix = base_matrix[:, :retain_len].copy()
+    else:
+        # each row keeps the retain_len bases ending at its own length
+        start_positions = numpy.maximum(seq_lens - retain_len, 0)
+        source_positions = start_positions[:, numpy.newaxis] + numpy.arange(retain_len)[numpy.newaxis, :]
+        source_positions = numpy.minimum(source_positions, base_matrix.shape[1] - 1)
+        trimmed_matrix = numpy.take_along_axis(base_matrix, source_positions, axis=1)
+    trimmed_matrix[is_too_short] = 0
+    return numpy.ascontiguousarray(trimmed_matrix).view("S{0}".format(retain_len)).reshape(len(bytes_array))
+
+
+def trim_fastq_batches(fastq_handler, retain_len, retain_5p_end, batch_size=100000):
+    """Stream a fastq through trim_seqs_array one batch at a time, for files too big to hold in memory.
+
+    Yields:
+        tuple(numpy.ndarray, numpy.ndarray, numpy.ndarray): For each batch, the trimmed (upper-cased) sequences,
+            the trimmed qualities, and the too-short mask, as returned by trim_seqs_array.
+    """
+    for curr_seqs, curr_quals in fastq_batch_generator(fastq_handler, batch_size):
+        yield trim_seqs_array(curr_seqs, retain_len, retain_5p_end, curr_quals)
+
+
+def merge_igm_files_by_lane_read_set(input_files_dir, output_files_dir, file_suffix, num_threads=4):
     read_direction_identifiers = ["_R1_", "_R2_"]
     for curr_direction_id in read_direction_identifiers:
         wildpath = "{0}*{1}".format(curr_direction_id, file_suffix)
         relevant_filepaths = get_filepaths_from_wildcard(input_files_dir, wildpath)
 
         direction_regex = "_L\d\d\d{0}\d\d\d".format(curr_direction_id)
-        merge_files_grouped_by_regex(relevant_filepaths, direction_regex, output_files_dir, file_suffix)
+        merge_files_grouped_by_regex(relevant_filepaths, direction_regex, output_files_dir, file_suffix, num_threads)
 
 
-def merge_files_grouped_by_regex(relevant_filepaths, relevant_regex, output_files_dir, file_suffix):
+def merge_files_grouped_by_regex(relevant_filepaths, relevant_regex, output_files_dir, file_suffix, num_threads=4):
     fps_by_base = group_files(relevant_filepaths, relevant_regex, replacement="")
+
+    # check every output before writing any, so a clash doesn't leave a half-finished merge behind
+    output_fps_by_base = {}
     for curr_base in fps_by_base:
         output_fp = make_file_path(output_files_dir, curr_base, file_suffix)
         if os.path.isfile(output_fp):
             raise ValueError("Output file '{0}' already exists.".format(output_fp))
+        output_fps_by_base[curr_base] = output_fp
+
+    # merging is I/O-bound, so output groups are written concurrently from a thread pool
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        merge_futures = [executor.submit(concatenate_files, fps_by_base[x], output_fps_by_base[x])
+                         for x in fps_by_base]
+        for curr_future in merge_futures:
+            curr_future.result()
+
+
+def merge_paired_lane_files(input_files_dir, output_files_dir, file_suffix, manifest_fp=None, num_threads=4):
+    """Merge each sample's per-lane R1 and R2 files in lockstep, validating and summarizing as it goes.
+
+    For every sample, lane files are appended to <sample>_R1<file_suffix> and <sample>_R2<file_suffix>
+    one lane pair at a time.  Records, bytes, and an md5 of each merged file are computed during the single
+    copy pass, so no second read is needed to verify the merge.  Gzip/BGZF inputs are copied unchanged and
+    decompressed in memory only for counting.  A lane file whose last line has no newline gets one (as an extra
+    gzip member, for compressed inputs), so the next lane's first line isn't run onto it.
+
+    Args:
+        input_files_dir (str): Directory holding files named like <sample>_L001_R1_001<file_suffix>.
+        output_files_dir (str): Directory in which to write the merged files.
+        file_suffix (str): Shared file ending, e.g. ".fastq" or ".fastq.gz".
+        manifest_fp (Optional[str]): Path of a tab-delimited manifest to write.  Default is None (no file).
+        num_threads (Optional[int]): Number of samples to merge concurrently.  Default is 4.
+
+    Returns:
+        list(collections.OrderedDict): One manifest row per merged file, with keys sample, read, filepath,
+            num_lanes, num_records, num_bytes, and md5.
+
+    Raises:
+        ValueError: If samples or lanes have no R1/R2 partner, an output already exists, or any merged R1 and
+            R2 lane (or file) has a different number of records.
+    """
+    fps_by_direction_by_sample = {}
+    for curr_direction_id in ["_R1_", "_R2_"]:
+        wildpath = "{0}*{1}".format(curr_direction_id, file_suffix)
+        relevant_filepaths = get_filepaths_from_wildcard(input_files_dir, wildpath)
+        direction_regex = r"_L\d\d\d{0}\d\d\d".format(curr_direction_id)
+        for curr_fp in sorted(relevant_filepaths):
+            # strip the whole suffix, not just the last extension, so that e.g. .fastq.gz samples are named right
+            curr_base = os.path.basename(curr_fp)[:-len(file_suffix)]
+            curr_sample = re.sub(direction_regex, "", curr_base, 1)
+            curr_fps_by_direction = fps_by_direction_by_sample.setdefault(curr_sample, {})
+            curr_fps_by_direction.setdefault(curr_direction_id, []).append(curr_fp)
+
+    merge_args = []
+    for curr_sample in sorted(fps_by_direction_by_sample):
+        r1_fps = fps_by_direction_by_sample[curr_sample].get("_R1_", [])
+        r2_fps = fps_by_direction_by_sample[curr_sample].get("_R2_", [])
+        # pair on file names, so an "_R1_" elsewhere in the directory path can't break the match
+        expected_r2_names = [re.sub(r"(_L\d\d\d)_R1_(\d\d\d)", r"\1_R2_\2", os.path.basename(x), 1) for x in r1_fps]
+        if expected_r2_names != [os.path.basename(x) for x in r2_fps]:
+            raise ValueError("Sample {0} has unpaired lane files: R1 {1}, R2 {2}".format(
+                curr_sample, r1_fps, r2_fps))
+
+        output_fps = [make_file_path(output_files_dir, "{0}_{1}".format(curr_sample, x), file_suffix)
+                      for x in ["R1", "R2"]]
+        for curr_output_fp in output_fps:
+            if os.path.isfile(curr_output_fp):
+                raise ValueError("Output file '{0}' already exists.".format(curr_output_fp))
+        merge_args.append((curr_sample, r1_fps, r2_fps, output_fps[0], output_fps[1]))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        merge_futures = [executor.submit(_merge_paired_lanes_for_sample, *x) for x in merge_args]
+        sample_results = [x.result() for x in merge_futures]
+
+    manifest_rows = [x for curr_rows, _ in sample_results for x in curr_rows]
+    if manifest_fp is not None:
+        with open(manifest_fp, 'w', newline="") as manifest_f:
+            writer = csv.DictWriter(manifest_f, fieldnames=_MERGE_MANIFEST_FIELDS, delimiter="\t")
+            writer.writeheader()
+            writer.writerows(manifest_rows)
+
+    failure_msgs = [x for _, curr_msgs in sample_results for x in curr_msgs]
+    if len(failure_msgs) > 0:
+        raise ValueError("\n".join(failure_msgs))
+    return manifest_rows
+
+
+def _merge_paired_lanes_for_sample(sample_name, r1_fps, r2_fps, r1_output_fp, r2_output_fp):
+    failure_msgs = []
+    output_fps = [r1_output_fp, r2_output_fp]
+    totals = [{"num_records": 0, "num_bytes": 0, "md5": hashlib.md5()} for _ in output_fps]
+
+    with open(r1_output_fp, 'wb') as r1_output_f, open(r2_output_fp, 'wb') as r2_output_f:
+        output_fs = [r1_output_f, r2_output_f]
+        for curr_lane_fps in zip(r1_fps, r2_fps):
+            lane_num_records = []
+            for input_fp, output_f, curr_totals in zip(curr_lane_fps, output_fs, totals):
+                logging.info("Adding {0} to {1}".format(input_fp, output_f.name))
+                num_bytes, num_lines = _copy_counting_lines(input_fp, output_f, curr_totals["md5"])
+                if num_lines % 4 != 0:
+                    failure_msgs.append("{0} has {1} lines, which is not a whole number of fastq records".format(
+                        input_fp, num_lines))
+                curr_totals["num_bytes"] += num_bytes
+                curr_totals["num_records"] += num_lines // 4
+                lane_num_records.append(num_lines // 4)
+
+            if lane_num_records[0] != lane_num_records[1]:
+                failure_msgs.append("{0} has {1} records but {2} has {3}".format(
+                    curr_lane_fps[0], lane_num_records[0], curr_lane_fps[1], lane_num_records[1]))
+
+    manifest_rows = []
+    for read_name, output_fp, curr_totals in zip(["R1", "R2"], output_fps, totals):
+        curr_values = [sample_name, read_name, output_fp, len(r1_fps), curr_totals["num_records"],
+                       curr_totals["num_bytes"], curr_totals["md5"].hexdigest()]
+        manifest_rows.append(collections.OrderedDict(zip(_MERGE_MANIFEST_FIELDS, curr_values)))
+    return manifest_rows, failure_msgs
+
+
+def _copy_counting_lines(input_fp, output_f, md5, chunk_size=1024 * 1024):
+    compression_type = get_compression_type(input_fp)
+    if compression_type not in (None, GZIP_COMPRESSION, BGZF_COMPRESSION):
+        raise ValueError("Cannot count records in {0}-compressed file {1}".format(compression_type, input_fp))
+    line_counter = _GzipLineCounter() if compression_type is not None else None
+
+    num_bytes = 0
+    num_lines = 0
+    last_byte = b""
+    with open(input_fp, 'rb') as input_f:
+        while True:
+            curr_chunk = input_f.read(chunk_size)
+            if len(curr_chunk) == 0:
+                break
+            output_f.write(curr_chunk)
+            md5.update(curr_chunk)
+            num_bytes += len(curr_chunk)
+            if line_counter is None:
+                num_lines += curr_chunk.count(b"\n")
+                last_byte = curr_chunk[-1:]
+            else:
+                try:
+                    line_counter.update(curr_chunk)
+                except zlib.error as e:
+                    raise ValueError("{0} is not a valid gzip file: {1}".format(input_fp, e))
+
+    if line_counter is not None:
+        if line_counter.is_mid_member:
+            raise ValueError("{0} ends in the middle of a gzip member; the file is truncated.".format(input_fp))
+        num_lines = line_counter.num_lines
+        last_byte = line_counter.last_byte
+
+    if last_byte not in (b"", b"\n"):
+        # the last line has no newline: count it, and end it so that whatever is appended next starts a new line
+        num_lines += 1
+        newline_bytes = b"\n" if line_counter is None else _get_gzip_newline_member()
+        output_f.write(newline_bytes)
+        md5.update(newline_bytes)
+        num_bytes += len(newline_bytes)
+    return num_bytes, num_lines
+
+
+def _get_gzip_newline_member():
+    # fixed mtime, so merging the same inputs always gives the same md5; gzip.compress only takes mtime in 3.8+
+    member_f = io.BytesIO()
+    with gzip.GzipFile(fileobj=member_f, mode='wb', mtime=0) as gzip_f:
+        gzip_f.write(b"\n")
+    return member_f.getvalue()
+
+
+class _GzipLineCounter:
+    # counts newlines in a (possibly multi-member, possibly zero-padded) gzip stream fed to it in arbitrary chunks
+    def __init__(self):
+        self.num_lines = 0
+        self.last_byte = b""
+        self._decompressor = None  # None between members
+
+    @property
+    def is_mid_member(self):
+        return self._decompressor is not None
+
+    def update(self, compressed_chunk):
+        while len(compressed_chunk) > 0:
+            if self._decompressor is None:
+                # whatever follows a member is either another member or zero padding
+                compressed_chunk = compressed_chunk.lstrip(b"\x00")
+                if len(compressed_chunk) == 0:
+                    break
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
 
-        with open(output_fp, 'wb') as output_f:
-            for input_fp in fps_by_base[curr_base]:
-                with open(input_fp, 'rb') as input_f:
-                    logging.info("Adding {0} to {1}".format(input_fp, output_fp))
-                    shutil.copyfileobj(input_f, output_f)
+            curr_data = self._decompressor.decompress(compressed_chunk)
+            self.num_lines += curr_data.count(b"\n")
+            if len(curr_data) > 0:
+                self.last_byte = curr_data[-1:]
+            if not self._decompressor.eof:
+                break
+            compressed_chunk = self._decompressor.unused_data
+            self._decompressor = None
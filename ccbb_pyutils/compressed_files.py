@@ -0,0 +1,417 @@
+# standard libraries
+import collections
+import concurrent.futures
+import gzip
+import io
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import timeit
+import zlib
+
+__author__ = "Amanda Birmingham"
+__maintainer__ = "Amanda Birmingham"
+__email__ = "abirmingham@ucsd.edu"
+__status__ = "prototype"
+
+GZIP_COMPRESSION = "gzip"
+BGZF_COMPRESSION = "bgzf"
+ZSTD_COMPRESSION = "zstd"
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_GZIP_FEXTRA_FLAG = 0x04
+_BGZF_SUBFIELD_ID = b"BC"
+_GZIP_FIXED_HEADER_LEN = 12
+_GZIP_FOOTER_LEN = 8
+_BGZF_BLOCKS_PER_BATCH = 256  # up to 16 MiB of compressed data in flight per file
+_STREAM_CHUNK_SIZE = 1024 * 1024
+
+DecompressionResult = collections.namedtuple("DecompressionResult", ["input_fp", "output_fp", "num_input_bytes",
+                                                                     "num_output_bytes", "elapsed_seconds"])
+
+# Candidate external decompressors in order of preference; each entry is (executable name, extra args builder).
+# Running the decompressor as a separate process lets decompression overlap with parsing in python.
+_DECOMPRESSORS_BY_TYPE = {
+    GZIP_COMPRESSION: [("pigz", lambda n: ["-p", str(n)]), ("igzip", lambda n: ["-T", str(n)]),
+                       ("gzip", lambda n: [])],
+    BGZF_COMPRESSION: [("bgzip", lambda n: ["-@", str(n)]), ("pigz", lambda n: ["-p", str(n)]),
+                       ("igzip", lambda n: ["-T", str(n)]), ("gzip", lambda n: [])],
+    ZSTD_COMPRESSION: [("zstd", lambda n: ["-q", "-T{0}".format(n)])]
+}
+
+
+def get_default_num_decompress_threads():
+    return min(4, os.cpu_count() or 1)
+
+
+def get_compression_type(file_path):
+    """Identify the compression, if any, of the input file from its leading bytes.
+
+    BGZF (as produced by bgzip) is a gzip variant whose members each carry a "BC" extra subfield.
+
+    Args:
+        file_path (str): The path to the file of interest.
+
+    Returns:
+        str or None: One of GZIP_COMPRESSION, BGZF_COMPRESSION, or ZSTD_COMPRESSION, or None if the file is not
+            recognized as compressed.
+    """
+    result = None
+    with open(file_path, 'rb') as file_obj:
+        header = file_obj.read(_GZIP_FIXED_HEADER_LEN)
+        if header.startswith(_ZSTD_MAGIC):
+            result = ZSTD_COMPRESSION
+        elif header.startswith(_GZIP_MAGIC):
+            _, block_size = _read_bgzf_extra_field(header, file_obj)
+            result = GZIP_COMPRESSION if block_size is None else BGZF_COMPRESSION
+    return result
+
+
+def _read_bgzf_extra_field(header, input_f):
+    # A BGZF block is a gzip member whose only header flag is FEXTRA and whose extra field holds a "BC" subfield
+    # with the block's total size - 1; the subfields can come in any order.  Given the fixed part of a member's
+    # header, reads its extra field and returns (extra field, block size), with a block size of None if this isn't
+    # a BGZF block.
+    if len(header) < _GZIP_FIXED_HEADER_LEN or header[:3] != _GZIP_MAGIC + b"\x08" or \
+            header[3] != _GZIP_FEXTRA_FLAG:
+        return b"", None
+
+    extra_len = struct.unpack("<H", header[10:12])[0]
+    extra_field = input_f.read(extra_len)
+    subfield_start = 0
+    while subfield_start + 4 <= len(extra_field):
+        subfield_id = extra_field[subfield_start:subfield_start + 2]
+        subfield_len = struct.unpack("<H", extra_field[subfield_start + 2:subfield_start + 4])[0]
+        subfield_data = extra_field[subfield_start + 4:subfield_start + 4 + subfield_len]
+        if subfield_id == _BGZF_SUBFIELD_ID and subfield_len == 2 and len(subfield_data) == 2:
+            return extra_field, struct.unpack("<H", subfield_data)[0] + 1
+        subfield_start += 4 + subfield_len
+    return extra_field, None
+
+
+def open_decompressed_text(file_path, num_threads=None):
+    """Open the input file for text reading, transparently decompressing gzip, BGZF, and zstd inputs.
+
+    Compressed inputs are streamed through an external (multi-threaded where available) decompressor process
+    so that decompression overlaps with whatever the caller does with the text.  Gzip inputs fall back to the
+    python gzip module if no external decompressor is on the path.
+
+    Args:
+        file_path (str): The path to the (possibly compressed) file to read.
+        num_threads (Optional[int]): Threads to request from the external decompressor.  Default is
+            get_default_num_decompress_threads().
+
+    Returns:
+        io.TextIOBase: A readable text stream; closing it also reaps any decompressor process.
+
+    Raises:
+        ValueError: If the input is zstd-compressed and no zstd executable is available.
+    """
+    return _open_decompressed(file_path, num_threads, is_binary=False)
+
+
+def open_decompressed_binary(file_path, num_threads=None):
+    """Open the input file for binary reading, decompressing as open_decompressed_text does.
+
+    Returns:
+        io.BufferedIOBase: A readable binary stream; closing it also reaps any decompressor process.
+    """
+    return _open_decompressed(file_path, num_threads, is_binary=True)
+
+
+def _open_decompressed(file_path, num_threads, is_binary):
+    compression_type = get_compression_type(file_path)
+    if compression_type is None:
+        return open(file_path, 'rb' if is_binary else 'r')
+
+    num_threads = get_default_num_decompress_threads() if num_threads is None else num_threads
+    call_args = _get_decompressor_args(compression_type, num_threads)
+    if call_args is not None:
+        call_args.extend(["-d", "-c", file_path])
+        return _DecompressorPipeBinaryReader(call_args) if is_binary else _DecompressorPipeReader(call_args)
+
+    if compression_type == ZSTD_COMPRESSION:
+        raise ValueError("Unable to read '{0}': no zstd executable was found on the path.".format(file_path))
+    return gzip.open(file_path, 'rb' if is_binary else 'rt')
+
+
+def _get_decompressor_args(compression_type, num_threads):
+    for curr_executable, curr_args_builder in _DECOMPRESSORS_BY_TYPE[compression_type]:
+        curr_executable_fp = shutil.which(curr_executable)
+        if curr_executable_fp is not None:
+            return [curr_executable_fp] + curr_args_builder(num_threads)
+    return None
+
+
+class _DecompressorPipeMixin:
+    def _start_decompressor(self, call_args, bufsize=-1):
+        self.call_args = call_args
+        self.reached_eof = False
+        # stderr goes to a file rather than a pipe: nothing reads it until the end, and a decompressor that filled
+        # an unread pipe with warnings would block, and so stall the reader too
+        self._stderr_f = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(call_args, shell=False, bufsize=bufsize, stdout=subprocess.PIPE,
+                                        stderr=self._stderr_f)
+        return self.process.stdout
+
+    def _close_decompressor(self, close_stream_func):
+        # if the reader stops early, the decompressor may still be running and its exit status is irrelevant
+        stopped_early = not self.reached_eof and self.process.poll() is None
+        if stopped_early:
+            self.process.terminate()
+        close_stream_func()
+        self.process.wait()
+        with self._stderr_f:
+            self._stderr_f.seek(0)
+            err = self._stderr_f.read()
+
+        if not stopped_early and self.process.returncode != 0:
+            raise subprocess.CalledProcessError(self.process.returncode, self.call_args, stderr=err)
+
+
+class _DecompressorPipeReader(_DecompressorPipeMixin, io.TextIOWrapper):
+    def __init__(self, call_args):
+        super().__init__(self._start_decompressor(call_args))
+
+    def read(self, size=-1):
+        result = super().read(size)
+        if result == "" or size is None or size < 0:
+            self.reached_eof = True
+        return result
+
+    def __next__(self):
+        try:
+            return super().__next__()
+        except StopIteration:
+            self.reached_eof = True
+            raise
+
+    def close(self):
+        if not self.closed:
+            self._close_decompressor(super().close)
+
+
+class _DecompressorPipeBinaryReader(_DecompressorPipeMixin, io.BufferedReader):
+    def __init__(self, call_args):
+        super().__init__(self._start_decompressor(call_args, bufsize=0))
+
+    def read(self, size=-1):
+        result = super().read(size)
+        if result == b"" or size is None or size < 0:
+            self.reached_eof = True
+        return result
+
+    def close(self):
+        if not self.closed:
+            self._close_decompressor(super().close)
+
+
+def decompress_files(compressed_fps, keep_inputs=False, num_workers=None, num_threads_per_file=None,
+                     overwrite=False):
+    """Decompress gzip/BGZF files concurrently, in this process, next to the originals.
+
+    See decompress_file for how each file is handled.  All files are attempted even if some fail.
+
+    Args:
+        compressed_fps (list(str)): Paths of the files to decompress; each output drops the ".gz" (or ".bgz")
+            extension.
+        keep_inputs (Optional[bool]): True to keep the compressed files.  Default is False, like gunzip.
+        num_workers (Optional[int]): Number of files decompressed at once.  Default is
+            get_default_num_decompress_threads().
+        num_threads_per_file (Optional[int]): Threads used within each BGZF file.  Default is
+            get_default_num_decompress_threads().
+        overwrite (Optional[bool]): True to replace existing outputs; otherwise, like gunzip, files whose output
+            already exists are skipped.  Default is False.
+
+    Returns:
+        list(DecompressionResult): One per file decompressed, in input order.
+
+    Raises:
+        ValueError: If any file could not be decompressed or failed its integrity check; its output is not
+            created and its input is kept.
+    """
+    num_workers = get_default_num_decompress_threads() if num_workers is None else num_workers
+    start_time = timeit.default_timer()
+    results = []
+    failure_msgs = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(decompress_file, x, None, keep_inputs, num_threads_per_file, overwrite)
+                   for x in compressed_fps]
+        for curr_fp, curr_future in zip(compressed_fps, futures):
+            try:
+                curr_result = curr_future.result()
+            except (OSError, ValueError) as e:
+                failure_msgs.append("{0}: {1}".format(curr_fp, e))
+                continue
+            if curr_result is not None:
+                results.append(curr_result)
+
+    elapsed_seconds = timeit.default_timer() - start_time
+    num_input_bytes = sum([x.num_input_bytes for x in results])
+    logging.info("Decompressed {0} file(s), {1:.1f} MB in {2:.1f} s ({3:.1f} MB/s)".format(
+        len(results), num_input_bytes / (1024 * 1024), elapsed_seconds,
+        _get_megabytes_per_second(num_input_bytes, elapsed_seconds)))
+
+    if len(failure_msgs) > 0:
+        raise ValueError("Unable to decompress {0} file(s):\n{1}".format(len(failure_msgs),
+                                                                          "\n".join(failure_msgs)))
+    return results
+
+
+def decompress_file(compressed_fp, output_fp=None, keep_input=False, num_threads=None, overwrite=False):
+    """Decompress a gzip or BGZF file without an external gunzip.
+
+    BGZF blocks are independent, so batches of them are inflated in parallel threads (zlib releases the GIL);
+    each block's CRC32 and length are checked.  Other gzip files, including multi-member ones, are streamed
+    through zlib, which checks each member's CRC32 and length.  Output goes to a temporary file that is renamed
+    into place only once the whole input has been verified, so an interrupted or failed run never leaves a
+    partial output behind.  As with gunzip, the output gets the input's permissions and modification time.
+
+    Args:
+        compressed_fp (str): Path of the gzip or BGZF file.
+        output_fp (Optional[str]): Path of the decompressed file.  Default is compressed_fp minus its extension.
+        keep_input (Optional[bool]): True to keep the compressed file.  Default is False.
+        num_threads (Optional[int]): Threads for BGZF inputs.  Default is get_default_num_decompress_threads().
+        overwrite (Optional[bool]): True to replace an existing output.  Default is False, which skips the file.
+
+    Returns:
+        DecompressionResult or None: Sizes and timing, or None if the file was skipped.
+
+    Raises:
+        ValueError: If the input is not gzip-compressed, or is truncated or corrupt.
+    """
+    output_fp = _get_decompressed_fp(compressed_fp) if output_fp is None else output_fp
+    if os.path.exists(output_fp) and not overwrite:
+        logging.info("Not decompressing {0}: {1} already exists".format(compressed_fp, output_fp))
+        return None
+
+    compression_type = get_compression_type(compressed_fp)
+    if compression_type not in (GZIP_COMPRESSION, BGZF_COMPRESSION):
+        raise ValueError("'{0}' is not gzip-compressed.".format(compressed_fp))
+
+    start_time = timeit.default_timer()
+    num_input_bytes = os.path.getsize(compressed_fp)
+    output_dir, output_name = os.path.split(os.path.abspath(output_fp))
+    temp_f = tempfile.NamedTemporaryFile(dir=output_dir, prefix=".{0}.".format(output_name), delete=False)
+    try:
+        with open(compressed_fp, 'rb') as input_f, temp_f:
+            try:
+                if compression_type == BGZF_COMPRESSION:
+                    num_threads = get_default_num_decompress_threads() if num_threads is None else num_threads
+                    num_output_bytes = _decompress_bgzf(input_f, temp_f, num_threads)
+                else:
+                    num_output_bytes = _decompress_gzip_members(input_f, temp_f)
+            except (zlib.error, EOFError, ValueError) as e:
+                raise ValueError("'{0}' is truncated or corrupt: {1}".format(compressed_fp, e)) from e
+        shutil.copystat(compressed_fp, temp_f.name)
+        os.replace(temp_f.name, output_fp)
+    except BaseException:
+        os.remove(temp_f.name)
+        raise
+
+    if not keep_input:
+        os.remove(compressed_fp)
+
+    elapsed_seconds = timeit.default_timer() - start_time
+    logging.info("Decompressed {0}: {1:.1f} MB in {2:.1f} s ({3:.1f} MB/s)".format(
+        compressed_fp, num_input_bytes / (1024 * 1024), elapsed_seconds,
+        _get_megabytes_per_second(num_input_bytes, elapsed_seconds)))
+    return DecompressionResult(compressed_fp, output_fp, num_input_bytes, num_output_bytes, elapsed_seconds)
+
+
+def _get_decompressed_fp(compressed_fp):
+    for curr_extension in [".gz", ".bgz", ".gzip"]:
+        if compressed_fp.endswith(curr_extension):
+            return compressed_fp[:-len(curr_extension)]
+    raise ValueError("Cannot name the output for '{0}': it has no gzip extension.".format(compressed_fp))
+
+
+def _get_megabytes_per_second(num_bytes, elapsed_seconds):
+    return num_bytes / (1024 * 1024) / elapsed_seconds if elapsed_seconds > 0 else 0
+
+
+def _decompress_gzip_members(input_f, output_f):
+    num_output_bytes = 0
+    decompressor = zlib.decompressobj(wbits=31)  # 31 = gzip wrapper, so zlib checks each member's CRC32 and size
+    member_started = False
+    for curr_chunk in iter(lambda: input_f.read(_STREAM_CHUNK_SIZE), b""):
+        while curr_chunk != b"":
+            member_started = True
+            curr_output = decompressor.decompress(curr_chunk)
+            output_f.write(curr_output)
+            num_output_bytes += len(curr_output)
+            curr_chunk = b""
+
+            if decompressor.eof:
+                # whatever follows a member is either another member or zero padding
+                curr_chunk = decompressor.unused_data
+                if curr_chunk.strip(b"\x00") == b"":
+                    curr_chunk = b""
+                decompressor = zlib.decompressobj(wbits=31)
+                member_started = False
+
+    if member_started:
+        raise ValueError("Input ends in the middle of a gzip member; the file is truncated.")
+    return num_output_bytes
+
+
+def _decompress_bgzf(input_f, output_f, num_threads):
+    num_output_bytes = 0
+    found_eof_block = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        while True:
+            blocks = _read_bgzf_blocks(input_f, _BGZF_BLOCKS_PER_BATCH)
+            if len(blocks) == 0:
+                break
+            for curr_output in executor.map(_inflate_bgzf_block, blocks):
+                output_f.write(curr_output)
+                num_output_bytes += len(curr_output)
+            # the end-of-file block is an empty one
+            found_eof_block = blocks[-1][-4:] == b"\x00\x00\x00\x00"
+
+    if input_f.tell() < os.fstat(input_f.fileno()).st_size:
+        # the rest doesn't look like BGZF blocks (e.g. plain gzip appended to a BGZF file); read it as plain gzip,
+        # which checks for truncation itself
+        logging.debug("{0} is not all BGZF; reading from byte {1} as plain gzip".format(
+            input_f.name, input_f.tell()))
+        num_output_bytes += _decompress_gzip_members(input_f, output_f)
+    elif not found_eof_block:
+        logging.warning("{0} has no BGZF end-of-file block; it may be truncated.".format(input_f.name))
+    return num_output_bytes
+
+
+def _read_bgzf_blocks(input_f, max_blocks):
+    # stops early, with the file positioned at its start, at the first member that isn't a BGZF block
+    blocks = []
+    while len(blocks) < max_blocks:
+        block_start = input_f.tell()
+        header = input_f.read(_GZIP_FIXED_HEADER_LEN)
+        if header == b"":
+            break
+        extra_field, block_size = _read_bgzf_extra_field(header, input_f)
+        if block_size is None:
+            input_f.seek(block_start)
+            break
+
+        header += extra_field
+        if block_size < len(header) + _GZIP_FOOTER_LEN:
+            raise ValueError("Invalid BGZF block size {0} at byte {1}.".format(block_size, block_start))
+        rest_of_block = input_f.read(block_size - len(header))
+        if len(rest_of_block) != block_size - len(header):
+            raise ValueError("Input ends in the middle of a BGZF block; the file is truncated.")
+        blocks.append(header + rest_of_block)
+    return blocks
+
+
+def _inflate_bgzf_block(block):
+    header_len = _GZIP_FIXED_HEADER_LEN + struct.unpack("<H", block[10:12])[0]
+    expected_crc, expected_size = struct.unpack("<II", block[-_GZIP_FOOTER_LEN:])
+    result = zlib.decompress(block[header_len:-_GZIP_FOOTER_LEN], -15)  # -15 = raw deflate data
+    if len(result) != expected_size or zlib.crc32(result) != expected_crc:
+        raise ValueError("BGZF block failed its CRC32/length check; the file is corrupt.")
+    return result
@@ -1,8 +1,8 @@
 # standard libraries
 import os
 
-from ccbb_pyutils.parallel_process_fastqs import parallel_process_files
-from ccbb_pyutils.subprocess_summary import call_subprocess
+from ccbb_pyutils.parallel_process_fastqs import parallel_process_files, TaskResources
+from ccbb_pyutils.subprocess_summary import call_subprocess, call_subprocess_cached
 
 from ccbb_pyutils.files_and_paths import verify_or_make_dir
 
@@ -12,22 +12,52 @@ __email__ = "abirmingham@ucsd.edu"
 __status__ = "prototype"
 
 
-def run_fastqc(top_output_dir, fastqc_filepath, ext_name, fastq_fp):
+# fastqc allocates about this much java heap per thread
+FASTQC_MEMORY_GB_PER_THREAD = 0.25
+FASTQC_COMPRESSION_EXTENSIONS = [".gz", ".bz2"]
+FASTQC_FORMAT_EXTENSIONS = [".txt", ".fastq", ".fq", ".csfastq", ".sam", ".bam"]
+
+
+def run_fastqc(top_output_dir, fastqc_filepath, ext_name, fastq_fp, num_threads=None, cache_dir=None):
     results_dir = "{0}/fastqc_results".format(top_output_dir)    
     verify_or_make_dir(results_dir)
     
     call_args = [fastqc_filepath]
     call_args.append(fastq_fp)
     call_args.extend(["--extract", "--outdir={0}".format(results_dir)])
-    call_subprocess(call_args)
+    if num_threads is not None:
+        call_args.append("--threads={0}".format(num_threads))
+
+    if cache_dir is None:
+        call_subprocess(call_args)
+    else:
+        output_base = os.path.join(results_dir, _get_fastqc_output_base(fastq_fp))
+        output_fps = [output_base + "_fastqc.html", output_base + "_fastqc.zip", output_base + "_fastqc"]
+        call_subprocess_cached(call_args, cache_dir, [fastq_fp], output_fps)
+
+
+def _get_fastqc_output_base(fastq_fp):
+    # fastqc names its outputs after the input file, minus any compression and sequence-format extensions
+    result = os.path.basename(fastq_fp)
+    for curr_extensions in [FASTQC_COMPRESSION_EXTENSIONS, FASTQC_FORMAT_EXTENSIONS]:
+        for curr_extension in curr_extensions:
+            if result.endswith(curr_extension):
+                result = result[:-len(curr_extension)]
+                break
+    return result
 
 
 def run_parallel_fastqc(input_dir, output_dir, num_processors,
-    fastqc_fp="fastqc", seq_file_ext_name=".fastq"):
+    fastqc_fp="fastqc", seq_file_ext_name=".fastq", threads_per_file=None, resource_budget=None):
+
+    task_resources = None
+    if threads_per_file is not None:
+        task_resources = TaskResources(threads_per_file, threads_per_file * FASTQC_MEMORY_GB_PER_THREAD)
 
     results = parallel_process_files(input_dir, seq_file_ext_name, num_processors,
                 run_fastqc,
-                [output_dir, fastqc_fp, seq_file_ext_name])
+                [output_dir, fastqc_fp, seq_file_ext_name],
+                task_resources=task_resources, resource_budget=resource_budget)
     return results
 
 
@@ -1,16 +1,32 @@
 # standard libraries
+import collections
+import concurrent.futures
+import errno
 import fnmatch
 import glob
+import hashlib
 import logging
 import os
 import re
+import shutil
+import tempfile
+import types
 import warnings
 
+from ccbb_pyutils.compressed_files import decompress_files
+
 __author__ = "Amanda Birmingham"
 __maintainer__ = "Amanda Birmingham"
 __email__ = "abirmingham@ucsd.edu"
 __status__ = "prototype"
 
+DEFAULT_NUM_WALK_THREADS = 8
+DEFAULT_NUM_MOVE_THREADS = 4
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+IndexedPath = collections.namedtuple("IndexedPath", ["path", "dir_path", "name", "is_dir", "size", "mtime_ns"])
+FileMove = collections.namedtuple("FileMove", ["source_fp", "target_fp"])
+
 
 def transform_path(input_fp, output_dir, output_ext, input_suffix_to_replace=None):
     if input_suffix_to_replace is not None:
@@ -93,6 +109,171 @@ def get_basename_fps_tuples(parent_dir, wildcard_filename, subdirs_are_basename,
     return result
 
 
+class DirectoryIndex:
+    """In-memory listing of a directory tree, built in one os.scandir pass, for answering repeated file queries.
+
+    Query methods mirror the module functions of the same names (get_filepaths_from_wildcard etc.) but never
+    touch the filesystem.  The index goes stale when files are created, deleted, or renamed: callers that make
+    such changes themselves can report them with record_changes, and otherwise refresh (re-scan) or invalidate
+    (re-scan on next query) it.  is_stale compares each indexed directory's modification time, which changes
+    whenever an entry in it is added, removed, or renamed, to the one recorded at scan time.
+
+    Paths are matched on their absolute, normalized forms, so e.g. "/data/fastqs/" and "/data/fastqs" are the same
+    directory, but query results are spelled as they were scanned (starting with top_dir, like glob's).
+    """
+
+    def __init__(self, top_dir, recursive=True):
+        """Scan the input directory.
+
+        Args:
+            top_dir (str): The directory to index.
+            recursive (Optional[bool]): True to index all subdirectories too.  Default is True.
+        """
+        self.top_dir = top_dir
+        self.recursive = recursive
+        self._entries_by_path = None
+        self._dir_mtimes_ns = None
+        self._dir_paths_by_key = None
+        self.refresh()
+
+    def __len__(self):
+        return len(self._get_entries_by_path())
+
+    def refresh(self):
+        entries_by_path = collections.OrderedDict()
+        dir_mtimes_ns = {}
+        dir_paths_by_key = {}
+        pending_dirs = [self.top_dir]
+        while len(pending_dirs) > 0:
+            curr_dir = pending_dirs.pop()
+            try:
+                curr_dir_mtime_ns = os.stat(curr_dir).st_mtime_ns
+                dir_entries = os.scandir(curr_dir)
+            except OSError as e:
+                # like os.walk, skip directories that can't be listed
+                logging.debug("Skipping unreadable directory '{0}': {1}".format(curr_dir, e))
+                continue
+
+            curr_dir_key = _get_path_key(curr_dir)
+            dir_mtimes_ns[curr_dir_key] = curr_dir_mtime_ns
+            dir_paths_by_key[curr_dir_key] = curr_dir
+            with dir_entries:
+                for curr_entry in dir_entries:
+                    curr_indexed_path = _get_indexed_path(curr_entry, curr_dir)
+                    entries_by_path[os.path.join(curr_dir_key, curr_entry.name)] = curr_indexed_path
+                    # like os.walk, list links to directories as directories but don't follow them, which also
+                    # keeps link cycles from recursing forever
+                    if curr_indexed_path.is_dir and self.recursive and not curr_entry.is_symlink():
+                        pending_dirs.append(curr_entry.path)
+
+        self._entries_by_path = entries_by_path
+        self._dir_mtimes_ns = dir_mtimes_ns
+        self._dir_paths_by_key = dir_paths_by_key
+
+    def invalidate(self):
+        self._entries_by_path = None
+
+    def includes_dir(self, dir_path):
+        self._get_entries_by_path()
+        return _get_path_key(dir_path) in self._dir_mtimes_ns
+
+    def is_stale(self):
+        if self._entries_by_path is None:
+            return True
+        for curr_dir, curr_mtime_ns in self._dir_mtimes_ns.items():
+            try:
+                if os.stat(curr_dir).st_mtime_ns != curr_mtime_ns:
+                    return True
+            except FileNotFoundError:
+                return True
+        return False
+
+    def refresh_if_stale(self):
+        """Re-scan if is_stale(); returns True if it did."""
+        result = self.is_stale()
+        if result:
+            self.refresh()
+        return result
+
+    def record_changes(self, removed_fps=(), added_fps=()):
+        """Update the index for files the caller itself removed or added (e.g. by renaming), without a re-scan.
+
+        Added files must be in an indexed directory.
+        """
+        entries_by_path = self._get_entries_by_path()
+        changed_dir_keys = set()
+        for curr_fp in removed_fps:
+            curr_key = _get_path_key(curr_fp)
+            if entries_by_path.pop(curr_key, None) is not None:
+                changed_dir_keys.add(os.path.dirname(curr_key))
+        for curr_fp in added_fps:
+            curr_key = _get_path_key(curr_fp)
+            curr_dir_key, curr_name = os.path.split(curr_key)
+            if curr_dir_key not in self._dir_mtimes_ns:
+                raise ValueError("'{0}' is not in a directory indexed under '{1}'.".format(curr_fp, self.top_dir))
+            # spell the path the way the scan would have
+            curr_dir = self._dir_paths_by_key[curr_dir_key]
+            curr_stat = os.stat(curr_fp)
+            entries_by_path[curr_key] = IndexedPath(os.path.join(curr_dir, curr_name), curr_dir, curr_name,
+                                                    os.path.isdir(curr_fp), curr_stat.st_size,
+                                                    curr_stat.st_mtime_ns)
+            changed_dir_keys.add(curr_dir_key)
+
+        # the changes were ours, so the directories' new modification times don't make the index stale
+        for curr_dir_key in changed_dir_keys:
+            self._dir_mtimes_ns[curr_dir_key] = os.stat(curr_dir_key).st_mtime_ns
+
+    def get_entries(self, wildcard_filename="*", all_subdirs=False):
+        """Return the IndexedPaths whose names match the wildcard, as for get_filepaths_from_wildcard."""
+        name_regex = re.compile(fnmatch.translate(wildcard_filename))
+        if all_subdirs:
+            if not self.recursive:
+                raise ValueError("This index of '{0}' does not include subdirectories.".format(self.top_dir))
+            # like os.walk + fnmatch.filter: files only, at any depth, hidden ones included
+            return [x for x in self._get_entries_by_path().values() if not x.is_dir and name_regex.match(x.name)]
+
+        # like glob.glob: files and directories directly in top_dir, hidden ones only if asked for explicitly
+        include_hidden = wildcard_filename.startswith(".")
+        return [x for x in self._get_entries_by_path().values()
+                if x.dir_path == self.top_dir and name_regex.match(x.name) and
+                (include_hidden or not x.name.startswith("."))]
+
+    def get_filepaths_from_wildcard(self, wildcard_filename, prefix_asterisk=True, all_subdirs=False):
+        wildcard_filename = ("*" + wildcard_filename) if prefix_asterisk else wildcard_filename
+        return [x.path for x in self.get_entries(wildcard_filename, all_subdirs)]
+
+    def get_filepaths_by_prefix_and_suffix(self, prefix, suffix, all_subdirs=False):
+        suffix_fps = self.get_filepaths_from_wildcard(suffix, all_subdirs=all_subdirs)
+        return _filter_filepaths_by_prefix(suffix_fps, prefix)
+
+    def summarize_filenames_for_prefix_and_suffix(self, run_prefix, counts_suffix, all_subdirs=False):
+        return _summarize_filenames(self.get_filepaths_by_prefix_and_suffix(run_prefix, counts_suffix,
+                                                                            all_subdirs=all_subdirs))
+
+    def _get_entries_by_path(self):
+        if self._entries_by_path is None:
+            self.refresh()
+        return self._entries_by_path
+
+
+def _get_path_key(path):
+    return os.path.abspath(path)
+
+
+def _get_indexed_path(dir_entry, dir_path):
+    try:
+        is_dir = dir_entry.is_dir()
+    except OSError:
+        is_dir = False
+
+    try:
+        entry_stat = dir_entry.stat()
+    except OSError:
+        # e.g. a dangling link or a link cycle; describe the link itself
+        entry_stat = dir_entry.stat(follow_symlinks=False)
+    return IndexedPath(dir_entry.path, dir_path, dir_entry.name, is_dir, entry_stat.st_size, entry_stat.st_mtime_ns)
+
+
 def get_filepaths_from_wildcard(directory, wildcard_filename, prefix_asterisk=True, all_subdirs=False):
     """Identify all file paths in the input directory that match the input wildcard.
 
@@ -123,43 +304,164 @@ def get_filepaths_from_wildcard(directory, wildcard_filename, prefix_asterisk=Tr
     return result
 
 
-def _recursively_get_filepaths_from_wildcard(directory, wildcard_filename):
-    # code from https://stackoverflow.com/questions/2186525/use-a-glob-to-find-files-recursively-in-python
+def _recursively_get_filepaths_from_wildcard(directory, wildcard_filename, prune_patterns=None, num_threads=None):
+    # sorted, since the concurrent walk finds files in a different order on every run
+    return sorted(iter_filepaths_from_wildcard(directory, wildcard_filename, prune_patterns, num_threads))
+
+
+def iter_filepaths_from_wildcard(directory, wildcard_filename, prune_patterns=None, num_threads=None):
+    """Yield the paths of all files anywhere under the input directory whose names match the input wildcard.
+
+    Directories are listed concurrently, so on high-latency (e.g. networked) filesystems this is much faster than
+    os.walk.  Paths are yielded as each directory's listing comes back, so their order can differ from run to run
+    (sort them if that matters).  Like os.walk, symbolic links to directories are not followed and unreadable
+    directories are skipped.
+
+    Args:
+        directory (str): The path to the directory of interest.
+        wildcard_filename (str): fnmatch-style wildcard that file names must match, e.g. "*_aligned.fa".
+        prune_patterns (Optional[list(str)]): fnmatch-style wildcards; subdirectories whose names match any of
+            these are not searched.  Default is None, which searches all subdirectories.
+        num_threads (Optional[int]): Maximum number of directories listed at once.  Default is
+            DEFAULT_NUM_WALK_THREADS.
+
+    Yields:
+        str: A matching file path.
+    """
+    name_regex = re.compile(fnmatch.translate(wildcard_filename))
+    prune_regex = None
+    if prune_patterns:
+        prune_regex = re.compile("|".join([fnmatch.translate(x) for x in prune_patterns]))
+    num_threads = DEFAULT_NUM_WALK_THREADS if num_threads is None else num_threads
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+    pending_futures = {executor.submit(_scan_dir_for_matches, directory, name_regex, prune_regex)}
+    try:
+        while len(pending_futures) > 0:
+            done_futures, pending_futures = concurrent.futures.wait(
+                pending_futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for curr_future in done_futures:
+                matching_fps, subdir_paths = curr_future.result()
+                for curr_subdir_path in subdir_paths:
+                    pending_futures.add(executor.submit(_scan_dir_for_matches, curr_subdir_path, name_regex,
+                                                        prune_regex))
+                for curr_fp in matching_fps:
+                    yield curr_fp
+    finally:
+        # if the caller stopped early, don't keep listing directories nobody will look at
+        for curr_future in pending_futures:
+            curr_future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _scan_dir_for_matches(directory, name_regex, prune_regex):
     matching_fps = []
-    for root, dirnames, filenames in os.walk(directory):
-        for filename in fnmatch.filter(filenames, wildcard_filename):
-            matching_fps.append(os.path.join(root, filename))
-    return matching_fps
+    subdir_paths = []
+    try:
+        with os.scandir(directory) as dir_entries:
+            for curr_entry in dir_entries:
+                try:
+                    # same classification as os.walk: a link to a directory counts as a directory, not a file
+                    curr_is_dir = curr_entry.is_dir()
+                except OSError:
+                    curr_is_dir = False
+
+                if curr_is_dir:
+                    if not curr_entry.is_symlink() and (prune_regex is None or not prune_regex.match(curr_entry.name)):
+                        subdir_paths.append(curr_entry.path)
+                elif name_regex.match(curr_entry.name):
+                    matching_fps.append(curr_entry.path)
+    except OSError as e:
+        logging.debug("Skipping unreadable directory '{0}': {1}".format(directory, e))
+    return matching_fps, subdir_paths
 
 
 def get_filepaths_by_prefix_and_suffix(directory, prefix, suffix, all_subdirs=False):
     suffix_fps = get_filepaths_from_wildcard(directory, suffix, all_subdirs=all_subdirs)
-    if prefix is not None and prefix is not "":
-        prefix_and_suffix_fps = [x for x in suffix_fps if prefix in x]
+    return _filter_filepaths_by_prefix(suffix_fps, prefix)
+
+
+def _filter_filepaths_by_prefix(filepaths, prefix):
+    if prefix is not None and prefix != "":
+        prefix_and_suffix_fps = [x for x in filepaths if prefix in x]
     else:
-        prefix_and_suffix_fps = suffix_fps
+        prefix_and_suffix_fps = filepaths
     return prefix_and_suffix_fps
 
 
 def group_files(filepaths, regex, replacement=""):
-    filepaths.sort()  # ensure always combined in same order
-    filepaths_by_bases = {}
+    """Group file paths by their base names with the first match of the regex replaced.
 
-    for curr_fp in filepaths:
-        _, file_base, _ = get_file_name_pieces(curr_fp)
-        condensed_file_base = re.sub(regex, replacement, file_base, 1)
+    Example:
+        Inputting ["s1_R1_001.fastq", "s1_R2_001.fastq"], "_R\\d_", "_" returns
+            {"s1_001": ["s1_R1_001.fastq", "s1_R2_001.fastq"]}.
+
+    Args:
+        filepaths (list(str)): The file paths to group; not modified.
+        regex (str or re.Pattern): The pattern to replace in each file base name (without extension).
+        replacement (Optional[str]): What to replace the first match with.  Default is "".
+
+    Returns:
+        dict(str, list(str)): Each condensed base name mapped to its file paths, in sorted order.
+    """
+    compiled_regex = re.compile(regex)
+    filepaths_by_bases = collections.defaultdict(list)
+    for curr_fp in sorted(filepaths):  # sorted copy, so always combined in same order
+        file_base = os.path.splitext(os.path.basename(curr_fp))[0]
+        filepaths_by_bases[compiled_regex.sub(replacement, file_base, 1)].append(curr_fp)
+
+    return dict(filepaths_by_bases)
+
+
+def group_files_by_keys(filepaths, regex, key_names=None):
+    """Group file paths, in one pass, by several fields pulled out of their base names.
 
-        if not condensed_file_base in filepaths_by_bases:
-            filepaths_by_bases[condensed_file_base] = [curr_fp]
+    Example:
+        Inputting ["s1_L001_R1_001.fastq", "s1_L002_R1_001.fastq"], r"(?P<sample>.+)_L\\d+_(?P<read>R\\d)_" returns
+            {("s1", "R1"): ("s1_L001_R1_001.fastq", "s1_L002_R1_001.fastq")}.
+
+    Args:
+        filepaths (list(str)): The file paths to group; not modified.
+        regex (str or re.Pattern): Pattern with named groups, searched for in each file base name (without
+            extension).
+        key_names (Optional[list(str)]): The named groups that make up the grouping key, in order.  Default is
+            None, which uses all of the regex's named groups.
+
+    Returns:
+        types.MappingProxyType: Read-only mapping of each key tuple to a tuple of its file paths, in sorted order.
+
+    Raises:
+        ValueError: If the regex has no named groups or doesn't match some of the file base names.
+    """
+    compiled_regex = re.compile(regex)
+    if key_names is None:
+        key_names = sorted(compiled_regex.groupindex, key=compiled_regex.groupindex.get)
+    if len(key_names) == 0:
+        raise ValueError("Regex '{0}' has no named groups to group by.".format(compiled_regex.pattern))
+
+    filepaths_by_keys = collections.defaultdict(list)
+    unmatched_fps = []
+    for curr_fp in sorted(filepaths):
+        curr_match = compiled_regex.search(os.path.splitext(os.path.basename(curr_fp))[0])
+        if curr_match is None:
+            unmatched_fps.append(curr_fp)
         else:
-            filepaths_by_bases[condensed_file_base].append(curr_fp)
+            filepaths_by_keys[tuple([curr_match.group(x) for x in key_names])].append(curr_fp)
 
-    return filepaths_by_bases
+    if len(unmatched_fps) > 0:
+        raise ValueError("Regex '{0}' does not match {1} file(s): {2}".format(
+            compiled_regex.pattern, len(unmatched_fps), ", ".join(unmatched_fps)))
+
+    return types.MappingProxyType({k: tuple(v) for k, v in filepaths_by_keys.items()})
 
 
 def summarize_filenames_for_prefix_and_suffix(directory, run_prefix, counts_suffix, all_subdirs=False):
     prefix_and_suffix_fps = get_filepaths_by_prefix_and_suffix(directory, run_prefix, counts_suffix,
                                                                all_subdirs=all_subdirs)
+    return _summarize_filenames(prefix_and_suffix_fps)
+
+
+def _summarize_filenames(prefix_and_suffix_fps):
     filenames = []
     for curr_fp in prefix_and_suffix_fps:
         _, filename = os.path.split(curr_fp)
@@ -173,53 +475,200 @@ def verify_or_make_dir(dir_path):
     os.makedirs(dir_path, exist_ok=True)  # True = is OK if path already exists
 
 
-def gunzip_wildpath(directory, name_match, keep_gzs=False, do_recursive=False):
-    # gunzip the gzipped files; do this from shell because doing through
-    # python gzip module is slow
-    matching_fps = get_filepaths_from_wildcard(directory, name_match, all_subdirs=do_recursive)
-    # note that the -k or --keep switch is only supported in gzip 1.6 or later!
-    keep_switch = "-k " if keep_gzs else ""
-    for curr_fp in matching_fps:
-        gunzip_cmd = "gunzip {0}{1}".format(keep_switch, curr_fp)
-        os.system(gunzip_cmd)
+def gunzip_wildpath(directory, name_match, keep_gzs=False, do_recursive=False, num_workers=None,
+                    directory_index=None):
+    # decompress in-process, several files at once (and BGZF files block-parallel); see
+    # compressed_files.decompress_files.  If given, directory_index (a DirectoryIndex of directory) is used to
+    # find the files and is kept up to date.
+    if directory_index is None:
+        matching_fps = get_filepaths_from_wildcard(directory, name_match, all_subdirs=do_recursive)
+    else:
+        matching_fps = directory_index.get_filepaths_from_wildcard(name_match, all_subdirs=do_recursive)
+
+    try:
+        results = decompress_files(matching_fps, keep_inputs=keep_gzs, num_workers=num_workers)
+    except ValueError:
+        if directory_index is not None:
+            directory_index.invalidate()
+        raise
+
+    _record_index_changes(directory_index, removed_fps=[] if keep_gzs else [x.input_fp for x in results],
+                          added_fps=[x.output_fp for x in results])
+    return results
+
+
+def _record_index_changes(directory_index, removed_fps, added_fps):
+    # the filesystem changes are already done, so a bookkeeping problem shouldn't fail the caller; the index just
+    # re-scans on its next query instead
+    if directory_index is None:
+        return
+    try:
+        directory_index.record_changes(removed_fps=removed_fps, added_fps=added_fps)
+    except (OSError, ValueError) as e:
+        logging.debug("Re-scanning index of '{0}': {1}".format(directory_index.top_dir, e))
+        directory_index.invalidate()
+
+
+def move_to_dir_and_flatten(source_dir, target_dir, name_match, directory_index=None, dry_run=False,
+                            num_threads=None):
+    """Move all files matching the wildcard anywhere under source_dir directly into target_dir.
+
+    The whole set of moves is planned (see plan_flatten_moves) before anything is moved, so a name collision
+    stops the flattening before it starts rather than overwriting a file.  Each file is renamed if possible,
+    or else (e.g. when target_dir is on another filesystem) copied, fsynced, and then deleted from source_dir.
+
+    Args:
+        source_dir (str): The directory to search, recursively.
+        target_dir (str): The directory to move the matching files into.
+        name_match (str): The fixed, shared part of the filenames of interest, as for get_filepaths_from_wildcard.
+        directory_index (Optional[DirectoryIndex]): Index of source_dir to find the files with, which is kept up to
+            date.  Default is None, which searches the filesystem.
+        dry_run (Optional[bool]): True to just log and return the planned moves.  Default is False.
+        num_threads (Optional[int]): Maximum number of files moved at once.  Default is DEFAULT_NUM_MOVE_THREADS.
+
+    Returns:
+        list(FileMove): The planned (or, if dry_run, would-be) moves.
+    """
+    planned_moves = plan_flatten_moves(source_dir, target_dir, name_match, directory_index)
+    if dry_run:
+        for curr_move in planned_moves:
+            logging.info("Would move {0} to {1}".format(curr_move.source_fp, curr_move.target_fp))
+        return planned_moves
+
+    try:
+        execute_file_moves(planned_moves, num_threads)
+    except BaseException:
+        if directory_index is not None:
+            directory_index.invalidate()
+        raise
+
+    if directory_index is not None:
+        target_is_indexed = directory_index.includes_dir(target_dir)
+        _record_index_changes(directory_index, removed_fps=[x.source_fp for x in planned_moves],
+                              added_fps=[x.target_fp for x in planned_moves] if target_is_indexed else [])
+    return planned_moves
+
+
+def plan_flatten_moves(source_dir, target_dir, name_match, directory_index=None):
+    """Return the moves that would put every file matching the wildcard under source_dir directly in target_dir.
 
+    Files already in target_dir stay where they are.
 
-def move_to_dir_and_flatten(source_dir, target_dir, name_match):
-    matching_fps = get_filepaths_from_wildcard(source_dir, name_match, all_subdirs=True)
-    for curr_fp in matching_fps:
+    Raises:
+        ValueError: If any two files (moved or already in target_dir) would end up with the same path.
+    """
+    if directory_index is None:
+        matching_fps = get_filepaths_from_wildcard(source_dir, name_match, all_subdirs=True)
+    else:
+        matching_fps = directory_index.get_filepaths_from_wildcard(name_match, all_subdirs=True)
+
+    # one listing of the target rather than a stat per planned move
+    existing_names = set(os.listdir(target_dir)) if os.path.isdir(target_dir) else set()
+    abs_target_dir = os.path.abspath(target_dir)
+    planned_moves = []
+    source_fps_by_name = collections.defaultdict(list)
+    for curr_fp in sorted(matching_fps):
         curr_dir, curr_fname = os.path.split(curr_fp)
-        if curr_dir != target_dir:
-            os.rename(curr_fp, os.path.join(target_dir, curr_fname))
+        if os.path.abspath(curr_dir) == abs_target_dir:
+            continue
+        source_fps_by_name[curr_fname].append(curr_fp)
+        planned_moves.append(FileMove(curr_fp, os.path.join(target_dir, curr_fname)))
+
+    collision_msgs = []
+    for curr_fname, curr_source_fps in source_fps_by_name.items():
+        if len(curr_source_fps) > 1 or curr_fname in existing_names:
+            existing_msg = " (already in target)" if curr_fname in existing_names else ""
+            collision_msgs.append("'{0}'{1} from {2}".format(curr_fname, existing_msg, ", ".join(curr_source_fps)))
+    if len(collision_msgs) > 0:
+        raise ValueError("Cannot flatten {0} into '{1}' without overwriting: {2}".format(
+            source_dir, target_dir, "; ".join(collision_msgs)))
+
+    return planned_moves
+
 
+def execute_file_moves(file_moves, num_threads=None):
+    """Carry out the input FileMoves concurrently, renaming where possible and copying across filesystems.
 
-def unzip_and_flatten_files(top_fastqs_dir, ext_name, gzip_ext_name, keep_gzs):
+    Raises:
+        OSError: The first error encountered, after all the other moves have finished.
+    """
+    num_threads = DEFAULT_NUM_MOVE_THREADS if num_threads is None else num_threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = [executor.submit(_move_file, x.source_fp, x.target_fp) for x in file_moves]
+    for curr_future in futures:
+        curr_future.result()
+
+
+def _move_file(source_fp, target_fp):
+    try:
+        os.rename(source_fp, target_fp)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        _copy_and_unlink(source_fp, target_fp)
+
+
+def _copy_and_unlink(source_fp, target_fp):
+    # copy to a temporary name first, so a half-copied file never appears under the real name, and make sure the
+    # copy is on disk before deleting the original
+    target_dir, target_name = os.path.split(target_fp)
+    temp_f = tempfile.NamedTemporaryFile(dir=target_dir, prefix=".{0}.".format(target_name), delete=False)
+    try:
+        with open(source_fp, 'rb') as source_f, temp_f:
+            _copy_file_contents(source_f, temp_f)
+            temp_f.flush()
+            os.fsync(temp_f.fileno())
+        shutil.copystat(source_fp, temp_f.name)
+        os.replace(temp_f.name, target_fp)
+    except BaseException:
+        os.remove(temp_f.name)
+        raise
+    _fsync_dir(target_dir)
+    os.remove(source_fp)
+
+
+def _fsync_dir(dir_path):
+    dir_fd = os.open(dir_path or ".", os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def unzip_and_flatten_files(top_fastqs_dir, ext_name, gzip_ext_name, keep_gzs, directory_index=None):
     # first, recursively unzip all <ext_name><gzip_ext_name> (e.g., .fastq.gz) files anywhere under the input dir
-    gunzip_wildpath(top_fastqs_dir, ext_name + gzip_ext_name, keep_gzs, True)  # True = do recursive
+    gunzip_wildpath(top_fastqs_dir, ext_name + gzip_ext_name, keep_gzs, True,  # True = do recursive
+                    directory_index=directory_index)
     # now move all fastqs to top-level directory so don't have to work recursively in future
-    move_to_dir_and_flatten(top_fastqs_dir, top_fastqs_dir, ext_name)
+    move_to_dir_and_flatten(top_fastqs_dir, top_fastqs_dir, ext_name, directory_index=directory_index)
 
 
 def list_and_unzip_files(fastq_top_dir, ext_name, keep_gzs):
     gzip_ext_name = ".gz"
+    # walk the tree once; the unzipping and moving below keep the index current as they go
+    directory_index = DirectoryIndex(fastq_top_dir)
 
     # examine the existing compressed files
     logging.info("{0}{1} files:".format(ext_name, gzip_ext_name))
-    logging.info(summarize_filenames_for_prefix_and_suffix(fastq_top_dir, "",
-                                                           "{0}{1}".format(ext_name, gzip_ext_name),
-                                                           all_subdirs=True))
+    logging.info(directory_index.summarize_filenames_for_prefix_and_suffix(
+        "", "{0}{1}".format(ext_name, gzip_ext_name), all_subdirs=True))
 
     # uncompress them and move them to the top directory
-    unzip_and_flatten_files(fastq_top_dir, ext_name, gzip_ext_name, keep_gzs)
+    unzip_and_flatten_files(fastq_top_dir, ext_name, gzip_ext_name, keep_gzs, directory_index=directory_index)
 
     # examine the existing uncompressed files
     logging.info("\n{0} files:".format(ext_name))
-    logging.info(summarize_filenames_for_prefix_and_suffix(fastq_top_dir, "", ext_name))
+    logging.info(directory_index.summarize_filenames_for_prefix_and_suffix("", ext_name))
 
 
 def check_file_presence(directory, name_prefix, name_suffix, all_subdirs=False,
-                        check_failure_msg=None, just_warn=False):
+                        check_failure_msg=None, just_warn=False, directory_index=None):
 
-    created_fps = summarize_filenames_for_prefix_and_suffix(directory, name_prefix, name_suffix, all_subdirs)
+    if directory_index is None:
+        created_fps = summarize_filenames_for_prefix_and_suffix(directory, name_prefix, name_suffix, all_subdirs)
+    else:
+        created_fps = directory_index.summarize_filenames_for_prefix_and_suffix(name_prefix, name_suffix,
+                                                                                all_subdirs)
     if len(created_fps) == 0:
         check_failure_msg = "" if check_failure_msg is None else check_failure_msg + " "
         output_msg = "{0}No files with names beginning with '{1}' and ending with '{2}' " \
@@ -233,6 +682,93 @@ def check_file_presence(directory, name_prefix, name_suffix, all_subdirs=False,
     return created_fps
 
 
+def concatenate_files(input_fps, output_fp):
+    """Concatenate the input files, in order, into the output file.
+
+    Data is copied in the kernel (os.copy_file_range, else os.sendfile) where the platform and filesystems allow,
+    falling back to a buffered python copy.  Gzip files are simply concatenated: a sequence of gzip members is
+    itself a valid gzip file, so no decompression or recompression is needed.
+
+    Args:
+        input_fps (list(str)): Paths of the files to concatenate.
+        output_fp (str): Path of the file to create (or overwrite).
+    """
+    with open(output_fp, 'wb') as output_f:
+        for input_fp in input_fps:
+            with open(input_fp, 'rb') as input_f:
+                logging.info("Adding {0} to {1}".format(input_fp, output_fp))
+                _copy_file_contents(input_f, output_f)
+
+
+def _copy_file_contents(input_f, output_f):
+    input_fd = input_f.fileno()
+    output_fd = output_f.fileno()
+    remaining_bytes = os.fstat(input_fd).st_size - input_f.tell()
+
+    kernel_copy_funcs = []
+    if hasattr(os, "copy_file_range"):  # linux, python 3.8+
+        kernel_copy_funcs.append(_copy_file_range)
+    if hasattr(os, "sendfile"):
+        kernel_copy_funcs.append(_sendfile)
+
+    for curr_copy_func in kernel_copy_funcs:
+        try:
+            while remaining_bytes > 0:
+                num_copied = curr_copy_func(input_fd, output_fd, remaining_bytes)
+                if num_copied == 0:
+                    break  # this method can't go on (e.g. unsupported by the filesystem); the next one resumes here
+                remaining_bytes -= num_copied
+        except OSError as e:
+            # these mean the kernel can't do this particular copy (e.g. across filesystems); anything else is real
+            if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF):
+                raise
+        if remaining_bytes == 0:
+            return
+
+    # kernel copies advance the underlying file positions, so the python copy resumes wherever they stopped
+    input_f.seek(os.lseek(input_fd, 0, os.SEEK_CUR))
+    output_f.seek(os.lseek(output_fd, 0, os.SEEK_CUR))
+    while remaining_bytes > 0:
+        curr_chunk = input_f.read(min(remaining_bytes, _COPY_CHUNK_SIZE))
+        if len(curr_chunk) == 0:
+            raise OSError("'{0}' ended {1} bytes short of its expected size while being copied.".format(
+                input_f.name, remaining_bytes))
+        output_f.write(curr_chunk)
+        remaining_bytes -= len(curr_chunk)
+
+
+def _copy_file_range(input_fd, output_fd, num_bytes):
+    return os.copy_file_range(input_fd, output_fd, num_bytes)
+
+
+def _sendfile(input_fd, output_fd, num_bytes):
+    return os.sendfile(output_fd, input_fd, None, num_bytes)
+
+
+def get_file_fingerprint(file_path, hash_name=None, chunk_size=1024 * 1024):
+    """Return a cheap identity for the contents of a file, for noticing when an input has changed.
+
+    Args:
+        file_path (str): The path to the file of interest.
+        hash_name (Optional[str]): A hashlib algorithm name (e.g. "md5") to also hash the full contents, which
+            catches changes that preserve size and modification time.  Default is None (no hash).
+        chunk_size (Optional[int]): Bytes read at a time when hashing.
+
+    Returns:
+        tuple(int, int, str or None): The size in bytes, the modification time in nanoseconds, and the hex digest
+            (or None if not hashing).
+    """
+    stat_result = os.stat(file_path)
+    hex_digest = None
+    if hash_name is not None:
+        hasher = hashlib.new(hash_name)
+        with open(file_path, 'rb') as file_obj:
+            for curr_chunk in iter(lambda: file_obj.read(chunk_size), b""):
+                hasher.update(curr_chunk)
+        hex_digest = hasher.hexdigest()
+    return stat_result.st_size, stat_result.st_mtime_ns, hex_digest
+
+
 def expand_path(filepath):
     result = os.path.expanduser(filepath)
     result = os.path.expandvars(result)
@@ -0,0 +1,125 @@
+"""This module exposes an index for assigning reads to reference sequences while tolerating mismatches."""
+
+# standard libraries
+import collections
+import itertools
+import logging
+
+__author__ = "Amanda Birmingham"
+__maintainer__ = "Amanda Birmingham"
+__email__ = "abirmingham@ucsd.edu"
+__status__ = "prototype"
+
+_AMBIGUOUS_INDEX = -1
+
+
+class MismatchIndex:
+    """Hash map from every sequence within max_mismatches of a reference sequence to that reference.
+
+    All variants are precomputed, so assigning a read is a single dictionary lookup.  A variant that is equally
+    close to more than one reference is recorded as ambiguous and never assigned; a variant closer to one
+    reference than to any other is assigned to the closest one.  Reads must already be trimmed to the length of
+    the references (see bio_seq_utilities.trim_seq).
+    """
+
+    def __init__(self, reference_seqs_by_name, max_mismatches=1, position_alphabet="ACGTN"):
+        """Build the index.
+
+        Args:
+            reference_seqs_by_name (dict or list): Mapping from reference name (e.g. guide id) to sequence, or a
+                list of sequences to be used as their own names.  Sequences are upper-cased.
+            max_mismatches (Optional[int]): Maximum Hamming distance from a reference.  Default is 1.
+            position_alphabet (Optional[str]): Characters that may be substituted at each position.  Default is
+                "ACGTN", so a read with an N counts as having a mismatch.
+
+        Raises:
+            ValueError: If two different reference names have the same sequence.
+        """
+        if not isinstance(reference_seqs_by_name, dict):
+            reference_seqs_by_name = collections.OrderedDict((x, x) for x in reference_seqs_by_name)
+
+        self.max_mismatches = max_mismatches
+        self.reference_names = list(reference_seqs_by_name.keys())
+        self.reference_seqs = [x.upper() for x in reference_seqs_by_name.values()]
+        self._index_and_distance_by_seq = {}
+        self.num_ambiguous_variants = 0
+
+        for curr_index, curr_seq in enumerate(self.reference_seqs):
+            existing_index, _ = self._index_and_distance_by_seq.get(curr_seq, (None, None))
+            if existing_index is not None:
+                raise ValueError("References '{0}' and '{1}' have the same sequence '{2}'.".format(
+                    self.reference_names[existing_index], self.reference_names[curr_index], curr_seq))
+            self._index_and_distance_by_seq[curr_seq] = (curr_index, 0)
+
+        # add variants one distance at a time, so anything already present is at least as close
+        for curr_distance in range(1, max_mismatches + 1):
+            for curr_index, curr_seq in enumerate(self.reference_seqs):
+                for curr_variant in generate_mismatched_seqs(curr_seq, curr_distance, position_alphabet):
+                    self._add_variant(curr_variant, curr_index, curr_distance)
+
+        logging.info("Indexed {0} variants of {1} reference sequences; {2} are ambiguous".format(
+            len(self._index_and_distance_by_seq), len(self.reference_seqs), self.num_ambiguous_variants))
+
+    def __len__(self):
+        return len(self._index_and_distance_by_seq)
+
+    def _add_variant(self, variant_seq, reference_index, distance):
+        existing_index, existing_distance = self._index_and_distance_by_seq.get(variant_seq, (None, None))
+        if existing_index is None:
+            self._index_and_distance_by_seq[variant_seq] = (reference_index, distance)
+        elif existing_distance == distance and existing_index not in (reference_index, _AMBIGUOUS_INDEX):
+            self._index_and_distance_by_seq[variant_seq] = (_AMBIGUOUS_INDEX, distance)
+            self.num_ambiguous_variants += 1
+
+    def lookup(self, read_seq):
+        """Return (reference name, number of mismatches) for the read, or None if it has no unambiguous match."""
+        index_and_distance = self._index_and_distance_by_seq.get(read_seq)
+        if index_and_distance is None or index_and_distance[0] == _AMBIGUOUS_INDEX:
+            return None
+        return self.reference_names[index_and_distance[0]], index_and_distance[1]
+
+    def is_ambiguous(self, read_seq):
+        index_and_distance = self._index_and_distance_by_seq.get(read_seq)
+        return index_and_distance is not None and index_and_distance[0] == _AMBIGUOUS_INDEX
+
+    def count_matches(self, read_seqs):
+        """Count how many of the input reads are assigned to each reference.
+
+        Args:
+            read_seqs (iterable): Read sequences as str or bytes (e.g. numpy "S" array values), already
+                upper-cased and trimmed to the reference length.
+
+        Returns:
+            tuple(collections.Counter, int, int): Counts by reference name, the number of ambiguous reads, and
+                the number of reads matching nothing.
+        """
+        counts_by_index = collections.Counter()
+        num_unmatched = 0
+        get_index_and_distance = self._index_and_distance_by_seq.get
+        for curr_seq in read_seqs:
+            if isinstance(curr_seq, bytes):
+                curr_seq = curr_seq.decode("ascii")
+            index_and_distance = get_index_and_distance(curr_seq)
+            if index_and_distance is None:
+                num_unmatched += 1
+            else:
+                counts_by_index[index_and_distance[0]] += 1
+
+        num_ambiguous = counts_by_index.pop(_AMBIGUOUS_INDEX, 0)
+        counts_by_name = collections.Counter({self.reference_names[x]: y for x, y in counts_by_index.items()})
+        return counts_by_name, num_ambiguous, num_unmatched
+
+
+def generate_mismatched_seqs(perfect_seq, num_mismatches, position_alphabet):
+    """Yield every sequence differing from perfect_seq at exactly num_mismatches positions.
+
+    Each variant is yielded once; substitutions are drawn from position_alphabet.
+    """
+    perfect_seq_chars = list(perfect_seq)
+    for curr_positions in itertools.combinations(range(len(perfect_seq_chars)), num_mismatches):
+        alternative_chars = [[x for x in position_alphabet if x != perfect_seq_chars[y]] for y in curr_positions]
+        for curr_substitutions in itertools.product(*alternative_chars):
+            mismatch_seq_chars = list(perfect_seq_chars)
+            for curr_position, curr_char in zip(curr_positions, curr_substitutions):
+                mismatch_seq_chars[curr_position] = curr_char
+            yield "".join(mismatch_seq_chars)
@@ -0,0 +1,161 @@
+"""This module exposes functions for holding DNA sequences as 2-bit codes packed into numpy uint64 words."""
+
+# standard libraries
+import collections
+
+# third-party libraries
+import numpy
+
+from ccbb_pyutils.basic_fastq import sequences_to_uint8_matrix
+
+__author__ = "Amanda Birmingham"
+__maintainer__ = "Amanda Birmingham"
+__email__ = "abirmingham@ucsd.edu"
+__status__ = "prototype"
+
+BASES_PER_WORD = 32
+
+# A, C, G, T are 0-3 so that a base's complement is (3 - code), i.e. code XOR 3.  Anything else (N, other
+# ambiguity codes) is stored as code 0 with both of its bits set in the n_mask.
+_CODE_BASES = b"ACGT"
+_NOT_A_BASE = 255
+_CODE_BY_BYTE = numpy.full(256, _NOT_A_BASE, dtype=numpy.uint8)
+for _curr_code, _curr_base in enumerate(_CODE_BASES):
+    _CODE_BY_BYTE[_curr_base] = _curr_code
+    _CODE_BY_BYTE[ord(chr(_curr_base).lower())] = _curr_code
+
+_LOW_BITS_MASK = numpy.uint64(0x5555555555555555)
+_BYTE_POPCOUNTS = numpy.array([bin(x).count("1") for x in range(256)], dtype=numpy.uint8)
+
+PackedDnaSeqs = collections.namedtuple("PackedDnaSeqs", ["words", "n_mask", "seq_len"])
+PackedDnaSeqs.__doc__ = """Equal-length DNA sequences packed 2 bits per base, first base in the most significant bits.
+
+words and n_mask are uint64 arrays of shape (num_seqs, ceil(seq_len / 32)); unused low bits of the last word
+are zero.  n_mask has 0b11 at the position of every base that is not A, C, G, or T.
+"""
+
+
+def pack_dna_seqs(dna_seqs):
+    """Pack equal-length DNA sequences into 2-bit codes.
+
+    Args:
+        dna_seqs (array-like): A numpy "S" array or list of str/bytes sequences, all of the same length.
+
+    Returns:
+        PackedDnaSeqs: The packed sequences.
+
+    Raises:
+        ValueError: If the sequences are not all the same length.
+    """
+    code_matrix = _get_code_matrix(dna_seqs)
+    is_not_base = code_matrix == _NOT_A_BASE
+    code_matrix[is_not_base] = 0
+    words = _pack_code_matrix(code_matrix)
+    n_mask = _pack_code_matrix(is_not_base.astype(numpy.uint8) * 3)
+    return PackedDnaSeqs(words, n_mask, code_matrix.shape[1])
+
+
+def unpack_dna_seqs(packed_seqs):
+    """Return the packed sequences as a numpy "S" array, with N at every masked position."""
+    code_matrix = _unpack_code_matrix(packed_seqs.words, packed_seqs.seq_len)
+    is_not_base = _unpack_code_matrix(packed_seqs.n_mask, packed_seqs.seq_len) != 0
+    base_matrix = numpy.frombuffer(_CODE_BASES, dtype=numpy.uint8)[code_matrix]
+    base_matrix[is_not_base] = ord("N")
+    return base_matrix.view("S{0}".format(packed_seqs.seq_len)).reshape(len(base_matrix))
+
+
+def rev_comp_packed(packed_seqs):
+    """Return the reverse complements of the packed sequences, still packed; masked positions stay masked."""
+    code_matrix = _unpack_code_matrix(packed_seqs.words, packed_seqs.seq_len)[:, ::-1] ^ 3
+    n_matrix = _unpack_code_matrix(packed_seqs.n_mask, packed_seqs.seq_len)[:, ::-1]
+    code_matrix[n_matrix != 0] = 0
+    return PackedDnaSeqs(_pack_code_matrix(code_matrix), _pack_code_matrix(n_matrix), packed_seqs.seq_len)
+
+
+def hamming_distances_packed(packed_seqs, other_packed_seqs):
+    """Count mismatched positions between packed sequences; masked (N) positions always count as mismatches.
+
+    The two inputs must have the same seq_len; their rows are compared with numpy broadcasting, so a single
+    packed sequence (one row) can be compared against many.
+
+    Returns:
+        numpy.ndarray: Mismatch counts, one per compared pair of rows.
+    """
+    if packed_seqs.seq_len != other_packed_seqs.seq_len:
+        raise ValueError("Cannot compare sequences of length {0} and {1}.".format(packed_seqs.seq_len,
+                                                                               other_packed_seqs.seq_len))
+
+    diff_words = (packed_seqs.words ^ other_packed_seqs.words) | packed_seqs.n_mask | other_packed_seqs.n_mask
+    # collapse each 2-bit base to a single bit that is set if either bit differed
+    diff_words = (diff_words | (diff_words >> numpy.uint64(1))) & _LOW_BITS_MASK
+    return _popcount(diff_words).sum(axis=-1)
+
+
+def extract_kmers(dna_seqs, k):
+    """Return every k-mer of the input sequences packed into one uint64 each (k <= 32).
+
+    Args:
+        dna_seqs (array-like): A numpy "S" array or list of str/bytes sequences, all of the same length.
+        k (int): The k-mer length.
+
+    Returns:
+        tuple(numpy.ndarray, numpy.ndarray): uint64 k-mer codes of shape (num_seqs, seq_len - k + 1), and a
+            boolean array of the same shape that is False for k-mers containing a base other than A, C, G, or T.
+    """
+    if not 0 < k <= BASES_PER_WORD:
+        raise ValueError("k must be between 1 and {0}, not {1}.".format(BASES_PER_WORD, k))
+
+    code_matrix = _get_code_matrix(dna_seqs)
+    num_kmers = code_matrix.shape[1] - k + 1
+    if num_kmers < 1:
+        raise ValueError("Sequences of length {0} are shorter than k={1}.".format(code_matrix.shape[1], k))
+
+    is_not_base = code_matrix == _NOT_A_BASE
+    code_matrix[is_not_base] = 0
+    kmers = numpy.zeros((code_matrix.shape[0], num_kmers), dtype=numpy.uint64)
+    num_bad_bases = numpy.zeros(kmers.shape, dtype=numpy.int32)
+    for curr_offset in range(k):
+        kmers = (kmers << numpy.uint64(2)) | code_matrix[:, curr_offset:curr_offset + num_kmers]
+        num_bad_bases += is_not_base[:, curr_offset:curr_offset + num_kmers]
+    return kmers, num_bad_bases == 0
+
+
+def hash_kmers(kmers):
+    """Mix packed k-mer codes into well-distributed uint64 hashes (the splitmix64 finalizer)."""
+    hashes = numpy.asarray(kmers, dtype=numpy.uint64).copy()
+    hashes ^= hashes >> numpy.uint64(30)
+    hashes *= numpy.uint64(0xbf58476d1ce4e5b9)
+    hashes ^= hashes >> numpy.uint64(27)
+    hashes *= numpy.uint64(0x94d049bb133111eb)
+    hashes ^= hashes >> numpy.uint64(31)
+    return hashes
+
+
+def _get_code_matrix(dna_seqs):
+    dna_seqs = numpy.ascontiguousarray(numpy.asarray(dna_seqs, dtype=bytes))
+    base_matrix = sequences_to_uint8_matrix(dna_seqs)
+    if numpy.any(base_matrix == 0):
+        raise ValueError("All sequences must have the same length.")
+    return _CODE_BY_BYTE[base_matrix]
+
+
+def _pack_code_matrix(code_matrix):
+    num_seqs, seq_len = code_matrix.shape
+    num_words = -(-seq_len // BASES_PER_WORD)
+    padded_codes = numpy.zeros((num_seqs, num_words * BASES_PER_WORD), dtype=numpy.uint64)
+    padded_codes[:, :seq_len] = code_matrix
+    shifts = numpy.arange(2 * (BASES_PER_WORD - 1), -1, -2, dtype=numpy.uint64)
+    return numpy.bitwise_or.reduce(padded_codes.reshape(num_seqs, num_words, BASES_PER_WORD) << shifts, axis=2)
+
+
+def _unpack_code_matrix(words, seq_len):
+    shifts = numpy.arange(2 * (BASES_PER_WORD - 1), -1, -2, dtype=numpy.uint64)
+    codes = (words[:, :, numpy.newaxis] >> shifts) & numpy.uint64(3)
+    return codes.reshape(words.shape[0], -1)[:, :seq_len].astype(numpy.uint8)
+
+
+def _popcount(words):
+    if hasattr(numpy, "bitwise_count"):  # numpy >= 2.0
+        return numpy.bitwise_count(words)
+    byte_counts = _BYTE_POPCOUNTS[numpy.ascontiguousarray(words).view(numpy.uint8)]
+    return byte_counts.reshape(words.shape + (8,)).sum(axis=-1)
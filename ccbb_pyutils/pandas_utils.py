@@ -1,5 +1,9 @@
 """This module exposes utility functions and classes for working with pandas objects."""
 
+# standard libraries
+import os
+import re
+
 # third-party libraries
 import pandas
 
@@ -20,6 +24,26 @@ def add_series_to_dataframe(dataframe, series, header):
     dataframe.loc[:, header] = pandas.Series(series, index=dataframe.index)
 
 
+def group_files_as_series(filepaths, regex, replacement=""):
+    """Group file paths as files_and_paths.group_files does, using pandas string operations for large inventories.
+
+    Args:
+        filepaths (list(str) or pandas.Series): The file paths to group; not modified.
+        regex (str or re.Pattern): The pattern to replace in each file base name (without extension).
+        replacement (Optional[str]): What to replace the first match with.  Default is "".
+
+    Returns:
+        pandas.Series: Lists of file paths, in sorted order, indexed by (sorted) condensed base name.
+    """
+    filepaths = pandas.Series(filepaths, dtype=object).sort_values(ignore_index=True)
+    # os.path.splitext's rules for what counts as an extension are fiddly to match with a regex
+    file_bases = pandas.Series([os.path.splitext(os.path.basename(x))[0] for x in filepaths], dtype=object)
+    condensed_bases = file_bases.str.replace(re.compile(regex), replacement, n=1, regex=True)
+    result = filepaths.groupby(condensed_bases.values, sort=True).agg(list)
+    result.index.name = None
+    return result
+
+
 def merge_files_by_shared_header(file_fps, merge_col_header):
     is_first = True
     combined_df = None
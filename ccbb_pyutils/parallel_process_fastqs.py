@@ -1,13 +1,28 @@
 # standard libraries
+import base64
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import hashlib
+import json
 import logging
 import multiprocessing
+import os
+import pickle
+import resource
+import threading
 import timeit
 import traceback
 
+# third-party libraries
+import pandas
+
+from ccbb_pyutils.basic_fastq import fastq_text_to_records, paired_fastq_text_chunk_generator, \
+    records_to_read_pairs
 from ccbb_pyutils.bio_seq_utilities import pair_hiseq_read_files
 
-from ccbb_pyutils.files_and_paths import get_basename_fps_tuples, get_file_name_pieces, \
+from ccbb_pyutils.files_and_paths import get_basename_fps_tuples, get_file_fingerprint, get_file_name_pieces, \
     get_filepaths_from_wildcard
 
 __author__ = 'Amanda Birmingham'
@@ -15,31 +30,161 @@ __maintainer__ = "Amanda Birmingham"
 __email__ = "abirmingham@ucsd.edu"
 __status__ = "prototype"
 
+TaskFailure = collections.namedtuple("TaskFailure", ["process_name", "exception", "traceback"])
+TaskResources = collections.namedtuple("TaskResources", ["num_threads", "memory_gb"])
+TaskResources.__doc__ = """Threads and memory that one task (or, as a budget, the whole node) needs or provides."""
+TaskMetrics = collections.namedtuple("TaskMetrics", ["process_name", "wall_seconds", "user_seconds",
+                                                     "system_seconds", "child_user_seconds", "child_system_seconds",
+                                                     "max_rss_kb", "child_max_rss_kb", "bytes_read",
+                                                     "bytes_written"])
+TaskMetrics.__doc__ = """Resource use of one task, as measured by measure_function.
+
+CPU times and byte counts cover only the task.  max_rss_kb and child_max_rss_kb are high-water marks (see
+resource.getrusage) for the worker process and for its largest waited-for subprocess *so far*, so they can
+reflect an earlier, bigger task run by the same worker.  bytes_read and bytes_written count the worker's own
+read/write calls (rchar/wchar in /proc/self/io), not those of subprocesses, and are None where that file doesn't
+exist.
+
+A task run in a thread other than the main one (e.g. by a ThreadPoolExecutor) shares its process with whatever
+else is running, so its CPU times and byte counts come from per-thread counters (resource.RUSAGE_THREAD and
+/proc/thread-self/io) and are None where those don't exist; its child_* fields are always None, since a
+subprocess can't be attributed to one thread, and max_rss_kb is the whole process's.
+"""
+ParallelProgress = collections.namedtuple("ParallelProgress", ["num_done", "num_failed", "num_running",
+                                                               "num_queued", "elapsed_seconds", "bytes_done",
+                                                               "bytes_total"])
+
 
 def get_elapsed_time_to_now(start_time, process_name=None):
     end_time = timeit.default_timer()
     elapsed_seconds = end_time - start_time
-    m, s = divmod(elapsed_seconds, 60)
-    h, m = divmod(m, 60)
-    result = "elapsed time: %d:%02d:%02d" % (h, m, s)
+    result = "elapsed time: " + format_seconds(elapsed_seconds)
     if process_name is not None:
         result = "{0} ".format(process_name) + result
     return result
 
 
-def time_function(process_name, func_name, pass_process_name_to_func, *func_args):
+def format_seconds(num_seconds):
+    m, s = divmod(num_seconds, 60)
+    h, m = divmod(m, 60)
+    return "%d:%02d:%02d" % (h, m, s)
+
+
+def format_progress(progress):
+    """Summarize a ParallelProgress as text, e.g. "3/10 done (1 failed), 4 running, 3 queued; 5.2 MB/s; ETA 0:10:00"."""
+    num_total = progress.num_done + progress.num_running + progress.num_queued
+    result = "{0}/{1} done ({2} failed), {3} running, {4} queued".format(
+        progress.num_done, num_total, progress.num_failed, progress.num_running, progress.num_queued)
+
+    if progress.elapsed_seconds > 0 and progress.bytes_done > 0:
+        bytes_per_second = progress.bytes_done / progress.elapsed_seconds
+        eta_seconds = (progress.bytes_total - progress.bytes_done) / bytes_per_second
+        result += "; {0:.1f} MB/s; ETA {1}".format(bytes_per_second / (1024 * 1024), format_seconds(eta_seconds))
+    elif progress.elapsed_seconds > 0 and progress.num_done > 0:
+        # no input sizes to go on, so estimate from the task completion rate instead
+        eta_seconds = (num_total - progress.num_done) * progress.elapsed_seconds / progress.num_done
+        result += "; ETA {0}".format(format_seconds(eta_seconds))
+    return result
+
+
+def log_progress(progress):
+    logging.info(format_progress(progress))
+
+
+def get_node_resources():
+    """Return the threads and memory of this machine as TaskResources, for use as a resource budget."""
+    num_threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    memory_bytes = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return TaskResources(num_threads, memory_bytes / (1024 ** 3))
+
+
+class TaskLedger:
+    """Append-only JSON-lines record of successfully completed tasks, so that a rerun can skip them.
+
+    Each line holds a task key (see get_task_key), the process name, the completion time, and the pickled,
+    base64-encoded result.  Lines are flushed to disk as each task finishes; a truncated last line, as left by a
+    run that was killed mid-write, is ignored.
+    """
+
+    def __init__(self, ledger_fp):
+        self.ledger_fp = ledger_fp
+        self._results_by_key = {}
+
+        if os.path.exists(ledger_fp):
+            with open(ledger_fp, 'r') as ledger_f:
+                for curr_line in ledger_f:
+                    try:
+                        curr_entry = json.loads(curr_line)
+                        curr_result = pickle.loads(base64.b64decode(curr_entry["result"]))
+                    except (ValueError, KeyError, pickle.UnpicklingError, EOFError):
+                        logging.info("Ignoring unreadable entry in task ledger {0}".format(ledger_fp))
+                        continue
+                    self._results_by_key[curr_entry["key"]] = curr_result
+
+    def __contains__(self, task_key):
+        return task_key in self._results_by_key
+
+    def __len__(self):
+        return len(self._results_by_key)
+
+    def get_result(self, task_key):
+        return self._results_by_key[task_key]
+
+    def record(self, task_key, process_name, result):
+        entry = {"key": task_key, "process_name": process_name, "completed": datetime.datetime.now().isoformat(),
+                 "result": base64.b64encode(pickle.dumps(result)).decode("ascii")}
+        with open(self.ledger_fp, 'a') as ledger_f:
+            ledger_f.write(json.dumps(entry) + "\n")
+            ledger_f.flush()
+            os.fsync(ledger_f.fileno())
+        self._results_by_key[task_key] = result
+
+
+def get_task_key(process_arguments, input_fps, hash_name=None, fixed_inputs_key=None):
+    """Identify a task by its process name, function, fixed inputs, and input file fingerprints.
+
+    Args:
+        process_arguments (tuple): The arguments to time_function: process name, function, whether to pass the
+            process name, then the function's inputs, ending with the input filepaths.
+        input_fps (list(str)): The input filepaths at the end of process_arguments.
+        hash_name (Optional[str]): Hash algorithm for the input fingerprints; see get_file_fingerprint.
+        fixed_inputs_key (Optional[str]): Used in place of the fixed inputs, for inputs that can't be written as
+            JSON.  The caller must change it whenever those inputs change.  Default is None (use the fixed inputs'
+            JSON).
+
+    Returns:
+        str: A hex digest that changes if any of the above does.
+
+    Raises:
+        ValueError: If fixed_inputs_key is None and the fixed inputs can't be written as JSON.
+    """
+    process_name, func_for_task, pass_process_name_to_func = process_arguments[0:3]
+    if fixed_inputs_key is None:
+        fixed_inputs = process_arguments[3:len(process_arguments) - len(input_fps)]
+        try:
+            fixed_inputs_key = json.dumps(fixed_inputs, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            raise ValueError("Can't key task {0} in a ledger: its fixed inputs can't be written as JSON ({1}); "
+                             "pass a ledger_fixed_inputs_key that identifies them instead.".format(process_name, e))
+
+    key_pieces = [process_name, func_for_task.__module__, func_for_task.__qualname__, pass_process_name_to_func,
+                  fixed_inputs_key, [list(get_file_fingerprint(x, hash_name)) for x in input_fps]]
+    return hashlib.sha256(json.dumps(key_pieces).encode("utf-8")).hexdigest()
+
+
+def time_function(process_name, func_name, pass_process_name_to_func, *func_args, **func_kwargs):
     logging.info("Starting {0} at {1}".format(process_name, datetime.datetime.now()))
     start_time = timeit.default_timer()
 
     if pass_process_name_to_func:
         try:
-            func_result = func_name(process_name, *func_args)
+            func_result = func_name(process_name, *func_args, **func_kwargs)
         except Exception as e:
             logging.info(traceback.format_exc())
             raise e
     else:
         try:
-            func_result = func_name(*func_args)
+            func_result = func_name(*func_args, **func_kwargs)
         except Exception as e:
             logging.info(traceback.format_exc())
             raise e
@@ -48,15 +193,155 @@ def time_function(process_name, func_name, pass_process_name_to_func, *func_args
     return process_name, func_result
 
 
+def measure_function(process_name, func_name, pass_process_name_to_func, *func_args, **func_kwargs):
+    """Run time_function with the same arguments and also measure the resources it used.
+
+    Returns:
+        tuple(TaskMetrics, tuple(str, object)): The metrics and the time_function result.
+    """
+    # process-wide counters would include every other task running in the same process at the same time
+    is_in_thread = threading.current_thread() is not threading.main_thread()
+    self_who = resource.RUSAGE_SELF
+    io_fp = "/proc/self/io"
+    if is_in_thread:
+        self_who = getattr(resource, "RUSAGE_THREAD", None)
+        io_fp = "/proc/thread-self/io"
+
+    self_usage = _get_rusage(self_who)
+    child_usage = None if is_in_thread else resource.getrusage(resource.RUSAGE_CHILDREN)
+    io_counts = _get_io_counts(io_fp)
+    start_time = timeit.default_timer()
+
+    result = time_function(process_name, func_name, pass_process_name_to_func, *func_args, **func_kwargs)
+
+    wall_seconds = timeit.default_timer() - start_time
+    new_self_usage = _get_rusage(self_who)
+    new_child_usage = None if is_in_thread else resource.getrusage(resource.RUSAGE_CHILDREN)
+    new_io_counts = _get_io_counts(io_fp)
+    bytes_read, bytes_written = None, None
+    if io_counts is not None and new_io_counts is not None:
+        bytes_read, bytes_written = [y - x for x, y in zip(io_counts, new_io_counts)]
+
+    user_seconds, system_seconds = None, None
+    if self_usage is not None:
+        user_seconds = new_self_usage.ru_utime - self_usage.ru_utime
+        system_seconds = new_self_usage.ru_stime - self_usage.ru_stime
+    child_user_seconds, child_system_seconds, child_max_rss_kb = None, None, None
+    if child_usage is not None:
+        child_user_seconds = new_child_usage.ru_utime - child_usage.ru_utime
+        child_system_seconds = new_child_usage.ru_stime - child_usage.ru_stime
+        child_max_rss_kb = new_child_usage.ru_maxrss
+
+    metrics = TaskMetrics(process_name, wall_seconds, user_seconds, system_seconds, child_user_seconds,
+                          child_system_seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                          child_max_rss_kb, bytes_read, bytes_written)
+    return metrics, result
+
+
+def _get_rusage(who):
+    return None if who is None else resource.getrusage(who)
+
+
+def _get_io_counts(io_fp="/proc/self/io"):
+    try:
+        with open(io_fp, 'r') as io_f:
+            counts_by_name = dict(x.split(":") for x in io_f.read().splitlines() if ":" in x)
+        return int(counts_by_name["rchar"]), int(counts_by_name["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def metrics_to_dataframe(task_metrics):
+    """Return a pandas.DataFrame with one row per TaskMetrics; None entries (tasks not measured) are skipped."""
+    return pandas.DataFrame([x for x in task_metrics if x is not None], columns=TaskMetrics._fields)
+
+
+def write_metrics_jsonl(task_metrics, output_fp):
+    """Append one JSON object per TaskMetrics to the output file; None entries are skipped."""
+    with open(output_fp, 'a') as output_f:
+        for curr_metrics in task_metrics:
+            if curr_metrics is not None:
+                output_f.write(json.dumps(curr_metrics._asdict()) + "\n")
+
+
 def parallel_process_files(file_dir, file_suffix, num_processes, func_for_one_file, func_fixed_inputs_list,
-                           pass_process_name_to_func=False):
+                           pass_process_name_to_func=False, progress_callback=None, ledger_fp=None,
+                           fingerprint_hash_name=None, task_resources=None, resource_budget=None,
+                           return_metrics=False, executor=None, ledger_fixed_inputs_key=None):
     logging.info("Starting parallel processing at {0}".format(datetime.datetime.now()))
     start_time = timeit.default_timer()
 
-    results = []
+    process_arguments, task_sizes, task_input_fps = _get_file_process_arguments(
+        file_dir, file_suffix, func_for_one_file, func_fixed_inputs_list, pass_process_name_to_func)
+    ledger, task_keys = _get_ledger_and_task_keys(ledger_fp, process_arguments, task_input_fps,
+                                                  fingerprint_hash_name, ledger_fixed_inputs_key)
+    resources_by_task = _get_resources_by_task(task_resources, process_arguments, task_input_fps)
+    results, task_metrics = _run_tasks_largest_first(process_arguments, task_sizes, num_processes,
+                                                     progress_callback, ledger, task_keys, resources_by_task,
+                                                     resource_budget, executor)
+
+    logging.info(get_elapsed_time_to_now(start_time, "parallel processing"))
+    return (results, task_metrics) if return_metrics else results
+
+
+def iter_parallel_process_files(file_dir, file_suffix, num_processes, func_for_one_file, func_fixed_inputs_list,
+                                pass_process_name_to_func=False, progress_callback=log_progress, ledger_fp=None,
+                                fingerprint_hash_name=None, task_resources=None, resource_budget=None,
+                                executor=None, ledger_fixed_inputs_key=None):
+    """Like parallel_process_files, but yield each (process_name, result) as soon as its task finishes.
+
+    A task that raises an exception does not stop the others: its result is a TaskFailure holding the exception
+    and its formatted traceback.
+
+    Args:
+        progress_callback (Optional[function]): Called with a ParallelProgress after every task finishes.  Default
+            is log_progress; pass None for no progress reports.
+        ledger_fp (Optional[str]): Path of a TaskLedger file.  Tasks it records as completed, for unchanged
+            inputs, are not rerun: their stored results are yielded first.  New successes are added to it.
+            Default is None (no ledger).  parallel_process_files takes the same argument.
+        fingerprint_hash_name (Optional[str]): Hash algorithm (e.g. "md5") used to fingerprint input files for
+            the ledger in addition to their size and modification time.  Default is None.
+        ledger_fixed_inputs_key (Optional[str]): Identifies func_fixed_inputs_list in the ledger's task keys, for
+            fixed inputs that can't be written as JSON; change it whenever they change.  Default is None (use
+            their JSON, raising a ValueError before any task runs if they can't be written as JSON).
+        task_resources (Optional[TaskResources or function]): The threads and memory each task needs, either the
+            same for all tasks or as a function called with (process_name, input_fps) that returns them.  When
+            given, a task is only started once its needs fit in what is left of resource_budget, and the function
+            being run is called with an extra num_threads keyword argument to pass on to its tool.  num_processes
+            still caps how many tasks run at once.  Default is None (no resource accounting).
+        resource_budget (Optional[TaskResources]): Total threads and memory available to the tasks.  Default is
+            get_node_resources().  A task that needs more than the whole budget is run by itself.
+        executor (Optional[concurrent.futures.Executor]): Where to run the tasks, e.g. a ThreadPoolExecutor for
+            functions that mostly wait on external tools, or a socket_executor.SocketExecutor to spread them
+            across machines sharing a filesystem.  It is not shut down afterwards.  num_processes should match
+            its number of workers.  Default is None, which runs the tasks in a new ProcessPoolExecutor.  With a
+            ThreadPoolExecutor, per-task metrics are per-thread and omit subprocesses; see TaskMetrics.
+
+    parallel_process_files also takes return_metrics (default False); if True, it returns (results, metrics),
+    where metrics holds a TaskMetrics for each result, or None for results taken from the ledger.
+
+    Yields:
+        tuple(str, object): The process name and the function result (or TaskFailure), in completion order.
+    """
+    process_arguments, task_sizes, task_input_fps = _get_file_process_arguments(
+        file_dir, file_suffix, func_for_one_file, func_fixed_inputs_list, pass_process_name_to_func)
+    ledger, task_keys = _get_ledger_and_task_keys(ledger_fp, process_arguments, task_input_fps,
+                                                  fingerprint_hash_name, ledger_fixed_inputs_key)
+    resources_by_task = _get_resources_by_task(task_resources, process_arguments, task_input_fps)
+    for _, _, curr_result in _iter_task_results(process_arguments, task_sizes, num_processes, progress_callback,
+                                                capture_failures=True, ledger=ledger, task_keys=task_keys,
+                                                resources_by_task=resources_by_task,
+                                                resource_budget=resource_budget, executor=executor):
+        yield curr_result
+
+
+def _get_file_process_arguments(file_dir, file_suffix, func_for_one_file, func_fixed_inputs_list,
+                                pass_process_name_to_func):
     relevant_filepaths = get_filepaths_from_wildcard(file_dir, file_suffix)
 
     process_arguments = []
+    task_sizes = []
+    task_input_fps = []
     for curr_fp in relevant_filepaths:
         fp_list = [curr_fp]
         _, curr_base, _ = get_file_name_pieces(curr_fp)
@@ -65,21 +350,179 @@ def parallel_process_files(file_dir, file_suffix, num_processes, func_for_one_fi
         curr_args_list.extend(func_fixed_inputs_list)
         curr_args_list.extend(fp_list)
         process_arguments.append(tuple(curr_args_list))
+        task_sizes.append(_get_total_file_size(fp_list))
+        task_input_fps.append(fp_list)
 
-    with multiprocessing.Pool(processes=num_processes) as pool:
-        results = pool.starmap(time_function, process_arguments)
+    return process_arguments, task_sizes, task_input_fps
+
+
+def _get_total_file_size(filepaths):
+    return sum([os.path.getsize(x) for x in filepaths])
+
+
+def _get_ledger_and_task_keys(ledger_fp, process_arguments, task_input_fps, hash_name, fixed_inputs_key):
+    if ledger_fp is None:
+        return None, None
+
+    task_keys = [get_task_key(x, y, hash_name, fixed_inputs_key) for x, y in zip(process_arguments, task_input_fps)]
+    ledger = TaskLedger(ledger_fp)
+    return ledger, task_keys
+
+
+def _get_resources_by_task(task_resources, process_arguments, task_input_fps):
+    if task_resources is None:
+        return None
+    if callable(task_resources):
+        return [task_resources(x[0], y) for x, y in zip(process_arguments, task_input_fps)]
+    return [task_resources] * len(process_arguments)
+
+
+def _run_tasks_largest_first(process_arguments, task_sizes, num_processes, progress_callback=None, ledger=None,
+                             task_keys=None, resources_by_task=None, resource_budget=None, executor=None):
+    results = [None] * len(process_arguments)
+    task_metrics = [None] * len(process_arguments)
+    for curr_index, curr_metrics, curr_result in _iter_task_results(
+            process_arguments, task_sizes, num_processes, progress_callback, ledger=ledger, task_keys=task_keys,
+            resources_by_task=resources_by_task, resource_budget=resource_budget, executor=executor):
+        task_metrics[curr_index] = curr_metrics
+        results[curr_index] = curr_result
+
+    _log_task_wall_times(task_metrics)
+    return results, task_metrics
+
+
+def _iter_task_results(process_arguments, task_sizes, num_processes, progress_callback=None,
+                       capture_failures=False, ledger=None, task_keys=None, resources_by_task=None,
+                       resource_budget=None, executor=None):
+    # Tasks are handed out biggest input first, and only one per worker is submitted at a time, so one huge sample
+    # can't end up queued behind a static chunk of small ones.  Yields (index into process_arguments,
+    # TaskMetrics, (process_name, result)) in completion order; tasks already in the ledger come first, with no
+    # metrics, and are not rerun.  With resources_by_task, the biggest pending task that fits in the unused part of
+    # the budget goes next, so small tasks can fill in around a big one.
+    task_indices = list(range(len(process_arguments)))
+    if ledger is not None:
+        task_indices = [x for x in task_indices if task_keys[x] not in ledger]
+        num_skipped = len(process_arguments) - len(task_indices)
+        logging.info("Skipping {0} task(s) already completed according to {1}".format(num_skipped,
+                                                                                     ledger.ledger_fp))
+        for curr_index in sorted(set(range(len(process_arguments))) - set(task_indices)):
+            yield curr_index, None, (process_arguments[curr_index][0], ledger.get_result(task_keys[curr_index]))
+
+    pending_indices = collections.deque(sorted(task_indices, key=lambda x: task_sizes[x], reverse=True))
+    bytes_total = sum([task_sizes[x] for x in task_indices])
+    index_by_future = {}
+    num_done = 0
+    num_failed = 0
+    bytes_done = 0
+    start_time = timeit.default_timer()
+    if resources_by_task is not None and resource_budget is None:
+        resource_budget = get_node_resources()
+    resources_in_use = TaskResources(0, 0)
+
+    if executor is None:
+        executor_context = concurrent.futures.ProcessPoolExecutor(max_workers=num_processes)
+    else:
+        # a caller-supplied executor may be reused, so leave shutting it down to the caller
+        executor_context = contextlib.nullcontext(executor)
+
+    with executor_context as executor:
+        try:
+            while len(pending_indices) > 0 or len(index_by_future) > 0:
+                while len(pending_indices) > 0 and len(index_by_future) < num_processes:
+                    if resources_by_task is None:
+                        curr_index = pending_indices.popleft()
+                        curr_future = executor.submit(measure_function, *process_arguments[curr_index])
+                    else:
+                        curr_index = _pop_admissible_task(pending_indices, resources_by_task, resources_in_use,
+                                                          resource_budget, len(index_by_future) == 0)
+                        if curr_index is None:
+                            break
+                        curr_resources = resources_by_task[curr_index]
+                        resources_in_use = _add_resources(resources_in_use, curr_resources)
+                        curr_future = executor.submit(measure_function, *process_arguments[curr_index],
+                                                      num_threads=curr_resources.num_threads)
+                    index_by_future[curr_future] = curr_index
+
+                done_futures, _ = concurrent.futures.wait(index_by_future,
+                                                          return_when=concurrent.futures.FIRST_COMPLETED)
+                for curr_future in done_futures:
+                    curr_index = index_by_future.pop(curr_future)
+                    if resources_by_task is not None:
+                        resources_in_use = _add_resources(resources_in_use, resources_by_task[curr_index], -1)
+                    num_done += 1
+                    bytes_done += task_sizes[curr_index]
+
+                    curr_exception = curr_future.exception()
+                    if curr_exception is None:
+                        curr_metrics, curr_result = curr_future.result()
+                        if ledger is not None:
+                            ledger.record(task_keys[curr_index], curr_result[0], curr_result[1])
+                    elif capture_failures:
+                        num_failed += 1
+                        process_name = process_arguments[curr_index][0]
+                        curr_traceback = "".join(traceback.format_exception(
+                            type(curr_exception), curr_exception, curr_exception.__traceback__))
+                        logging.info("{0} failed: {1}".format(process_name, curr_exception))
+                        curr_metrics = None
+                        curr_result = (process_name, TaskFailure(process_name, curr_exception, curr_traceback))
+                    else:
+                        raise curr_exception
+
+                    if progress_callback is not None:
+                        progress_callback(ParallelProgress(num_done, num_failed, len(index_by_future),
+                                                           len(pending_indices), timeit.default_timer() - start_time,
+                                                           bytes_done, bytes_total))
+                    yield curr_index, curr_metrics, curr_result
+        finally:
+            # this drops tasks not yet started; ones already running can't be stopped, so on an error the executor's
+            # shutdown waits for them to finish (the multiprocessing.Pool used before terminated them instead)
+            for curr_future in index_by_future:
+                curr_future.cancel()
+
+
+def _pop_admissible_task(pending_indices, resources_by_task, resources_in_use, resource_budget, nothing_running):
+    for curr_index in pending_indices:
+        if _fits_in_budget(_add_resources(resources_in_use, resources_by_task[curr_index]), resource_budget):
+            pending_indices.remove(curr_index)
+            return curr_index
+
+    if nothing_running:
+        # the biggest remaining task can never fit, so give it the whole node rather than waiting forever
+        curr_index = pending_indices.popleft()
+        logging.info("Task {0} needs {1}, more than the budget of {2}; running it alone".format(
+            curr_index, resources_by_task[curr_index], resource_budget))
+        return curr_index
+    return None
+
+
+def _add_resources(resources, other_resources, sign=1):
+    return TaskResources(resources.num_threads + sign * other_resources.num_threads,
+                         resources.memory_gb + sign * other_resources.memory_gb)
+
+
+def _fits_in_budget(resources, resource_budget):
+    return resources.num_threads <= resource_budget.num_threads and resources.memory_gb <= resource_budget.memory_gb
 
-    logging.info(get_elapsed_time_to_now(start_time, "parallel processing"))
-    return results
+
+def _log_task_wall_times(task_metrics):
+    # tasks with no metrics weren't run here (e.g. their results came from a ledger)
+    timed_tasks = [(x.wall_seconds, x.process_name) for x in task_metrics if x is not None]
+    if len(timed_tasks) == 0:
+        return
+
+    logging.info("Task wall times, longest first:")
+    for curr_seconds, curr_name in sorted(timed_tasks, reverse=True):
+        logging.info("{0}: {1}".format(curr_name, format_seconds(curr_seconds)))
 
 
 def serial_process_files(file_dir, file_suffix, func_for_one_file, func_fixed_inputs_list,
                          pass_process_name_to_func=False,
-                         prefix_asterisk=True, subdirs_are_basename=False):
+                         prefix_asterisk=True, subdirs_are_basename=False, return_metrics=False):
     logging.info("Starting serial processing at {0}".format(datetime.datetime.now()))
     start_time = timeit.default_timer()
 
     results = []
+    task_metrics = []
     relevant_basename_fp_tuples_list = get_basename_fps_tuples(file_dir, file_suffix,
                                                                prefix_asterisk=prefix_asterisk,
                                                                subdirs_are_basename=subdirs_are_basename)
@@ -94,39 +537,147 @@ def serial_process_files(file_dir, file_suffix, func_for_one_file, func_fixed_in
         curr_args_list.extend(func_fixed_inputs_list)
         curr_args_list.extend(fp_list)
         # process_arguments.append(tuple(curr_args_list))
-        curr_result = time_function(*curr_args_list)
+        curr_metrics, curr_result = measure_function(*curr_args_list)
         results.append(curr_result)
+        task_metrics.append(curr_metrics)
 
     logging.info(get_elapsed_time_to_now(start_time, "serial processing"))
-    return results
+    return (results, task_metrics) if return_metrics else results
 
 
 def parallel_process_paired_reads(fastq_dir, file_suffix, num_processes, func_for_one_pair, func_fixed_inputs_list,
-                                  pass_process_name_to_func=False):
+                                  pass_process_name_to_func=False, progress_callback=None, ledger_fp=None,
+                                  fingerprint_hash_name=None, task_resources=None, resource_budget=None,
+                                  return_metrics=False, executor=None, ledger_fixed_inputs_key=None):
     logging.info("Starting parallel processing at {0}".format(datetime.datetime.now()))
     start_time = timeit.default_timer()
 
     results = []
+    task_metrics = []
+    process_arguments, task_sizes, task_input_fps = _get_paired_reads_process_arguments(
+        fastq_dir, file_suffix, func_for_one_pair, func_fixed_inputs_list, pass_process_name_to_func)
+    if process_arguments is not None:
+        ledger, task_keys = _get_ledger_and_task_keys(ledger_fp, process_arguments, task_input_fps,
+                                                      fingerprint_hash_name, ledger_fixed_inputs_key)
+        resources_by_task = _get_resources_by_task(task_resources, process_arguments, task_input_fps)
+        results, task_metrics = _run_tasks_largest_first(process_arguments, task_sizes, num_processes,
+                                                         progress_callback, ledger, task_keys, resources_by_task,
+                                                         resource_budget, executor)
+
+    logging.info(get_elapsed_time_to_now(start_time, "parallel processing"))
+    return (results, task_metrics) if return_metrics else results
+
+
+def iter_parallel_process_paired_reads(fastq_dir, file_suffix, num_processes, func_for_one_pair,
+                                       func_fixed_inputs_list, pass_process_name_to_func=False,
+                                       progress_callback=log_progress, ledger_fp=None, fingerprint_hash_name=None,
+                                       task_resources=None, resource_budget=None, executor=None,
+                                       ledger_fixed_inputs_key=None):
+    """Like parallel_process_paired_reads, but yield results as tasks finish; see iter_parallel_process_files."""
+    process_arguments, task_sizes, task_input_fps = _get_paired_reads_process_arguments(
+        fastq_dir, file_suffix, func_for_one_pair, func_fixed_inputs_list, pass_process_name_to_func)
+    if process_arguments is not None:
+        ledger, task_keys = _get_ledger_and_task_keys(ledger_fp, process_arguments, task_input_fps,
+                                                      fingerprint_hash_name, ledger_fixed_inputs_key)
+        resources_by_task = _get_resources_by_task(task_resources, process_arguments, task_input_fps)
+        for _, _, curr_result in _iter_task_results(process_arguments, task_sizes, num_processes,
+                                                    progress_callback, capture_failures=True, ledger=ledger,
+                                                    task_keys=task_keys, resources_by_task=resources_by_task,
+                                                    resource_budget=resource_budget, executor=executor):
+            yield curr_result
+
+
+def _get_paired_reads_process_arguments(fastq_dir, file_suffix, func_for_one_pair, func_fixed_inputs_list,
+                                        pass_process_name_to_func):
     fastq_filepaths = get_filepaths_from_wildcard(fastq_dir, file_suffix)
     paired_fastqs_by_base, failure_msgs = pair_hiseq_read_files(fastq_filepaths)
 
     if failure_msgs is not None:
         logging.info(failure_msgs)
+        return None, None, None
+
+    process_arguments = []
+    task_sizes = []
+    task_input_fps = []
+    sorted_bases = sorted(paired_fastqs_by_base.keys())
+    for curr_base in sorted_bases:
+        fp_list = paired_fastqs_by_base[curr_base]
+        curr_args_list = [curr_base, func_for_one_pair, pass_process_name_to_func]
+        curr_args_list.extend(func_fixed_inputs_list)
+        curr_args_list.extend(fp_list)
+        process_arguments.append(tuple(curr_args_list))
+        task_sizes.append(_get_total_file_size(fp_list))
+        task_input_fps.append(fp_list)
+
+    return process_arguments, task_sizes, task_input_fps
+
+
+def sharded_process_paired_reads(fw_fastq_fp, rv_fastq_fp, num_processes, func_for_one_chunk,
+                                 func_fixed_inputs_list, chunk_size=100000, merge_func=None, get_full_record=False):
+    """Split a single pair of fastqs into chunks of read pairs and process the chunks in parallel.
+
+    func_for_one_chunk is called as func_for_one_chunk(*func_fixed_inputs_list, read_pairs), where read_pairs is
+    a list of the items paired_fastq_generator would yield for that chunk.  The main process only reads (and
+    decompresses) the inputs and finds where each chunk's last record ends; the workers get the raw text and do
+    all the line splitting and record building.  Only a bounded number of chunks is in flight at any time.
+
+    Args:
+        fw_fastq_fp (str): Path to the forward-read fastq (may be compressed).
+        rv_fastq_fp (str): Path to the reverse-read fastq (may be compressed).
+        num_processes (int): Number of worker processes.
+        func_for_one_chunk (function): Picklable function to run on each chunk.
+        func_fixed_inputs_list (list): Arguments passed to func_for_one_chunk before the chunk.
+        chunk_size (Optional[int]): Read pairs per chunk.  Default is 100000.
+        merge_func (Optional[function]): Two-argument function used to fold the chunk results together in
+            input order, e.g. operator.add for collections.Counter results.  Default is None, which returns the
+            list of chunk results in input order.
+        get_full_record (Optional[bool]): True to pass pairs of BasicFastq objects instead of pairs of
+            upper-cased sequences.  Default is False.
+
+    Returns:
+        The merged result if merge_func is given; otherwise a list with one result per chunk.
+    """
+    logging.info("Starting sharded processing of {0} and {1} at {2}".format(fw_fastq_fp, rv_fastq_fp,
+                                                                           datetime.datetime.now()))
+    start_time = timeit.default_timer()
+
+    chunk_results = []
+    num_chunks = 0
+    max_chunks_in_flight = 2 * num_processes
+
+    with multiprocessing.Pool(processes=num_processes) as pool:
+        # apply_async with a bounded window, rather than imap, so the reader doesn't run ahead of the workers and
+        # pull the whole file into memory
+        in_flight = collections.deque()
+        for fw_text, rv_text in paired_fastq_text_chunk_generator(fw_fastq_fp, rv_fastq_fp, chunk_size):
+            in_flight.append(pool.apply_async(
+                _process_read_pairs_chunk,
+                (func_for_one_chunk, func_fixed_inputs_list, get_full_record, fw_text, rv_text)))
+            num_chunks += 1
+            if len(in_flight) >= max_chunks_in_flight:
+                _add_chunk_result(chunk_results, in_flight.popleft().get(), merge_func)
+
+        while len(in_flight) > 0:
+            _add_chunk_result(chunk_results, in_flight.popleft().get(), merge_func)
+
+    logging.info("{0} chunks processed".format(num_chunks))
+    logging.info(get_elapsed_time_to_now(start_time, "sharded processing"))
+    if merge_func is None:
+        return chunk_results
+    return chunk_results[0] if len(chunk_results) > 0 else None
+
+
+def _add_chunk_result(chunk_results, new_result, merge_func):
+    if merge_func is not None and len(chunk_results) > 0:
+        chunk_results[0] = merge_func(chunk_results[0], new_result)
     else:
-        process_arguments = []
-        sorted_bases = sorted(paired_fastqs_by_base.keys())
-        for curr_base in sorted_bases:
-            fp_list = paired_fastqs_by_base[curr_base]
-            curr_args_list = [curr_base, func_for_one_pair, pass_process_name_to_func]
-            curr_args_list.extend(func_fixed_inputs_list)
-            curr_args_list.extend(fp_list)
-            process_arguments.append(tuple(curr_args_list))
-
-        with multiprocessing.Pool(processes=num_processes) as pool:
-            results = pool.starmap(time_function, process_arguments)
+        chunk_results.append(new_result)
 
-    logging.info(get_elapsed_time_to_now(start_time, "parallel processing"))
-    return results
+
+def _process_read_pairs_chunk(func_for_one_chunk, func_fixed_inputs_list, get_full_record, fw_text, rv_text):
+    read_pairs = records_to_read_pairs(fastq_text_to_records(fw_text), fastq_text_to_records(rv_text),
+                                       get_full_record)
+    return func_for_one_chunk(*func_fixed_inputs_list, read_pairs)
 
 
 def concatenate_parallel_results(results_tuples):
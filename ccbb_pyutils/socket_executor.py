@@ -0,0 +1,214 @@
+"""This module exposes a concurrent.futures executor whose workers are separate processes connected over TCP.
+
+Workers can run on any machine that can reach the executor's address and that has ccbb_pyutils (and whatever
+module holds the submitted functions) installed; inputs and outputs are expected to live on a shared filesystem.
+Functions and their arguments are pickled, so connections are authenticated with a shared key
+(multiprocessing.connection's HMAC challenge); only give the key to machines you trust.
+
+To run a worker on another node, create the executor with authkey=<key>.encode("utf-8") and then run:
+
+    CCBB_SOCKET_EXECUTOR_AUTHKEY=<key> python -m ccbb_pyutils.socket_executor <executor host> <executor port>
+"""
+
+# standard libraries
+import concurrent.futures
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import socket
+import sys
+import threading
+import traceback
+
+__author__ = "Amanda Birmingham"
+__maintainer__ = "Amanda Birmingham"
+__email__ = "abirmingham@ucsd.edu"
+__status__ = "prototype"
+
+AUTHKEY_ENV_VAR = "CCBB_SOCKET_EXECUTOR_AUTHKEY"
+
+_TASK_SUCCEEDED = "succeeded"
+_TASK_FAILED = "failed"
+_POLL_SECONDS = 0.1
+
+
+class RemoteTaskError(Exception):
+    """Raised in place of a worker-side exception that could not be sent back; holds the formatted traceback."""
+    pass
+
+
+class SocketExecutor(concurrent.futures.Executor):
+    """Executor that hands each submitted call to the next idle connected worker.
+
+    Each worker runs one task at a time, so the number of connected workers sets the parallelism; tasks
+    submitted before any worker connects simply wait.  If a worker disconnects mid-task, that task's future gets
+    a ConnectionError.
+    """
+
+    def __init__(self, address=("localhost", 0), authkey=None):
+        """Start listening for workers.
+
+        Args:
+            address (Optional[tuple(str, int)]): Host and port to listen on.  Default listens on localhost at a
+                free port; use ("", port) to accept workers from other machines.  The bound address is available
+                as the address attribute.
+            authkey (Optional[bytes]): Key workers must present.  Default is a random key, available as the
+                authkey attribute.
+        """
+        self.authkey = os.urandom(32) if authkey is None else authkey
+        self._listener = multiprocessing.connection.Listener(address, family="AF_INET", authkey=self.authkey)
+        self.address = self._listener.address
+        self._tasks = queue.Queue()
+        self._is_shutdown = False
+        self._shutdown_lock = threading.Lock()
+        self._worker_threads = []
+        self._accept_thread = threading.Thread(target=self._accept_workers, daemon=True)
+        self._accept_thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._shutdown_lock:
+            if self._is_shutdown:
+                raise RuntimeError("Cannot submit new tasks after shutdown.")
+            future = concurrent.futures.Future()
+            self._tasks.put((future, fn, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._shutdown_lock:
+            if self._is_shutdown:
+                return
+            self._is_shutdown = True
+
+        if cancel_futures:
+            self._cancel_queued_tasks()
+
+        # the accept thread is blocked in accept(), so wake it with a bare connection of our own; that fails the
+        # authentication handshake, which is fine, since the thread only needs to notice the shutdown
+        try:
+            socket.create_connection(self.address, timeout=_POLL_SECONDS).close()
+        except OSError:
+            pass
+
+        if wait:
+            self._accept_thread.join()
+            for curr_thread in list(self._worker_threads):
+                curr_thread.join()
+            # anything left never had a worker to run it
+            self._cancel_queued_tasks()
+        self._listener.close()
+
+    def _cancel_queued_tasks(self):
+        while True:
+            try:
+                future, _, _, _ = self._tasks.get_nowait()
+            except queue.Empty:
+                return
+            future.cancel()
+
+    def _accept_workers(self):
+        while True:
+            try:
+                connection = self._listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+                if self._is_shutdown:
+                    return
+                logging.info("Rejected socket executor worker connection: {0}".format(e))
+                continue
+
+            if self._is_shutdown:
+                connection.close()
+                return
+
+            worker_thread = threading.Thread(target=self._feed_worker, args=(connection,), daemon=True)
+            self._worker_threads.append(worker_thread)
+            worker_thread.start()
+
+    def _feed_worker(self, connection):
+        with connection:
+            while True:
+                try:
+                    future, fn, args, kwargs = self._tasks.get(timeout=_POLL_SECONDS)
+                except queue.Empty:
+                    if self._is_shutdown:
+                        _send_quietly(connection, None)
+                        return
+                    continue
+
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                try:
+                    connection.send((fn, args, kwargs))
+                    status, payload = connection.recv()
+                except (EOFError, OSError) as e:
+                    future.set_exception(ConnectionError("Socket executor worker disconnected: {0}".format(e)))
+                    return
+                except Exception as e:
+                    # e.g. the task couldn't be pickled; the worker is still fine
+                    future.set_exception(e)
+                    continue
+
+                if status == _TASK_SUCCEEDED:
+                    future.set_result(payload)
+                else:
+                    future.set_exception(payload)
+
+
+def run_socket_worker(address, authkey):
+    """Connect to a SocketExecutor and run the tasks it sends until it shuts down.
+
+    Args:
+        address (tuple(str, int)): The executor's host and port.
+        authkey (bytes): The executor's authkey.
+    """
+    with multiprocessing.connection.Client(tuple(address), family="AF_INET", authkey=authkey) as connection:
+        while True:
+            try:
+                task = connection.recv()
+            except EOFError:
+                return
+            if task is None:
+                return
+
+            fn, args, kwargs = task
+            try:
+                response = (_TASK_SUCCEEDED, fn(*args, **kwargs))
+            except Exception as e:
+                e.remote_traceback = traceback.format_exc()
+                response = (_TASK_FAILED, e)
+
+            try:
+                connection.send(response)
+            except Exception:
+                # the result or exception couldn't be pickled; send back something that can be
+                connection.send((_TASK_FAILED, RemoteTaskError(traceback.format_exc())))
+
+
+def start_local_workers(socket_executor, num_workers):
+    """Start worker processes on this machine for the input SocketExecutor.
+
+    Returns:
+        list(multiprocessing.Process): The started worker processes; they exit when the executor shuts down.
+    """
+    # spawn rather than fork, so workers don't inherit (and keep open) the executor's listening socket
+    spawn_context = multiprocessing.get_context("spawn")
+    result = []
+    for _ in range(num_workers):
+        curr_process = spawn_context.Process(target=run_socket_worker,
+                                             args=(socket_executor.address, socket_executor.authkey), daemon=True)
+        curr_process.start()
+        result.append(curr_process)
+    return result
+
+
+def _send_quietly(connection, message):
+    try:
+        connection.send(message)
+    except OSError:
+        pass
+
+
+if __name__ == "__main__":
+    run_socket_worker((sys.argv[1], int(sys.argv[2])), os.environ[AUTHKEY_ENV_VAR].encode("utf-8"))
@@ -1,9 +1,37 @@
 # standard libraries
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import shutil
 import subprocess
+import threading
 
 # standard libraries
 import logging
 
+from ccbb_pyutils.files_and_paths import get_file_fingerprint
+
+_FAILURE_TAIL_NUM_LINES = 20
+_NOT_STARTED_RETURN_CODE = 127  # what a shell reports for a command it can't find
+# longest stdout/stderr line the async runner will read before giving up on the command
+_MAX_LINE_BYTES = 16 * 1024 * 1024
+
+
+class SubprocessesFailedError(subprocess.SubprocessError):
+    """Raised when one or more concurrently run commands exit with a non-zero code.
+
+    Attributes:
+        failures (list(subprocess.CalledProcessError)): One per failed command, in input order; the stderr of each
+            holds the last lines the command wrote to stderr.
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        failure_msgs = ["'{0}' exited with code {1}".format(" ".join(x.cmd), x.returncode) for x in failures]
+        super().__init__("{0} command(s) failed: {1}".format(len(failures), "; ".join(failure_msgs)))
+
 
 def strip_and_append_non_empty(an_input, output_list):
     if isinstance(an_input, bytes):
@@ -30,7 +58,21 @@ def summarize_subprocess(err, output, results=None, curr_key=None,
     logging.info("----------------")
 
 
-def call_subprocess(call_args, stdout_fp=None):
+def call_subprocess(call_args, stdout_fp=None, log_fp=None, num_summary_lines=_FAILURE_TAIL_NUM_LINES):
+    """Run an external command, logging each line of its output as it arrives.
+
+    Only the last num_summary_lines lines of output are held in memory; if the command fails, they are logged
+    again as a summary once it exits.
+
+    Args:
+        call_args (list): The command and its arguments; each is converted to a string.
+        stdout_fp (Optional[str]): Path of a file to write the command's stdout to, instead of logging it.
+        log_fp (Optional[str]): Path of a file to also write all logged output lines to.  Default is None.
+        num_summary_lines (Optional[int]): Number of trailing output lines to keep for the summary.
+
+    Returns:
+        int: The command's exit code.
+    """
     str_call_args = [str(x) for x in call_args]
     str_output_location = "" if stdout_fp is None else " to {0}".format(stdout_fp)
     logging_msg = "Running {0}{1}".format(" ".join(str_call_args), str_output_location)
@@ -41,11 +83,252 @@ def call_subprocess(call_args, stdout_fp=None):
     else:
         stdout_f = subprocess.PIPE
 
-    process = subprocess.Popen(str_call_args, shell=False, stdout=stdout_f, stderr=subprocess.PIPE)
-    output, err = process.communicate()
+    log_f = None if log_fp is None else open(log_fp, 'w')
+    tail_lines = collections.deque(maxlen=num_summary_lines)
+    log_lock = threading.Lock()
+    try:
+        process = subprocess.Popen(str_call_args, shell=False, stdout=stdout_f, stderr=subprocess.PIPE)
+        # one thread per pipe, so a command filling one pipe can't block while we wait on the other
+        streams = [process.stderr] if stdout_fp is not None else [process.stderr, process.stdout]
+        reader_threads = [threading.Thread(target=_forward_stream_lines, args=(x, tail_lines, log_f, log_lock))
+                          for x in streams]
+        for curr_thread in reader_threads:
+            curr_thread.start()
+        for curr_thread in reader_threads:
+            curr_thread.join()
+        return_code = process.wait()
+    finally:
+        if stdout_fp is not None:
+            stdout_f.close()
+        if log_f is not None:
+            log_f.close()
+
+    logging.info("{0} exited with code {1}".format(str_call_args[0], return_code))
+    if return_code != 0:
+        summarize_subprocess("\n".join(tail_lines), "", curr_key="Last output of {0}".format(str_call_args[0]))
+    else:
+        logging.info("----------------")
+    return return_code
+
+
+def _forward_stream_lines(stream, tail_lines, log_f, log_lock):
+    with stream:
+        for curr_line in iter(stream.readline, b""):
+            curr_line = curr_line.decode("utf-8", errors="replace").rstrip()
+            if curr_line == "":
+                continue
+            logging.info(curr_line)
+            tail_lines.append(curr_line)
+            if log_f is not None:
+                with log_lock:
+                    log_f.write(curr_line + "\n")
+                    log_f.flush()
+
+
+def call_subprocess_cached(call_args, cache_dir, input_fps, output_fps, stdout_fp=None, tool_version=None,
+                           hash_name=None, **call_subprocess_kwargs):
+    """Run call_subprocess, unless the same command already produced the declared outputs from the same inputs.
+
+    The cache key covers the command line, the stdout filepath, the fingerprints of the inputs, and the tool
+    version.  After a successful run, a manifest of the outputs' fingerprints is saved under that key in
+    cache_dir.  A later call with the same key is skipped if every output still matches the manifest.  The
+    cache only knows about the inputs and outputs declared here.
+
+    Args:
+        call_args (list): The command and its arguments, as for call_subprocess.
+        cache_dir (str): Directory holding the manifests; created if necessary.
+        input_fps (list(str)): Files or directories the command reads.  Directories are fingerprinted by the
+            files under them.
+        output_fps (list(str)): Files or directories the command writes, other than stdout_fp.
+        stdout_fp (Optional[str]): As for call_subprocess; counted as both part of the key and an output.
+        tool_version (Optional[str]): The tool's version.  Default is None, which uses the fingerprint of the
+            executable found on the path, so reinstalling the tool invalidates the cache.
+        hash_name (Optional[str]): Hash algorithm (e.g. "md5") used to fingerprint inputs and outputs in
+            addition to their size and modification time; see files_and_paths.get_file_fingerprint.
+        **call_subprocess_kwargs: Passed on to call_subprocess.
+
+    Returns:
+        int: The command's exit code, or 0 if it was skipped.
+    """
+    cache_key = get_subprocess_cache_key(call_args, input_fps, stdout_fp, tool_version, hash_name)
+    manifest_fp = os.path.join(cache_dir, cache_key + ".json")
+    all_output_fps = list(output_fps) + ([] if stdout_fp is None else [stdout_fp])
+
+    if _outputs_match_manifest(manifest_fp, all_output_fps, hash_name):
+        logging.info("Skipping {0}: outputs match cache entry {1}".format(
+            " ".join([str(x) for x in call_args]), manifest_fp))
+        return 0
+
+    return_code = call_subprocess(call_args, stdout_fp=stdout_fp, **call_subprocess_kwargs)
+    missing_fps = [x for x in all_output_fps if not os.path.exists(x)]
+    if return_code == 0 and len(missing_fps) == 0:
+        manifest = {"call_args": [str(x) for x in call_args],
+                    "outputs": {x: _get_path_fingerprint(x, hash_name) for x in all_output_fps}}
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_manifest_fp = manifest_fp + ".tmp"
+        with open(temp_manifest_fp, 'w') as manifest_f:
+            json.dump(manifest, manifest_f)
+        os.replace(temp_manifest_fp, manifest_fp)
+    elif return_code == 0:
+        logging.info("Not caching {0}: declared outputs {1} were not created".format(call_args[0], missing_fps))
+    return return_code
+
+
+def get_subprocess_cache_key(call_args, input_fps, stdout_fp=None, tool_version=None, hash_name=None):
+    """Return the hex digest call_subprocess_cached uses to identify a command run; see that function."""
+    if tool_version is None:
+        executable_fp = shutil.which(str(call_args[0]))
+        tool_version = None if executable_fp is None else get_file_fingerprint(executable_fp)
+
+    key_pieces = [[str(x) for x in call_args], stdout_fp, tool_version,
+                  [[x, _get_path_fingerprint(x, hash_name)] for x in input_fps]]
+    return hashlib.sha256(json.dumps(key_pieces).encode("utf-8")).hexdigest()
+
+
+def _get_path_fingerprint(path, hash_name):
+    if not os.path.isdir(path):
+        return list(get_file_fingerprint(path, hash_name))
+
+    result = []
+    for curr_dir, curr_subdirs, curr_filenames in os.walk(path):
+        curr_subdirs.sort()
+        for curr_filename in sorted(curr_filenames):
+            curr_fp = os.path.join(curr_dir, curr_filename)
+            result.append([os.path.relpath(curr_fp, path)] + list(get_file_fingerprint(curr_fp, hash_name)))
+    return result
+
+
+def _outputs_match_manifest(manifest_fp, output_fps, hash_name):
+    try:
+        with open(manifest_fp, 'r') as manifest_f:
+            fingerprints_by_fp = json.load(manifest_f)["outputs"]
+    except (OSError, ValueError, KeyError):
+        return False
+
+    if sorted(fingerprints_by_fp.keys()) != sorted(output_fps):
+        return False
+    for curr_fp in output_fps:
+        if not os.path.exists(curr_fp) or _get_path_fingerprint(curr_fp, hash_name) != fingerprints_by_fp[curr_fp]:
+            return False
+    return True
+
+
+def run_subprocesses_concurrently(call_args_list, max_concurrent=None, stdout_fps=None, check=True):
+    """Run external commands concurrently; see run_subprocesses_async, which this runs in a new event loop.
+
+    Raises:
+        RuntimeError: If called from a running event loop (e.g. in a Jupyter notebook cell); there, use
+            `await run_subprocesses_async(...)` instead.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass  # no running loop, as required
+    else:
+        raise RuntimeError("run_subprocesses_concurrently can't start a new event loop inside a running one "
+                           "(e.g. in Jupyter); use 'await run_subprocesses_async(...)' instead.")
+    return asyncio.run(run_subprocesses_async(call_args_list, max_concurrent, stdout_fps, check))
+
+
+async def run_subprocesses_async(call_args_list, max_concurrent=None, stdout_fps=None, check=True):
+    """Run external commands concurrently, at most max_concurrent at a time.
+
+    Each line a command writes to stderr is logged as it arrives, prefixed with the command's index in
+    call_args_list; so is stdout, unless the command has a stdout filepath, in which case stdout goes straight
+    to that file.  All commands are run even if some fail; a command that can't be started at all (e.g. the
+    tool isn't installed) counts as failed with exit code 127, like in a shell.  If this coroutine is cancelled,
+    any running commands are killed.
+
+    Args:
+        call_args_list (list(list)): The commands to run, each a list of arguments as for call_subprocess.
+        max_concurrent (Optional[int]): Maximum number of commands running at once.  Default is os.cpu_count().
+        stdout_fps (Optional[list(str or None)]): For each command, the path of a file to write its stdout to,
+            or None to log it.  Default is None (log all stdout).
+        check (Optional[bool]): True to raise a SubprocessesFailedError if any command exits with a non-zero
+            code.  Default is True.
+
+    Returns:
+        list(int): The exit code of each command, in input order.
+
+    Raises:
+        SubprocessesFailedError: If check is True and any command failed.
+    """
+    max_concurrent = (os.cpu_count() or 1) if max_concurrent is None else max_concurrent
+    stdout_fps = [None] * len(call_args_list) if stdout_fps is None else stdout_fps
+    if len(stdout_fps) != len(call_args_list):
+        raise ValueError("Got {0} stdout filepaths for {1} commands.".format(len(stdout_fps), len(call_args_list)))
+
+    semaphore = asyncio.Semaphore(max_concurrent)
+    command_tasks = [asyncio.ensure_future(_run_subprocess_async(x, y, z, semaphore)) for x, (y, z) in
+                     enumerate(zip(call_args_list, stdout_fps))]
+    try:
+        # wait, unlike gather, doesn't itself cancel the commands, so each is cancelled just once below and can
+        # finish killing and reaping its process
+        if len(command_tasks) > 0:
+            await asyncio.wait(command_tasks)
+    except BaseException:
+        for curr_task in command_tasks:
+            curr_task.cancel()
+        await asyncio.gather(*command_tasks, return_exceptions=True)
+        raise
+    results = [x.result() for x in command_tasks]
+
+    failures = [subprocess.CalledProcessError(x, [str(w) for w in y], stderr="\n".join(z))
+                for (x, z), y in zip(results, call_args_list) if x != 0]
+    if check and len(failures) > 0:
+        raise SubprocessesFailedError(failures)
+    return [x[0] for x in results]
+
+
+async def _run_subprocess_async(command_index, call_args, stdout_fp, semaphore):
+    str_call_args = [str(x) for x in call_args]
+    async with semaphore:
+        str_output_location = "" if stdout_fp is None else " to {0}".format(stdout_fp)
+        logging.info("Running [{0}] {1}{2}".format(command_index, " ".join(str_call_args), str_output_location))
+
+        stdout_f = None
+        process = None
+        try:
+            stdout_f = None if stdout_fp is None else open(stdout_fp, 'wb')
+            process = await asyncio.create_subprocess_exec(
+                *str_call_args, stdout=subprocess.PIPE if stdout_f is None else stdout_f, stderr=subprocess.PIPE,
+                limit=_MAX_LINE_BYTES)
+        except OSError as e:
+            logging.info("[{0}] {1} could not be started: {2}".format(command_index, str_call_args[0], e))
+            return _NOT_STARTED_RETURN_CODE, [str(e)]
+        finally:
+            if process is None and stdout_f is not None:
+                stdout_f.close()
+
+        try:
+            stderr_tail = collections.deque(maxlen=_FAILURE_TAIL_NUM_LINES)
+            stream_readers = [_log_stream_lines(process.stderr, command_index, stderr_tail)]
+            if stdout_f is None:
+                stream_readers.append(_log_stream_lines(process.stdout, command_index))
+            await asyncio.gather(*stream_readers)
+            return_code = await process.wait()
+        except BaseException:
+            # e.g. cancelled: don't leave the command running, or unreaped
+            if process.returncode is None:
+                process.kill()
+            # communicate rather than wait, so the pipes are drained and closed too
+            await process.communicate()
+            raise
+        finally:
+            if stdout_f is not None:
+                stdout_f.close()
+
+    logging.info("[{0}] {1} exited with code {2}".format(command_index, str_call_args[0], return_code))
+    return return_code, list(stderr_tail)
 
-    if stdout_fp is not None:
-        stdout_f.close()
-        output = ""
 
-    summarize_subprocess(err, output)
\ No newline at end of file
+async def _log_stream_lines(stream, command_index, tail_lines=None):
+    while True:
+        curr_line = await stream.readline()
+        if curr_line == b"":
+            return
+        curr_line = curr_line.decode("utf-8", errors="replace").rstrip()
+        if curr_line != "":
+            logging.info("[{0}] {1}".format(command_index, curr_line))
+            if tail_lines is not None:
+                tail_lines.append(curr_line)
@@ -59,12 +59,16 @@ setup(
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
         'Programming Language:: Python:: 3:: Only',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
 
+    # asyncio.run and contextlib.nullcontext are new in 3.7
+    python_requires='>=3.7',
+
     # What does your project relate to?
     keywords='development',
 
@@ -74,7 +78,7 @@ setup(
 
     # List run-time dependencies here.  These will be installed by pip when
     # your project is installed.
-    install_requires=['jupyter','matplotlib', 'multiqc', 'natsort', 'nbformat', 'nbparameterise', 'notebook','pandas'],
+    install_requires=['jupyter','matplotlib', 'multiqc', 'natsort', 'nbformat', 'nbparameterise', 'notebook', 'numpy', 'pandas'],
 
     # List additional groups of dependencies here (e.g. development
     # dependencies). You can install these using the following syntax,
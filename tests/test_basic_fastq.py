@@ -0,0 +1,268 @@
+# standard libraries
+import contextlib
+import gzip
+import io
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+# third-party libraries
+import numpy
+
+# library under test
+import ccbb_pyutils.basic_fastq as ns_test
+
+__author__ = "Amanda Birmingham"
+__maintainer__ = "Amanda Birmingham"
+__email__ = "abirmingham@ucsd.edu"
+__status__ = "development"
+
+
+class TestFunctions(unittest.TestCase):
+    fw_fastq = ("@read1/1\nACGTacgt\n+\nIIIIIIII\n"
+                "@read2/1\nTTTTGGGG\n+\nHHHHHHHH\n"
+                "@read3/1\nCCCCAAAA\n+\nGGGGGGGG\n")
+    rv_fastq = ("@read1/2\nGGGGCCCC\n+\nIIIIIIII\n"
+                "@read2/2\nAAAAtttt\n+\nHHHHHHHH\n"
+                "@read3/2\nNNNNACGT\n+\nGGGGGGGG\n")
+
+    # region BasicFastq tests
+    def test_BasicFastq_add_line(self):
+        basic_fastq = ns_test.BasicFastq()
+        self.assertFalse(basic_fastq.add_line("@read1/1\n"))
+        self.assertFalse(basic_fastq.add_line("ACGT\n"))
+        self.assertEqual(("@read1/1\n", "ACGT\n"), basic_fastq.lines)
+        self.assertFalse(basic_fastq.add_line("+\n"))
+        self.assertTrue(basic_fastq.add_line("IIII\n"))
+
+        self.assertEqual("ACGT", basic_fastq.sequence)
+        self.assertEqual("IIII", basic_fastq.quality)
+        self.assertEqual("@read1/1\nACGT\n+\nIIII\n", basic_fastq.to_string())
+
+    def test_BasicFastq_add_line_too_many(self):
+        basic_fastq = ns_test.BasicFastq()
+        basic_fastq.lines = ["@read1/1\n", "ACGT\n", "+\n", "IIII\n"]
+        with self.assertRaises(ValueError):
+            basic_fastq.add_line("@read2/1\n")
+        self.assertEqual("@read1/1\nACGT\n+\nIIII\n", basic_fastq.to_string())
+
+    def test_BasicFastq_lines_not_mutable(self):
+        basic_fastq = ns_test.BasicFastq()
+        basic_fastq.set_lines(("@read1/1\n", "ACGT\n", "+\n", "IIII\n"))
+        with self.assertRaises(TypeError):
+            basic_fastq.lines[1] = "AC\n"
+        with self.assertRaises(AttributeError):
+            basic_fastq.lines.append("@read2/1\n")
+
+        # a whole new set of lines can still be assigned
+        basic_fastq.lines = ["@read2/1\n", "TTTT\n", "+\n", "HHHH\n"]
+        self.assertEqual("TTTT", basic_fastq.sequence)
+
+    def test_BasicFastq_to_string_round_trip(self):
+        record_lines = ("@read1/1 1:N:0:ACGT  extra\t\n", "ACGT\n", "+read1/1 \n", "IIII\n")
+        added_record, set_record = ns_test.BasicFastq(), ns_test.BasicFastq()
+        for curr_line in record_lines:
+            added_record.add_line(curr_line)
+        set_record.set_lines(record_lines)
+
+        self.assertEqual("".join(record_lines), added_record.to_string())
+        self.assertEqual("".join(record_lines), set_record.to_string())
+        self.assertEqual("@read1/1 1:N:0:ACGT  extra\t", set_record.header)
+
+    def test_BasicFastq_setters_and_copy(self):
+        basic_fastq = ns_test.BasicFastq()
+        basic_fastq.set_lines(("@read1/1\n", "ACGT\n", "+\n", "IIII\n"))
+        basic_fastq_copy = basic_fastq.copy()
+        basic_fastq.sequence = "AC"
+        basic_fastq.quality = "II"
+
+        self.assertEqual("@read1/1\nAC\n+\nII\n", basic_fastq.to_string())
+        self.assertEqual("@read1/1\nACGT\n+\nIIII\n", basic_fastq_copy.to_string())
+
+    def test_BasicFastqPool(self):
+        pool = ns_test.BasicFastqPool()
+        first_record = pool.acquire(("@read1/1\n", "ACGT\n", "+\n", "IIII\n"))
+        self.assertEqual("ACGT", first_record.sequence)
+
+        pool.release(first_record)
+        self.assertEqual(1, len(pool))
+        self.assertEqual((), first_record.lines)
+
+        second_record = pool.acquire()
+        self.assertIs(first_record, second_record)
+        self.assertEqual(0, len(pool))
+    # endregion
+
+    # region FastqHandler tests
+    def test_FastqHandler_get_next_record_small_blocks(self):
+        # block smaller than a record forces records to be stitched across block boundaries
+        handler = ns_test.FastqHandler(self.fw_fastq, input_is_fastq_string=True, block_size=5)
+        records = []
+        while True:
+            try:
+                handler.get_next_record()
+            except StopIteration:
+                break
+            records.append(handler.basic_fastq.to_string())
+            handler.clear_record()
+
+        self.assertEqual(self.fw_fastq, "".join(records))
+        self.assertTrue(handler.is_done)
+
+    def test_FastqHandler_get_next_batch(self):
+        handler = ns_test.FastqHandler(self.fw_fastq, input_is_fastq_string=True, block_size=40)
+        batches = []
+        while True:
+            try:
+                batches.append(handler.get_next_batch())
+            except StopIteration:
+                break
+
+        records = [x for curr_batch in batches for x in curr_batch]
+        self.assertEqual(3, len(records))
+        self.assertEqual(("@read2/1\n", "TTTTGGGG\n", "+\n", "HHHHHHHH\n"), records[1])
+
+    def test_FastqHandler_get_next_record_no_final_newline(self):
+        handler = ns_test.FastqHandler(self.fw_fastq.rstrip("\n"), input_is_fastq_string=True)
+        for _ in range(3):
+            handler.get_next_record()
+
+        self.assertEqual("GGGGGGGG", handler.basic_fastq.quality)
+        self.assertEqual("GGGGGGGG\n", handler.basic_fastq.lines[3])
+
+    def test_FastqHandler_get_next_record_unfinished(self):
+        handler = ns_test.FastqHandler(self.fw_fastq + "@read4/1\nACGT\n", input_is_fastq_string=True)
+        for _ in range(3):
+            handler.get_next_record()
+
+        with self.assertRaises(StopIteration):
+            handler.get_next_record()
+        self.assertFalse(handler.is_done)
+
+    def test_FastqHandler_gzip_input(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            gzip_fp = os.path.join(temp_dir, "test_R1_001.fastq.gz")
+            with gzip.open(gzip_fp, 'wt') as gzip_f:
+                gzip_f.write(self.fw_fastq)
+
+            handler = ns_test.FastqHandler(gzip_fp)
+            handler.get_next_record()
+            self.assertEqual("ACGTacgt", handler.basic_fastq.sequence)
+            handler.close()
+    # endregion
+
+    # region paired_fastq_generator tests
+    def test_paired_fastq_generator(self):
+        fw_handler = ns_test.FastqHandler(self.fw_fastq, input_is_fastq_string=True)
+        rv_handler = ns_test.FastqHandler(self.rv_fastq, input_is_fastq_string=True)
+
+        expected_output = [("ACGTACGT", "GGGGCCCC"), ("TTTTGGGG", "AAAATTTT"), ("CCCCAAAA", "NNNNACGT")]
+        real_output = list(ns_test.paired_fastq_generator(fw_handler, rv_handler))
+        self.assertListEqual(expected_output, real_output)
+
+    def test_paired_fastq_generator_out_of_sync(self):
+        fw_handler = ns_test.FastqHandler(self.fw_fastq, input_is_fastq_string=True)
+        rv_handler = ns_test.FastqHandler(self.rv_fastq[:-29], input_is_fastq_string=True)
+
+        printed_output = io.StringIO()
+        with contextlib.redirect_stdout(printed_output):
+            real_output = list(ns_test.paired_fastq_generator(fw_handler, rv_handler))
+
+        self.assertEqual(2, len(real_output))
+        self.assertIn("aren't in sync", printed_output.getvalue())
+    # endregion
+
+    # region paired_fastq_batch_generator tests
+    def test_paired_fastq_batch_generator(self):
+        fw_handler = ns_test.FastqHandler(self.fw_fastq, input_is_fastq_string=True, block_size=30)
+        rv_handler = ns_test.FastqHandler(self.rv_fastq, input_is_fastq_string=True, block_size=30)
+
+        real_output = list(ns_test.paired_fastq_batch_generator(fw_handler, rv_handler, batch_size=2))
+        self.assertEqual(2, len(real_output))
+        self.assertListEqual([b"ACGTACGT", b"TTTTGGGG"], real_output[0].fw_sequences.tolist())
+        self.assertListEqual([b"IIIIIIII", b"HHHHHHHH"], real_output[0].fw_qualities.tolist())
+        self.assertListEqual([b"GGGGCCCC", b"AAAATTTT"], real_output[0].rv_sequences.tolist())
+        self.assertListEqual([b"NNNNACGT"], real_output[1].rv_sequences.tolist())
+
+    def test_paired_fastq_batch_generator_out_of_sync(self):
+        fw_handler = ns_test.FastqHandler(self.fw_fastq, input_is_fastq_string=True)
+        rv_handler = ns_test.FastqHandler(self.rv_fastq[:-29], input_is_fastq_string=True)
+
+        with self.assertRaises(ns_test.FastqRecordsOutOfSyncError) as found_error:
+            list(ns_test.paired_fastq_batch_generator(fw_handler, rv_handler, batch_size=2))
+        self.assertEqual(2, found_error.exception.num_pairs_read)
+
+    def test_paired_fastq_batch_generator_unfinished(self):
+        fw_handler = ns_test.FastqHandler(self.fw_fastq, input_is_fastq_string=True)
+        rv_handler = ns_test.FastqHandler(self.rv_fastq[:-10], input_is_fastq_string=True)
+
+        with self.assertRaises(ns_test.UnfinishedFastqRecordError):
+            list(ns_test.paired_fastq_batch_generator(fw_handler, rv_handler))
+
+    def test_sequences_to_uint8_matrix(self):
+        input_array = numpy.array([b"ACGT", b"AC"], dtype=bytes)
+        expected_output = [[65, 67, 71, 84], [65, 67, 0, 0]]
+        real_output = ns_test.sequences_to_uint8_matrix(input_array)
+        self.assertListEqual(expected_output, real_output.tolist())
+    # endregion
+
+    # region paired_fastq_text_chunk_generator tests
+    def _write_pair(self, temp_dir, fw_text, rv_text, use_gzip=False):
+        open_func = gzip.open if use_gzip else open
+        result = []
+        for curr_name, curr_text in [("test_R1_001.fastq", fw_text), ("test_R2_001.fastq", rv_text)]:
+            curr_fp = os.path.join(temp_dir, curr_name + (".gz" if use_gzip else ""))
+            with open_func(curr_fp, 'wt') as curr_f:
+                curr_f.write(curr_text)
+            result.append(curr_fp)
+        return result
+
+    def test_paired_fastq_text_chunk_generator(self):
+        for use_gzip in [False, True]:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                # the last line's missing newline doesn't make for an unfinished record
+                fw_fp, rv_fp = self._write_pair(temp_dir, self.fw_fastq, self.rv_fastq[:-1], use_gzip)
+                real_output = list(ns_test.paired_fastq_text_chunk_generator(fw_fp, rv_fp, chunk_size=2))
+
+                fw_handler = ns_test.FastqHandler(self.fw_fastq, input_is_fastq_string=True)
+                rv_handler = ns_test.FastqHandler(self.rv_fastq, input_is_fastq_string=True)
+                expected_output = list(ns_test.paired_fastq_chunk_generator(fw_handler, rv_handler, chunk_size=2))
+                self.assertListEqual(expected_output,
+                                     [(ns_test.fastq_text_to_records(x), ns_test.fastq_text_to_records(y))
+                                      for x, y in real_output])
+
+    def test_paired_fastq_text_chunk_generator_small_blocks(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            fw_fp, rv_fp = self._write_pair(temp_dir, self.fw_fastq, self.rv_fastq)
+            original_block_size = ns_test._FastqRecordTextReader.block_size
+            ns_test._FastqRecordTextReader.block_size = 7
+            try:
+                real_output = list(ns_test.paired_fastq_text_chunk_generator(fw_fp, rv_fp, chunk_size=2))
+            finally:
+                ns_test._FastqRecordTextReader.block_size = original_block_size
+            self.assertListEqual([self.fw_fastq[:58].encode(), self.fw_fastq[58:].encode()],
+                                 [x for x, _ in real_output])
+
+    def test_paired_fastq_text_chunk_generator_one_record_chunks(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            fw_fp, rv_fp = self._write_pair(temp_dir, self.fw_fastq * 100, self.rv_fastq * 100)
+            with unittest.mock.patch.object(ns_test.numpy, "flatnonzero", wraps=numpy.flatnonzero) as found_scans:
+                real_output = list(ns_test.paired_fastq_text_chunk_generator(fw_fp, rv_fp, chunk_size=1))
+
+            self.assertEqual(300, len(real_output))
+            self.assertEqual((self.fw_fastq * 100).encode(), b"".join([x for x, _ in real_output]))
+            # each file fits in one block, which is scanned for newlines just once, not once per chunk
+            self.assertEqual(2, found_scans.call_count)
+
+    def test_paired_fastq_text_chunk_generator_errors(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            fw_fp, rv_fp = self._write_pair(temp_dir, self.fw_fastq, self.rv_fastq[:-29])
+            with self.assertRaises(ns_test.FastqRecordsOutOfSyncError) as found_error:
+                list(ns_test.paired_fastq_text_chunk_generator(fw_fp, rv_fp, chunk_size=2))
+            self.assertEqual(2, found_error.exception.num_pairs_read)
+
+            fw_fp, rv_fp = self._write_pair(temp_dir, self.fw_fastq, self.rv_fastq[:-10])
+            with self.assertRaises(ns_test.UnfinishedFastqRecordError):
+                list(ns_test.paired_fastq_text_chunk_generator(fw_fp, rv_fp))
+    # endregion
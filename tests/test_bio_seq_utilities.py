@@ -1,7 +1,17 @@
 # standard libraries
+import gzip
+import hashlib
+import os
+import tempfile
 import unittest
 
-from ccbb_pyutils.bio_seq_utilities import rev_comp_canonical_dna_seq, trim_seq
+# third-party libraries
+import numpy
+
+from ccbb_pyutils.basic_fastq import FastqHandler
+from ccbb_pyutils.bio_seq_utilities import expand_possible_mismatches, merge_files_grouped_by_regex, \
+    merge_paired_lane_files, rev_comp_canonical_dna_seq, rev_comp_dna_seq, rev_comp_dna_seqs_array, \
+    trim_fastq_batches, trim_seq, trim_seqs_array
 
 __author__ = "Amanda Birmingham"
 __maintainer__ = "Amanda Birmingham"
@@ -49,6 +59,48 @@ class TestFunctions(unittest.TestCase):
 
     # endregion
 
+    # region trim_seqs_array tests
+    def test_trim_seqs_array(self):
+        input_seqs = numpy.array([b"ACGTAC", b"AC", b"", b"GGGTTTA", b"TTG"])
+        input_quals = numpy.array([b"ABCDEF", b"AB", b"", b"ABCDEFG", b"ABC"])
+
+        # keep 5p end
+        trimmed_seqs, trimmed_quals, is_too_short = trim_seqs_array(input_seqs, 3, True, input_quals)
+        self.assertListEqual([b"ACG", b"", b"", b"GGG", b"TTG"], trimmed_seqs.tolist())
+        self.assertListEqual([b"ABC", b"", b"", b"ABC", b"ABC"], trimmed_quals.tolist())
+        self.assertListEqual([False, True, True, False, False], is_too_short.tolist())
+
+        # keep 3p end
+        trimmed_seqs, trimmed_quals, is_too_short = trim_seqs_array(input_seqs, 3, False, input_quals)
+        self.assertListEqual([b"TAC", b"", b"", b"TTA", b"TTG"], trimmed_seqs.tolist())
+        self.assertListEqual([b"DEF", b"", b"", b"EFG", b"ABC"], trimmed_quals.tolist())
+        self.assertListEqual([False, True, True, False, False], is_too_short.tolist())
+
+    def test_trim_seqs_array_all_short(self):
+        trimmed_seqs, trimmed_quals, is_too_short = trim_seqs_array(numpy.array([b"ACGT"]), 5, False)
+        self.assertListEqual([b""], trimmed_seqs.tolist())
+        self.assertIsNone(trimmed_quals)
+        self.assertListEqual([True], is_too_short.tolist())
+
+    def test_trim_fastq_batches(self):
+        fastq_str = "@r1\nACGTA\n+\nABCDE\n@r2\nacg\n+\nABC\n@r3\nttttt\n+\nABCDE\n"
+        handler = FastqHandler(fastq_str, input_is_fastq_string=True)
+        real_output = list(trim_fastq_batches(handler, 4, False, batch_size=2))
+
+        self.assertEqual(2, len(real_output))
+        self.assertListEqual([b"CGTA", b""], real_output[0][0].tolist())
+        self.assertListEqual([b"BCDE", b""], real_output[0][1].tolist())
+        self.assertListEqual([False, True], real_output[0][2].tolist())
+        self.assertListEqual([b"TTTT"], real_output[1][0].tolist())
+    # endregion
+
+    # region expand_possible_mismatches tests
+    def test_expand_possible_mismatches(self):
+        expected_output = ["CG", "GG", "AA", "AC"]
+        self.assertListEqual(expected_output, expand_possible_mismatches("AG", "ACG"))
+        self.assertListEqual(["AG"] + expected_output, expand_possible_mismatches("AG", "ACG", include_perfect=True))
+    # endregion
+
     # region rev_comp_canonical_dna_seq tests
     def test_rev_comp_canonical_dna_seq(self):
         input = "ACGccAgtaT"
@@ -56,4 +108,155 @@ class TestFunctions(unittest.TestCase):
 
         real_output = rev_comp_canonical_dna_seq(input)
         self.assertEqual(expected_output, real_output)
+
+    def test_rev_comp_canonical_dna_seq_bytes_and_non_canonical(self):
+        self.assertEqual(b"NtaCGT", rev_comp_canonical_dna_seq(b"ACGtaN"))
+        self.assertEqual("RNCGT", rev_comp_canonical_dna_seq("ACGNR"))
+    # endregion
+
+    # region rev_comp_dna_seq tests
+    def test_rev_comp_dna_seq(self):
+        self.assertEqual("NRYKMBVDHSWacgt", rev_comp_dna_seq("acgtWSDHBVKMRYN"))
+        self.assertEqual(b"NRYacgt", rev_comp_dna_seq(b"acgtRYN"))
+    # endregion
+
+    # region rev_comp_dna_seqs_array tests
+    def test_rev_comp_dna_seqs_array_equal_lengths(self):
+        input_array = numpy.array([b"AACG", b"TTgN"])
+        real_output = rev_comp_dna_seqs_array(input_array)
+        self.assertListEqual([b"CGTT", b"NcAA"], real_output.tolist())
+
+    def test_rev_comp_dna_seqs_array_unequal_lengths(self):
+        input_array = numpy.array([b"ACGTN", b"AC", b"", b"RYacgt"])
+        real_output = rev_comp_dna_seqs_array(input_array)
+        self.assertListEqual([b"NACGT", b"GT", b"", b"acgtRY"], real_output.tolist())
+    # endregion
+
+    # region merge_files_grouped_by_regex tests
+    def test_merge_files_grouped_by_regex(self):
+        with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+            input_fps = []
+            for curr_sample in ["s1", "s2", "s3"]:
+                for curr_lane in ["L001", "L002"]:
+                    curr_fp = os.path.join(input_dir, "{0}_{1}_R1_001.fastq".format(curr_sample, curr_lane))
+                    with open(curr_fp, 'w') as curr_f:
+                        curr_f.write("{0} {1}\n".format(curr_sample, curr_lane))
+                    input_fps.append(curr_fp)
+
+            merge_files_grouped_by_regex(input_fps, r"_L\d\d\d", output_dir, ".fastq", num_threads=2)
+
+            self.assertListEqual(["s1_R1_001.fastq", "s2_R1_001.fastq", "s3_R1_001.fastq"],
+                                 sorted(os.listdir(output_dir)))
+            with open(os.path.join(output_dir, "s2_R1_001.fastq")) as output_f:
+                self.assertEqual("s2 L001\ns2 L002\n", output_f.read())
+
+            # rerunning would overwrite existing outputs
+            with self.assertRaises(ValueError):
+                merge_files_grouped_by_regex(input_fps, r"_L\d\d\d", output_dir, ".fastq")
+    # endregion
+
+    # region merge_paired_lane_files tests
+    def _write_lane_files(self, input_dir, num_records_by_lane_and_read, use_gzip=False):
+        open_func = gzip.open if use_gzip else open
+        file_suffix = ".fastq.gz" if use_gzip else ".fastq"
+        for (curr_lane, curr_read), curr_num_records in num_records_by_lane_and_read.items():
+            curr_fp = os.path.join(input_dir, "s1_{0}_{1}_001{2}".format(curr_lane, curr_read, file_suffix))
+            with open_func(curr_fp, 'wt') as curr_f:
+                for curr_index in range(curr_num_records):
+                    curr_f.write("@{0}_{1}\nACGT\n+\nIIII\n".format(curr_lane, curr_index))
+        return file_suffix
+
+    def test_merge_paired_lane_files(self):
+        num_records = {("L001", "R1"): 2, ("L001", "R2"): 2, ("L002", "R1"): 3, ("L002", "R2"): 3}
+        for use_gzip in [False, True]:
+            with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+                file_suffix = self._write_lane_files(input_dir, num_records, use_gzip)
+                manifest_fp = os.path.join(output_dir, "manifest.txt")
+                real_output = merge_paired_lane_files(input_dir, output_dir, file_suffix, manifest_fp)
+
+                self.assertEqual(2, len(real_output))
+                r2_row = real_output[1]
+                self.assertEqual(("s1", "R2", 2, 5), (r2_row["sample"], r2_row["read"], r2_row["num_lanes"],
+                                                      r2_row["num_records"]))
+                self.assertEqual(os.path.join(output_dir, "s1_R2" + file_suffix), r2_row["filepath"])
+                with open(r2_row["filepath"], 'rb') as r2_f:
+                    r2_contents = r2_f.read()
+                self.assertEqual(len(r2_contents), r2_row["num_bytes"])
+                self.assertEqual(hashlib.md5(r2_contents).hexdigest(), r2_row["md5"])
+
+                with open(manifest_fp) as manifest_f:
+                    manifest_lines = manifest_f.readlines()
+                self.assertEqual(3, len(manifest_lines))
+                self.assertTrue(manifest_lines[0].startswith("sample\tread\tfilepath"))
+
+    def test_merge_paired_lane_files_no_final_newline(self):
+        num_records = {("L001", "R1"): 2, ("L001", "R2"): 2, ("L002", "R1"): 1, ("L002", "R2"): 1}
+        for use_gzip in [False, True]:
+            with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+                file_suffix = self._write_lane_files(input_dir, num_records, use_gzip)
+                open_func = gzip.open if use_gzip else open
+                for curr_read in ["R1", "R2"]:
+                    curr_fp = os.path.join(input_dir, "s1_L001_{0}_001{1}".format(curr_read, file_suffix))
+                    with open_func(curr_fp, 'rt') as curr_f:
+                        curr_text = curr_f.read()
+                    with open_func(curr_fp, 'wt') as curr_f:
+                        curr_f.write(curr_text.rstrip("\n"))
+
+                real_output = merge_paired_lane_files(input_dir, output_dir, file_suffix)
+                self.assertListEqual([3, 3], [x["num_records"] for x in real_output])
+                with open_func(real_output[0]["filepath"], 'rt') as r1_f:
+                    r1_lines = r1_f.read().splitlines()
+                self.assertListEqual(["@L001_0", "@L001_1", "@L002_0"], r1_lines[::4])
+                with open(real_output[0]["filepath"], 'rb') as r1_f:
+                    r1_contents = r1_f.read()
+                self.assertEqual(len(r1_contents), real_output[0]["num_bytes"])
+                self.assertEqual(hashlib.md5(r1_contents).hexdigest(), real_output[0]["md5"])
+
+    def test_merge_paired_lane_files_gzip_endings(self):
+        num_records = {("L001", "R1"): 2, ("L001", "R2"): 2}
+        for ending_name, expected_error in [("padding", None), ("truncated", "truncated"), ("garbage", "not a valid")]:
+            with self.subTest(ending=ending_name):
+                with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+                    file_suffix = self._write_lane_files(input_dir, num_records, use_gzip=True)
+                    r1_fp = os.path.join(input_dir, "s1_L001_R1_001" + file_suffix)
+                    with open(r1_fp, 'rb') as r1_f:
+                        r1_contents = r1_f.read()
+                    r1_contents = {"padding": r1_contents + b"\x00" * 512, "truncated": r1_contents[:-4],
+                                   "garbage": r1_contents + b"not gzip"}[ending_name]
+                    with open(r1_fp, 'wb') as r1_f:
+                        r1_f.write(r1_contents)
+
+                    if expected_error is None:
+                        real_output = merge_paired_lane_files(input_dir, output_dir, file_suffix)
+                        self.assertListEqual([2, 2], [x["num_records"] for x in real_output])
+                    else:
+                        with self.assertRaises(ValueError) as found_error:
+                            merge_paired_lane_files(input_dir, output_dir, file_suffix)
+                        self.assertIn(expected_error, str(found_error.exception))
+                        self.assertIn(r1_fp, str(found_error.exception))
+
+    def test_merge_paired_lane_files_r1_in_dir_path(self):
+        num_records = {("L001", "R1"): 1, ("L001", "R2"): 1}
+        with tempfile.TemporaryDirectory() as temp_dir, tempfile.TemporaryDirectory() as output_dir:
+            input_dir = os.path.join(temp_dir, "run_R1_files")
+            os.mkdir(input_dir)
+            self._write_lane_files(input_dir, num_records)
+            real_output = merge_paired_lane_files(input_dir, output_dir, ".fastq")
+            self.assertListEqual([1, 1], [x["num_records"] for x in real_output])
+
+    def test_merge_paired_lane_files_mismatched_counts(self):
+        num_records = {("L001", "R1"): 2, ("L001", "R2"): 1}
+        with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+            self._write_lane_files(input_dir, num_records)
+            with self.assertRaises(ValueError) as found_error:
+                merge_paired_lane_files(input_dir, output_dir, ".fastq")
+            self.assertIn("has 2 records but", str(found_error.exception))
+
+    def test_merge_paired_lane_files_unpaired_lane(self):
+        num_records = {("L001", "R1"): 1, ("L001", "R2"): 1, ("L002", "R1"): 1}
+        with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+            self._write_lane_files(input_dir, num_records)
+            with self.assertRaises(ValueError) as found_error:
+                merge_paired_lane_files(input_dir, output_dir, ".fastq")
+            self.assertIn("unpaired lane files", str(found_error.exception))
     # endregion
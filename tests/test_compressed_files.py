@@ -0,0 +1,223 @@
+# standard libraries
+import gzip
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+import zlib
+
+# library under test
+import ccbb_pyutils.compressed_files as ns_test
+
+__author__ = "Amanda Birmingham"
+__maintainer__ = "Amanda Birmingham"
+__email__ = "abirmingham@ucsd.edu"
+__status__ = "development"
+
+
+def write_bgzf(output_fp, data, block_size=1000, add_eof_block=True, other_subfields=b""):
+    # each BGZF block is a gzip member with a "BC" extra subfield holding the block's total size - 1
+    chunks = [data[x:x + block_size] for x in range(0, len(data), block_size)]
+    if add_eof_block:
+        chunks.append(b"")
+    with open(output_fp, 'wb') as output_f:
+        for curr_chunk in chunks:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            cdata = compressor.compress(curr_chunk) + compressor.flush()
+            header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff" + struct.pack("<H", len(other_subfields) + 6) + \
+                other_subfields + b"BC\x02\x00"
+            output_f.write(header + struct.pack("<H", len(header) + 2 + len(cdata) + 8 - 1) + cdata)
+            output_f.write(struct.pack("<II", zlib.crc32(curr_chunk), len(curr_chunk)))
+
+
+class TestFunctions(unittest.TestCase):
+    fastq_text = "@read1\nACGT\n+\nIIII\n@read2\nTTTT\n+\nHHHH\n" * 1000
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.plain_fp = os.path.join(self.temp_dir.name, "test.fastq")
+        with open(self.plain_fp, 'w') as plain_f:
+            plain_f.write(self.fastq_text)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _make_gzip(self):
+        gzip_fp = self.plain_fp + ".gz"
+        with gzip.open(gzip_fp, 'wt') as gzip_f:
+            gzip_f.write(self.fastq_text)
+        return gzip_fp
+
+    # region get_compression_type tests
+    def test_get_compression_type_plain(self):
+        self.assertIsNone(ns_test.get_compression_type(self.plain_fp))
+
+    def test_get_compression_type_gzip(self):
+        self.assertEqual(ns_test.GZIP_COMPRESSION, ns_test.get_compression_type(self._make_gzip()))
+
+    def test_get_compression_type_bgzf(self):
+        # minimal BGZF header: gzip magic, deflate, FEXTRA flag, then a "BC" subfield of length 2
+        bgzf_fp = os.path.join(self.temp_dir.name, "test.fastq.bgz")
+        with open(bgzf_fp, 'wb') as bgzf_f:
+            bgzf_f.write(b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00")
+        self.assertEqual(ns_test.BGZF_COMPRESSION, ns_test.get_compression_type(bgzf_fp))
+    # endregion
+
+    # region open_decompressed_text tests
+    def test_open_decompressed_text_plain(self):
+        with ns_test.open_decompressed_text(self.plain_fp) as test_f:
+            self.assertEqual(self.fastq_text, test_f.read())
+
+    def test_open_decompressed_text_gzip(self):
+        test_f = ns_test.open_decompressed_text(self._make_gzip(), num_threads=2)
+        self.assertEqual(self.fastq_text, test_f.read())
+        test_f.close()
+
+    def test_open_decompressed_text_gzip_stopped_early(self):
+        test_f = ns_test.open_decompressed_text(self._make_gzip())
+        self.assertEqual("@read1\n", test_f.read(7))
+        test_f.close()  # must not raise even though decompressor was cut off
+
+    @unittest.skipIf(shutil.which("zstd") is None, "zstd executable not available")
+    def test_open_decompressed_text_zstd(self):
+        subprocess.check_call(["zstd", "-q", self.plain_fp])
+        zstd_fp = self.plain_fp + ".zst"
+        self.assertEqual(ns_test.ZSTD_COMPRESSION, ns_test.get_compression_type(zstd_fp))
+        with ns_test.open_decompressed_text(zstd_fp) as test_f:
+            self.assertEqual(self.fastq_text, test_f.read())
+
+    def test_decompressor_pipe_reader_noisy_stderr(self):
+        # far more stderr than a pipe buffer holds must not stall reading stdout
+        noisy_script = "import sys; sys.stderr.write('warning\\n' * 100000); sys.stdout.write('@read1\\n')"
+        test_f = ns_test._DecompressorPipeReader([sys.executable, "-c", noisy_script])
+        self.assertEqual("@read1\n", test_f.read())
+        test_f.close()
+
+        failing_script = "import sys; sys.stderr.write('bad input\\n'); sys.exit(1)"
+        test_f = ns_test._DecompressorPipeReader([sys.executable, "-c", failing_script])
+        self.assertEqual("", test_f.read())
+        with self.assertRaises(subprocess.CalledProcessError) as found_error:
+            test_f.close()
+        self.assertEqual(b"bad input\n", found_error.exception.stderr)
+    # endregion
+
+    # region decompress_file tests
+    def test_decompress_file_gzip(self):
+        gzip_fp = self._make_gzip()
+        os.remove(self.plain_fp)
+
+        real_output = ns_test.decompress_file(gzip_fp)
+        self.assertEqual((gzip_fp, self.plain_fp, len(self.fastq_text)),
+                         (real_output.input_fp, real_output.output_fp, real_output.num_output_bytes))
+        self.assertFalse(os.path.exists(gzip_fp))
+        with open(self.plain_fp) as plain_f:
+            self.assertEqual(self.fastq_text, plain_f.read())
+
+    def test_decompress_file_multi_member_gzip(self):
+        gzip_fp = os.path.join(self.temp_dir.name, "multi.txt.gz")
+        with open(gzip_fp, 'wb') as gzip_f:
+            gzip_f.write(gzip.compress(b"first\n") + gzip.compress(b"second\n"))
+
+        ns_test.decompress_file(gzip_fp, keep_input=True)
+        self.assertTrue(os.path.exists(gzip_fp))
+        with open(os.path.join(self.temp_dir.name, "multi.txt"), 'rb') as output_f:
+            self.assertEqual(b"first\nsecond\n", output_f.read())
+
+    def test_decompress_file_bgzf(self):
+        bgzf_fp = os.path.join(self.temp_dir.name, "test.bgzf.fastq.gz")
+        write_bgzf(bgzf_fp, self.fastq_text.encode("ascii"))
+        self.assertEqual(ns_test.BGZF_COMPRESSION, ns_test.get_compression_type(bgzf_fp))
+
+        real_output = ns_test.decompress_file(bgzf_fp, num_threads=3)
+        self.assertEqual(len(self.fastq_text), real_output.num_output_bytes)
+        with open(real_output.output_fp) as output_f:
+            self.assertEqual(self.fastq_text, output_f.read())
+
+    def test_decompress_file_bgzf_other_subfields(self):
+        # BC needn't be the only, or the first, extra subfield
+        bgzf_fp = os.path.join(self.temp_dir.name, "subfields.fastq.gz")
+        write_bgzf(bgzf_fp, self.fastq_text.encode("ascii"), other_subfields=b"XY\x03\x00abc")
+        self.assertEqual(ns_test.BGZF_COMPRESSION, ns_test.get_compression_type(bgzf_fp))
+
+        ns_test.decompress_file(bgzf_fp)
+        with open(os.path.join(self.temp_dir.name, "subfields.fastq")) as output_f:
+            self.assertEqual(self.fastq_text, output_f.read())
+
+    def test_decompress_file_bgzf_then_gzip(self):
+        mixed_fp = os.path.join(self.temp_dir.name, "mixed.fastq.gz")
+        write_bgzf(mixed_fp, self.fastq_text.encode("ascii"), add_eof_block=False)
+        with open(mixed_fp, 'ab') as mixed_f:
+            mixed_f.write(gzip.compress(b"@read3\nGGGG\n+\nIIII\n"))
+
+        ns_test.decompress_file(mixed_fp)
+        with open(os.path.join(self.temp_dir.name, "mixed.fastq")) as output_f:
+            self.assertEqual(self.fastq_text + "@read3\nGGGG\n+\nIIII\n", output_f.read())
+
+    def test_decompress_file_bgzf_no_eof_block(self):
+        bgzf_fp = os.path.join(self.temp_dir.name, "no_eof.fastq.gz")
+        write_bgzf(bgzf_fp, self.fastq_text.encode("ascii"), add_eof_block=False)
+        with self.assertLogs(level="WARNING") as found_logs:
+            ns_test.decompress_file(bgzf_fp)
+        self.assertIn("no BGZF end-of-file block", found_logs.output[0])
+
+    def test_decompress_file_corrupt(self):
+        gzip_fp = self._make_gzip()
+        os.remove(self.plain_fp)
+        with open(gzip_fp, 'rb') as gzip_f:
+            gzip_bytes = gzip_f.read()
+
+        # truncated
+        with open(gzip_fp, 'wb') as gzip_f:
+            gzip_f.write(gzip_bytes[:len(gzip_bytes) // 2])
+        with self.assertRaises(ValueError):
+            ns_test.decompress_file(gzip_fp)
+
+        # bad CRC
+        with open(gzip_fp, 'wb') as gzip_f:
+            gzip_f.write(gzip_bytes[:-8] + b"\x00\x00\x00\x00" + gzip_bytes[-4:])
+        with self.assertRaises(ValueError) as found_error:
+            ns_test.decompress_file(gzip_fp)
+        self.assertIn(gzip_fp, str(found_error.exception))
+
+        # no partial output is left behind, and the input is kept
+        self.assertListEqual(["test.fastq.gz"], os.listdir(self.temp_dir.name))
+
+    def test_decompress_file_corrupt_bgzf(self):
+        bgzf_fp = os.path.join(self.temp_dir.name, "corrupt.fastq.gz")
+        write_bgzf(bgzf_fp, b"ACGT" * 1000)
+        with open(bgzf_fp, 'r+b') as bgzf_f:
+            # overwrite the first block's CRC
+            bgzf_f.seek(struct.unpack("<H", bgzf_f.read(18)[16:18])[0] + 1 - 8)
+            bgzf_f.write(b"\x00\x00\x00\x00")
+        with self.assertRaises(ValueError):
+            ns_test.decompress_file(bgzf_fp)
+
+    def test_decompress_file_existing_output(self):
+        gzip_fp = self._make_gzip()
+        self.assertIsNone(ns_test.decompress_file(gzip_fp))
+        self.assertTrue(os.path.exists(gzip_fp))
+    # endregion
+
+    # region decompress_files tests
+    def test_decompress_files(self):
+        input_fps = []
+        for curr_index in range(5):
+            curr_fp = os.path.join(self.temp_dir.name, "file{0}.txt.gz".format(curr_index))
+            with gzip.open(curr_fp, 'wt') as curr_f:
+                curr_f.write("file {0}\n".format(curr_index))
+            input_fps.append(curr_fp)
+        with open(input_fps[2], 'wb') as curr_f:
+            curr_f.write(b"\x1f\x8b not really gzip")
+
+        with self.assertRaises(ValueError) as found_error:
+            ns_test.decompress_files(input_fps, num_workers=3)
+        self.assertIn("file2.txt.gz", str(found_error.exception))
+
+        # the good files were still decompressed
+        for curr_index in [0, 1, 3, 4]:
+            with open(os.path.join(self.temp_dir.name, "file{0}.txt".format(curr_index))) as curr_f:
+                self.assertEqual("file {0}\n".format(curr_index), curr_f.read())
+    # endregion
@@ -18,6 +18,11 @@ class TestFunctions(unittest.TestCase):
         real_output2 = ns_test.run_multiqc(input_wildpath, os.environ["HOME"], multiqc_fp="echo")
         self.assertEqual(expected_output, real_output2)
 
+    def test__get_fastqc_output_base(self):
+        self.assertEqual("s1_R1_001", ns_test._get_fastqc_output_base("/my/dir/s1_R1_001.fastq.gz"))
+        self.assertEqual("s1.trimmed", ns_test._get_fastqc_output_base("s1.trimmed.fq"))
+        self.assertEqual("reads.bz", ns_test._get_fastqc_output_base("reads.bz"))
+
     def test__generate_multiqc_args(self):
         # with default
         expected_output = ['multiqc', '/my/input_dir', '--outdir=/your/output_dir']
@@ -1,7 +1,9 @@
 # standard libraries
+import gzip
 import os
 import tempfile
 import unittest
+import unittest.mock
 import warnings
 
 # library under test
@@ -84,3 +86,315 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(expected_dir, ns_test.expand_path("myfile.txt"))
 
 
+
+    def test_concatenate_files(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_fps = []
+            for curr_index, curr_contents in enumerate([b"first\n", b"", b"third" * 10000]):
+                curr_fp = os.path.join(temp_dir, "input{0}.txt".format(curr_index))
+                with open(curr_fp, 'wb') as curr_f:
+                    curr_f.write(curr_contents)
+                input_fps.append(curr_fp)
+
+            output_fp = os.path.join(temp_dir, "output.txt")
+            ns_test.concatenate_files(input_fps, output_fp)
+            with open(output_fp, 'rb') as output_f:
+                self.assertEqual(b"first\n" + b"third" * 10000, output_f.read())
+
+    def test_concatenate_files_kernel_copy_stalls(self):
+        def copy_a_little_then_stall(input_fd, output_fd, *args):
+            # copies a few bytes the first time (advancing both file positions, like the kernel), then nothing
+            if copy_calls:
+                return 0
+            copy_calls.append(True)
+            return os.write(output_fd, os.read(input_fd, 7))
+
+        def copy_nothing(*args):
+            return 0
+
+        contents = b"third" * 10000
+        for copy_file_range, sendfile in [(copy_nothing, os.sendfile), (copy_a_little_then_stall, copy_nothing)]:
+            copy_calls = []
+            with self.subTest(copy_file_range=copy_file_range.__name__, sendfile=sendfile.__name__):
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    input_fp = os.path.join(temp_dir, "input.txt")
+                    with open(input_fp, 'wb') as input_f:
+                        input_f.write(contents)
+
+                    output_fp = os.path.join(temp_dir, "output.txt")
+                    with unittest.mock.patch.object(ns_test.os, "copy_file_range", copy_file_range, create=True), \
+                            unittest.mock.patch.object(ns_test.os, "sendfile", sendfile, create=True):
+                        ns_test.concatenate_files([input_fp, input_fp], output_fp)
+                    with open(output_fp, 'rb') as output_f:
+                        self.assertEqual(contents * 2, output_f.read())
+
+    def test_concatenate_files_gzip_members(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_fps = [os.path.join(temp_dir, "L001.fastq.gz"), os.path.join(temp_dir, "L002.fastq.gz")]
+            for curr_fp, curr_contents in zip(input_fps, ["@r1\nACGT\n+\nIIII\n", "@r2\nTTTT\n+\nIIII\n"]):
+                with gzip.open(curr_fp, 'wt') as curr_f:
+                    curr_f.write(curr_contents)
+
+            output_fp = os.path.join(temp_dir, "merged.fastq.gz")
+            ns_test.concatenate_files(input_fps, output_fp)
+            with gzip.open(output_fp, 'rt') as output_f:
+                self.assertEqual("@r1\nACGT\n+\nIIII\n@r2\nTTTT\n+\nIIII\n", output_f.read())
+
+    def test_get_file_fingerprint(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            test_fp = os.path.join(temp_dir, "input.txt")
+            with open(test_fp, 'w') as test_f:
+                test_f.write("abc")
+
+            size, mtime_ns, hex_digest = ns_test.get_file_fingerprint(test_fp)
+            self.assertEqual((3, os.stat(test_fp).st_mtime_ns, None), (size, mtime_ns, hex_digest))
+            self.assertEqual("900150983cd24fb0d6963f7d28e17f72", ns_test.get_file_fingerprint(test_fp, "md5")[2])
+
+    def test_gunzip_wildpath(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sub_dir = os.path.join(temp_dir, "run1")
+            os.mkdir(sub_dir)
+            for curr_dir in [temp_dir, sub_dir]:
+                with gzip.open(os.path.join(curr_dir, "s1.fastq.gz"), 'wt') as curr_f:
+                    curr_f.write("@r1\nACGT\n+\nIIII\n")
+
+            real_output = ns_test.gunzip_wildpath(temp_dir, ".fastq.gz", keep_gzs=True, do_recursive=True)
+            self.assertEqual(2, len(real_output))
+            self.assertListEqual(["run1", "s1.fastq", "s1.fastq.gz"], sorted(os.listdir(temp_dir)))
+            with open(os.path.join(sub_dir, "s1.fastq")) as output_f:
+                self.assertEqual("@r1\nACGT\n+\nIIII\n", output_f.read())
+
+    def _write_index_test_files(self, temp_dir):
+        sub_dir = os.path.join(temp_dir, "run1")
+        os.mkdir(sub_dir)
+        for curr_fp in [os.path.join(temp_dir, "s1.fastq"), os.path.join(temp_dir, ".hidden.fastq"),
+                        os.path.join(temp_dir, "s1.txt"), os.path.join(sub_dir, "s2.fastq")]:
+            with open(curr_fp, 'w') as curr_f:
+                curr_f.write("abc")
+        return sub_dir
+
+    def test_directory_index_matches_module_functions(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self._write_index_test_files(temp_dir)
+            index = ns_test.DirectoryIndex(temp_dir)
+
+            for curr_wildcard in [".fastq", "*", ".hidden*"]:
+                for curr_all_subdirs in [False, True]:
+                    self.assertListEqual(
+                        sorted(ns_test.get_filepaths_from_wildcard(temp_dir, curr_wildcard,
+                                                                   all_subdirs=curr_all_subdirs)),
+                        sorted(index.get_filepaths_from_wildcard(curr_wildcard, all_subdirs=curr_all_subdirs)))
+
+            self.assertEqual("s2.fastq", index.summarize_filenames_for_prefix_and_suffix("s2", ".fastq",
+                                                                                         all_subdirs=True))
+            s1_entry = index.get_entries("s1.txt")[0]
+            self.assertEqual((3, os.stat(s1_entry.path).st_mtime_ns), (s1_entry.size, s1_entry.mtime_ns))
+
+    def test_directory_index_staleness(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sub_dir = self._write_index_test_files(temp_dir)
+            index = ns_test.DirectoryIndex(temp_dir)
+            self.assertFalse(index.is_stale())
+
+            # changes reported by the caller don't make the index stale
+            new_fp = os.path.join(temp_dir, "s2.fastq")
+            os.rename(os.path.join(sub_dir, "s2.fastq"), new_fp)
+            index.record_changes(removed_fps=[os.path.join(sub_dir, "s2.fastq")], added_fps=[new_fp])
+            self.assertFalse(index.is_stale())
+            self.assertEqual("s1.fastq\ns2.fastq", index.summarize_filenames_for_prefix_and_suffix("", ".fastq"))
+
+            # changes made behind its back do
+            open(os.path.join(sub_dir, "s3.fastq"), 'w').close()
+            self.assertTrue(index.refresh_if_stale())
+            self.assertEqual(1, len(index.get_filepaths_from_wildcard("s3.fastq", all_subdirs=True)))
+
+            os.remove(new_fp)
+            index.invalidate()
+            self.assertEqual("s1.fastq", index.summarize_filenames_for_prefix_and_suffix("", ".fastq"))
+
+    def test_directory_index_links(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sub_dir = self._write_index_test_files(temp_dir)
+            os.symlink(temp_dir, os.path.join(sub_dir, "loop_to_top"))
+            os.symlink("cycle_b", os.path.join(temp_dir, "cycle_a"))
+            os.symlink("cycle_a", os.path.join(temp_dir, "cycle_b"))
+            os.symlink("missing.fastq", os.path.join(temp_dir, "dangling.fastq"))
+
+            index = ns_test.DirectoryIndex(temp_dir)
+            for curr_wildcard in [".fastq", "*", "loop*"]:
+                for curr_all_subdirs in [False, True]:
+                    self.assertListEqual(
+                        sorted(ns_test.get_filepaths_from_wildcard(temp_dir, curr_wildcard,
+                                                                   all_subdirs=curr_all_subdirs)),
+                        sorted(index.get_filepaths_from_wildcard(curr_wildcard, all_subdirs=curr_all_subdirs)))
+            loop_entry = index._get_entries_by_path()[os.path.join(sub_dir, "loop_to_top")]
+            self.assertTrue(loop_entry.is_dir)
+            dangling_entry = index.get_entries("dangling.fastq")[0]
+            self.assertEqual((False, len("missing.fastq")), (dangling_entry.is_dir, dangling_entry.size))
+
+    @unittest.skipIf(os.geteuid() == 0, "root can read any directory")
+    def test_directory_index_unreadable_dir(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sub_dir = self._write_index_test_files(temp_dir)
+            os.chmod(sub_dir, 0)
+            try:
+                index = ns_test.DirectoryIndex(temp_dir)
+                self.assertListEqual(sorted(ns_test.get_filepaths_from_wildcard(temp_dir, ".fastq", all_subdirs=True)),
+                                     sorted(index.get_filepaths_from_wildcard(".fastq", all_subdirs=True)))
+            finally:
+                os.chmod(sub_dir, 0o700)
+
+    def test_list_and_unzip_files(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sub_dir = os.path.join(temp_dir, "run1")
+            os.mkdir(sub_dir)
+            with gzip.open(os.path.join(sub_dir, "s1.fastq.gz"), 'wt') as curr_f:
+                curr_f.write("@r1\nACGT\n+\nIIII\n")
+            open(os.path.join(temp_dir, "s2.fastq"), 'w').close()
+
+            # a trailing separator on the top directory is fine
+            with self.assertLogs(level="INFO") as found_logs:
+                ns_test.list_and_unzip_files(temp_dir + os.sep, ".fastq", keep_gzs=False)
+            self.assertListEqual(["run1", "s1.fastq", "s2.fastq"], sorted(os.listdir(temp_dir)))
+            self.assertListEqual([], os.listdir(sub_dir))
+            self.assertEqual("INFO:root:s1.fastq\ns2.fastq", found_logs.output[-1])
+
+    def test_directory_index_trailing_separator(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sub_dir = self._write_index_test_files(temp_dir)
+            index = ns_test.DirectoryIndex(temp_dir + os.sep)
+            self.assertTrue(index.includes_dir(temp_dir))
+            self.assertTrue(index.includes_dir(sub_dir + os.sep))
+
+            new_fp = os.path.join(temp_dir, "s2.fastq")
+            os.rename(os.path.join(sub_dir, "s2.fastq"), new_fp)
+            index.record_changes(removed_fps=[os.path.join(sub_dir + os.sep, "s2.fastq")], added_fps=[new_fp])
+            self.assertFalse(index.is_stale())
+            self.assertListEqual([os.path.join(temp_dir + os.sep, "s1.fastq"),
+                                  os.path.join(temp_dir + os.sep, "s2.fastq")],
+                                 sorted(index.get_filepaths_from_wildcard("s*.fastq", prefix_asterisk=False,
+                                                                          all_subdirs=True)))
+            self.assertListEqual(sorted(ns_test.get_filepaths_from_wildcard(temp_dir + os.sep, ".fastq")),
+                                 sorted(index.get_filepaths_from_wildcard(".fastq")))
+
+    def test_iter_filepaths_from_wildcard(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            expected_fps = []
+            for curr_sub_path in ["", "a", os.path.join("a", "b"), "c", os.path.join("c", "work")]:
+                curr_dir = os.path.join(temp_dir, curr_sub_path)
+                os.makedirs(curr_dir, exist_ok=True)
+                for curr_name in ["s1.fastq", "s1.txt"]:
+                    curr_fp = os.path.join(curr_dir, curr_name)
+                    open(curr_fp, 'w').close()
+                    if curr_name.endswith(".fastq") and not curr_sub_path.endswith("work"):
+                        expected_fps.append(curr_fp)
+            # links to directories are not followed
+            os.symlink(os.path.join(temp_dir, "a"), os.path.join(temp_dir, "link_to_a"))
+
+            real_output = ns_test.iter_filepaths_from_wildcard(temp_dir, "*.fastq", prune_patterns=["wo*"],
+                                                               num_threads=2)
+            self.assertListEqual(sorted(expected_fps), sorted(real_output))
+
+            # the list version finds the same files as os.walk when nothing is pruned, in a reproducible order
+            list_output = ns_test._recursively_get_filepaths_from_wildcard(temp_dir, "*.fastq")
+            self.assertEqual(5, len(list_output))
+            self.assertListEqual(sorted(list_output), list_output)
+
+            # callers can stop early
+            first_fp = next(ns_test.iter_filepaths_from_wildcard(temp_dir, "*.txt"))
+            self.assertTrue(first_fp.endswith("s1.txt"))
+
+    def _write_flatten_test_files(self, temp_dir, sub_dir_names, fnames):
+        for curr_sub_dir_name in sub_dir_names:
+            curr_dir = os.path.join(temp_dir, curr_sub_dir_name)
+            os.makedirs(curr_dir, exist_ok=True)
+            for curr_fname in fnames:
+                with open(os.path.join(curr_dir, curr_fname), 'w') as curr_f:
+                    curr_f.write(curr_sub_dir_name)
+
+    def test_move_to_dir_and_flatten(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self._write_flatten_test_files(temp_dir, [""], ["s0.fastq"])
+            self._write_flatten_test_files(temp_dir, ["run1"], ["s1.fastq"])
+            self._write_flatten_test_files(temp_dir, [os.path.join("run1", "lane2")], ["s2.fastq", "s2.txt"])
+
+            # files already in the target aren't moved (or mistaken for collisions with themselves)
+            planned_moves = ns_test.move_to_dir_and_flatten(temp_dir + os.sep, temp_dir, ".fastq", dry_run=True)
+            self.assertListEqual(["s1.fastq", "s2.fastq"], sorted([os.path.basename(x.target_fp)
+                                                                   for x in planned_moves]))
+            self.assertListEqual(["run1", "s0.fastq"], sorted(os.listdir(temp_dir)))
+
+            index = ns_test.DirectoryIndex(temp_dir)
+            real_output = ns_test.move_to_dir_and_flatten(temp_dir + os.sep, temp_dir + os.sep, ".fastq",
+                                                          directory_index=index)
+            self.assertEqual(2, len(real_output))
+            self.assertListEqual(["run1", "s0.fastq", "s1.fastq", "s2.fastq"], sorted(os.listdir(temp_dir)))
+            self.assertEqual("s0.fastq\ns1.fastq\ns2.fastq",
+                             index.summarize_filenames_for_prefix_and_suffix("", ".fastq"))
+            self.assertFalse(index.is_stale())
+
+            # a file that would overwrite one already in the target stops the whole flattening
+            self._write_flatten_test_files(temp_dir, ["run2"], ["s1.fastq", "s3.fastq"])
+            with self.assertRaises(ValueError) as found_error:
+                ns_test.move_to_dir_and_flatten(temp_dir, temp_dir, ".fastq")
+            self.assertIn("'s1.fastq' (already in target)", str(found_error.exception))
+            self.assertEqual(2, len(os.listdir(os.path.join(temp_dir, "run2"))))
+
+    def test__record_index_changes_invalidates_instead_of_raising(self):
+        with tempfile.TemporaryDirectory() as temp_dir, tempfile.TemporaryDirectory() as other_dir:
+            index = ns_test.DirectoryIndex(temp_dir)
+            other_fp = os.path.join(other_dir, "s1.fastq")
+            open(other_fp, 'w').close()
+            ns_test._record_index_changes(index, removed_fps=[], added_fps=[other_fp])
+            self.assertTrue(index.is_stale())
+
+    def test_plan_flatten_moves_collision(self):
+        with tempfile.TemporaryDirectory() as temp_dir, tempfile.TemporaryDirectory() as target_dir:
+            self._write_flatten_test_files(temp_dir, ["run1", "run2"], ["s1.fastq"])
+            with self.assertRaises(ValueError) as found_error:
+                ns_test.plan_flatten_moves(temp_dir, target_dir, ".fastq")
+            self.assertIn("'s1.fastq' from", str(found_error.exception))
+            self.assertEqual(1, len(os.listdir(os.path.join(temp_dir, "run2"))))
+
+    def test_copy_and_unlink(self):
+        with tempfile.TemporaryDirectory() as temp_dir, tempfile.TemporaryDirectory() as target_dir:
+            source_fp = os.path.join(temp_dir, "s1.fastq")
+            with open(source_fp, 'w') as source_f:
+                source_f.write("@r1\nACGT\n+\nIIII\n")
+            source_mtime_ns = os.stat(source_fp).st_mtime_ns
+            target_fp = os.path.join(target_dir, "s1.fastq")
+
+            ns_test._copy_and_unlink(source_fp, target_fp)
+            self.assertFalse(os.path.exists(source_fp))
+            self.assertListEqual(["s1.fastq"], os.listdir(target_dir))
+            self.assertEqual(source_mtime_ns, os.stat(target_fp).st_mtime_ns)
+            with open(target_fp) as target_f:
+                self.assertEqual("@r1\nACGT\n+\nIIII\n", target_f.read())
+
+    def test_group_files(self):
+        input_fps = ["/a/s2_R2_001.fastq", "/a/s1_R2_001.fastq", "/b/s1_R1_001.fastq", "/a/s2_R1_001.fastq"]
+        original_fps = list(input_fps)
+
+        real_output = ns_test.group_files(input_fps, r"_R\d_", "_")
+        self.assertDictEqual({"s1_001": ["/a/s1_R2_001.fastq", "/b/s1_R1_001.fastq"],
+                              "s2_001": ["/a/s2_R1_001.fastq", "/a/s2_R2_001.fastq"]}, real_output)
+        self.assertListEqual(original_fps, input_fps)
+
+    def test_group_files_by_keys(self):
+        input_fps = ["s1_L002_R1_001.fastq", "s1_L001_R2_001.fastq", "s1_L001_R1_001.fastq", "s2_L001_R1_001.fastq"]
+        regex = r"^(?P<sample>[^_]+)_(?P<lane>L\d+)_(?P<read>R\d)_"
+
+        real_output = ns_test.group_files_by_keys(input_fps, regex, ["sample", "read"])
+        self.assertDictEqual({("s1", "R1"): ("s1_L001_R1_001.fastq", "s1_L002_R1_001.fastq"),
+                              ("s1", "R2"): ("s1_L001_R2_001.fastq",),
+                              ("s2", "R1"): ("s2_L001_R1_001.fastq",)}, dict(real_output))
+        with self.assertRaises(TypeError):
+            real_output[("s3", "R1")] = ()
+
+        # all named groups, in pattern order, by default
+        self.assertEqual(4, len(ns_test.group_files_by_keys(input_fps, regex)))
+        self.assertIn(("s1", "L002", "R1"), ns_test.group_files_by_keys(input_fps, regex))
+
+        with self.assertRaises(ValueError) as found_error:
+            ns_test.group_files_by_keys(input_fps + ["undetermined.fastq"], regex)
+        self.assertIn("undetermined.fastq", str(found_error.exception))
@@ -0,0 +1,55 @@
+# standard libraries
+import collections
+import unittest
+
+# library under test
+import ccbb_pyutils.mismatch_index as ns_test
+
+__author__ = "Amanda Birmingham"
+__maintainer__ = "Amanda Birmingham"
+__email__ = "abirmingham@ucsd.edu"
+__status__ = "development"
+
+
+class TestMismatchIndex(unittest.TestCase):
+    def test_lookup(self):
+        test_index = ns_test.MismatchIndex({"guide1": "AAAA", "guide2": "CCCC"}, max_mismatches=1)
+        self.assertEqual(("guide1", 0), test_index.lookup("AAAA"))
+        self.assertEqual(("guide1", 1), test_index.lookup("AANA"))
+        self.assertEqual(("guide2", 1), test_index.lookup("CCCT"))
+        self.assertIsNone(test_index.lookup("AACC"))
+        # 2 references x (1 perfect + 4 positions x 4 alternatives)
+        self.assertEqual(34, len(test_index))
+
+    def test_lookup_ambiguous(self):
+        # AAT is one mismatch from both references, but AAG is an exact match for guide1
+        test_index = ns_test.MismatchIndex({"guide1": "AAG", "guide2": "AAC"}, max_mismatches=1)
+        self.assertIsNone(test_index.lookup("AAT"))
+        self.assertTrue(test_index.is_ambiguous("AAT"))
+        self.assertEqual(("guide1", 0), test_index.lookup("AAG"))
+        self.assertFalse(test_index.is_ambiguous("AAG"))
+
+    def test_closest_reference_wins(self):
+        test_index = ns_test.MismatchIndex(["AAAA", "AATT"], max_mismatches=2)
+        self.assertEqual(("AATT", 1), test_index.lookup("AATC"))
+        self.assertEqual(("AAAA", 1), test_index.lookup("AAAC"))
+
+    def test_duplicate_reference_error(self):
+        with self.assertRaises(ValueError):
+            ns_test.MismatchIndex({"guide1": "ACGT", "guide2": "acgt"})
+
+    def test_count_matches(self):
+        test_index = ns_test.MismatchIndex({"guide1": "AAG", "guide2": "AAC"}, max_mismatches=1)
+        counts, num_ambiguous, num_unmatched = test_index.count_matches(["AAG", b"AAG", "CAC", "AAT", "TTT"])
+        self.assertEqual(collections.Counter({"guide1": 2, "guide2": 1}), counts)
+        self.assertEqual(1, num_ambiguous)
+        self.assertEqual(1, num_unmatched)
+
+
+class TestFunctions(unittest.TestCase):
+    def test_generate_mismatched_seqs(self):
+        real_output = list(ns_test.generate_mismatched_seqs("AC", 1, "ACG"))
+        self.assertListEqual(["CC", "GC", "AA", "AG"], real_output)
+
+        real_output2 = sorted(ns_test.generate_mismatched_seqs("AC", 2, "ACG"))
+        self.assertListEqual(["CA", "CG", "GA", "GG"], real_output2)
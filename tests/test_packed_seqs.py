@@ -0,0 +1,79 @@
+# standard libraries
+import unittest
+
+# third-party libraries
+import numpy
+
+# library under test
+import ccbb_pyutils.packed_seqs as ns_test
+
+__author__ = "Amanda Birmingham"
+__maintainer__ = "Amanda Birmingham"
+__email__ = "abirmingham@ucsd.edu"
+__status__ = "development"
+
+
+class TestFunctions(unittest.TestCase):
+    # 40 bases, so the packed form spans two words
+    long_seq = "ACGTNACGTACGTACGTACGTACGTACGTACGTAAAACCG"
+
+    # region pack_dna_seqs/unpack_dna_seqs tests
+    def test_pack_dna_seqs(self):
+        real_output = ns_test.pack_dna_seqs(["ACGT", "acgN"])
+        self.assertEqual(4, real_output.seq_len)
+        # A=0, C=1, G=2, T=3, first base in the most significant bits
+        self.assertEqual(0b00011011 << 56, int(real_output.words[0, 0]))
+        self.assertEqual(0b00011000 << 56, int(real_output.words[1, 0]))
+        self.assertEqual(0b00000011 << 56, int(real_output.n_mask[1, 0]))
+
+    def test_pack_dna_seqs_round_trip(self):
+        input_seqs = numpy.array([self.long_seq.encode(), self.long_seq[::-1].encode()])
+        packed = ns_test.pack_dna_seqs(input_seqs)
+        self.assertEqual((2, 2), packed.words.shape)
+        self.assertListEqual(input_seqs.tolist(), ns_test.unpack_dna_seqs(packed).tolist())
+
+    def test_pack_dna_seqs_unequal_lengths(self):
+        with self.assertRaises(ValueError):
+            ns_test.pack_dna_seqs(["ACGT", "ACG"])
+    # endregion
+
+    # region rev_comp_packed tests
+    def test_rev_comp_packed(self):
+        packed = ns_test.pack_dna_seqs([self.long_seq, "A" * 40])
+        real_output = ns_test.unpack_dna_seqs(ns_test.rev_comp_packed(packed))
+        self.assertListEqual([b"CGGTTTTACGTACGTACGTACGTACGTACGTACGTNACGT", b"T" * 40], real_output.tolist())
+    # endregion
+
+    # region hamming_distances_packed tests
+    def test_hamming_distances_packed(self):
+        reads = ns_test.pack_dna_seqs([self.long_seq, "T" + self.long_seq[1:-1] + "A", self.long_seq.replace("N", "A")])
+        reference = ns_test.pack_dna_seqs([self.long_seq.replace("N", "A")])
+
+        # the N counts as a mismatch even against itself
+        real_output = ns_test.hamming_distances_packed(reads, reference)
+        self.assertListEqual([1, 3, 0], real_output.tolist())
+
+    def test_hamming_distances_packed_length_mismatch(self):
+        with self.assertRaises(ValueError):
+            ns_test.hamming_distances_packed(ns_test.pack_dna_seqs(["ACGT"]), ns_test.pack_dna_seqs(["ACG"]))
+    # endregion
+
+    # region extract_kmers/hash_kmers tests
+    def test_extract_kmers(self):
+        kmers, is_valid = ns_test.extract_kmers(["ACGTN"], 3)
+        self.assertListEqual([[0b000110, 0b011011, 0b101100]], kmers.tolist())
+        self.assertListEqual([[True, True, False]], is_valid.tolist())
+
+    def test_extract_kmers_bad_k(self):
+        with self.assertRaises(ValueError):
+            ns_test.extract_kmers(["ACGT"], 5)
+        with self.assertRaises(ValueError):
+            ns_test.extract_kmers(["ACGT"], 33)
+
+    def test_hash_kmers(self):
+        kmers, _ = ns_test.extract_kmers(["ACGTACGT"], 4)
+        hashes = ns_test.hash_kmers(kmers)
+        # ACGT occurs twice, so its hash does too; all other k-mers differ
+        self.assertEqual(hashes[0, 0], hashes[0, 4])
+        self.assertEqual(4, len(set(hashes[0].tolist())))
+    # endregion
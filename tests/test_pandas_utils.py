@@ -0,0 +1,25 @@
+# standard libraries
+import unittest
+
+# library under test
+import ccbb_pyutils.pandas_utils as ns_test
+from ccbb_pyutils.files_and_paths import group_files
+
+__author__ = "Amanda Birmingham"
+__maintainer__ = "Amanda Birmingham"
+__email__ = "abirmingham@ucsd.edu"
+__status__ = "development"
+
+
+class TestFunctions(unittest.TestCase):
+    # region group_files_as_series tests
+    def test_group_files_as_series(self):
+        input_fps = ["/a/s2_R2_001.fastq.gz", "/a/s1_R2_001.fastq.gz", "/b/s1_R1_001.fastq.gz",
+                     "/a/s2_R1_001.fastq.gz", "/a/.hidden_R1_001"]
+        original_fps = list(input_fps)
+
+        real_output = ns_test.group_files_as_series(input_fps, r"_R\d_", "_")
+        self.assertDictEqual(group_files(input_fps, r"_R\d_", "_"), real_output.to_dict())
+        self.assertListEqual([".hidden_001", "s1_001.fastq", "s2_001.fastq"], real_output.index.tolist())
+        self.assertListEqual(original_fps, input_fps)
+    # endregion
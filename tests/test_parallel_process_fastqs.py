@@ -0,0 +1,306 @@
+# standard libraries
+import collections
+import concurrent.futures
+import json
+import operator
+import os
+import tempfile
+import time
+import unittest
+
+from ccbb_pyutils.socket_executor import SocketExecutor, start_local_workers
+
+# library under test
+import ccbb_pyutils.parallel_process_fastqs as ns_test
+
+__author__ = "Amanda Birmingham"
+__maintainer__ = "Amanda Birmingham"
+__email__ = "abirmingham@ucsd.edu"
+__status__ = "development"
+
+
+def log_call(call_log_fp, input_fp):
+    with open(call_log_fp, 'a') as call_log_f:
+        call_log_f.write(os.path.basename(input_fp) + "\n")
+    return os.path.getsize(input_fp)
+
+
+def record_run_interval(input_fp, num_threads=None):
+    start_time = time.time()
+    time.sleep(0.2)
+    return num_threads, start_time, time.time()
+
+
+def count_fw_prefixes(prefix_len, read_pairs):
+    return collections.Counter([x[0][:prefix_len] for x in read_pairs])
+
+
+def get_file_size(fixed_input, input_fp):
+    return fixed_input, os.path.getsize(input_fp)
+
+
+def write_and_burn_cpu(output_fp):
+    with open(output_fp, 'w') as output_f:
+        output_f.write("x" * 1000000)
+    end_time = time.time() + 0.3
+    while time.time() < end_time:
+        pass
+
+
+def fail_on_small_file(input_fp):
+    if os.path.getsize(input_fp) < 100:
+        raise ValueError("too small")
+    return os.path.getsize(input_fp)
+
+
+def get_read_names(read_pairs):
+    return [(x[0].header, x[1].header) for x in read_pairs]
+
+
+class TestFunctions(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.fw_fp = os.path.join(self.temp_dir.name, "sample_R1_001.fastq")
+        self.rv_fp = os.path.join(self.temp_dir.name, "sample_R2_001.fastq")
+        fw_seqs = ["acgt", "ACGA", "TTTT", "ACGC", "GGGG"]
+        with open(self.fw_fp, 'w') as fw_f, open(self.rv_fp, 'w') as rv_f:
+            for curr_index, curr_seq in enumerate(fw_seqs):
+                fw_f.write("@read{0}/1\n{1}\n+\nIIII\n".format(curr_index, curr_seq))
+                rv_f.write("@read{0}/2\nNNNN\n+\nIIII\n".format(curr_index))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    # region sharded_process_paired_reads tests
+    def test_sharded_process_paired_reads_merged(self):
+        real_output = ns_test.sharded_process_paired_reads(self.fw_fp, self.rv_fp, 2, count_fw_prefixes, [3],
+                                                           chunk_size=2, merge_func=operator.add)
+        self.assertEqual(collections.Counter({"ACG": 3, "TTT": 1, "GGG": 1}), real_output)
+
+    def test_sharded_process_paired_reads_ordered(self):
+        real_output = ns_test.sharded_process_paired_reads(self.fw_fp, self.rv_fp, 2, get_read_names, [],
+                                                           chunk_size=2, get_full_record=True)
+        expected_output = [[("@read0/1", "@read0/2"), ("@read1/1", "@read1/2")],
+                           [("@read2/1", "@read2/2"), ("@read3/1", "@read3/2")],
+                           [("@read4/1", "@read4/2")]]
+        self.assertListEqual(expected_output, real_output)
+    # endregion
+
+    # region parallel_process_files tests
+    def test_parallel_process_files(self):
+        for curr_index, curr_size in enumerate([10, 1000, 100]):
+            with open(os.path.join(self.temp_dir.name, "file{0}.txt".format(curr_index)), 'w') as curr_f:
+                curr_f.write("x" * curr_size)
+
+        real_output = ns_test.parallel_process_files(self.temp_dir.name, ".txt", 2, get_file_size, ["fixed"])
+
+        # results come back in file-listing order, not in (largest-first) scheduling order
+        sizes_by_name = {"file0": 10, "file1": 1000, "file2": 100}
+        input_fps = ns_test.get_filepaths_from_wildcard(self.temp_dir.name, ".txt")
+        expected_names = [os.path.splitext(os.path.basename(x))[0] for x in input_fps]
+        expected_output = [(x, ("fixed", sizes_by_name[x])) for x in expected_names]
+        self.assertListEqual(expected_output, real_output)
+
+    def test_parallel_process_paired_reads(self):
+        real_output = ns_test.parallel_process_paired_reads(self.temp_dir.name, ".fastq", 2, get_file_size, [])
+        self.assertEqual(1, len(real_output))
+        self.assertEqual("sample_001", real_output[0][0])
+    # endregion
+
+    # region iter_parallel_process_files tests
+    def test_iter_parallel_process_files(self):
+        for curr_index, curr_size in enumerate([10, 1000, 100]):
+            with open(os.path.join(self.temp_dir.name, "file{0}.txt".format(curr_index)), 'w') as curr_f:
+                curr_f.write("x" * curr_size)
+
+        progress_reports = []
+        real_output = dict(ns_test.iter_parallel_process_files(self.temp_dir.name, ".txt", 2, fail_on_small_file, [],
+                                                               progress_callback=progress_reports.append))
+
+        self.assertEqual(1000, real_output["file1"])
+        self.assertEqual(100, real_output["file2"])
+        failure = real_output["file0"]
+        self.assertIsInstance(failure, ns_test.TaskFailure)
+        self.assertIsInstance(failure.exception, ValueError)
+        self.assertIn("too small", failure.traceback)
+
+        self.assertEqual(3, len(progress_reports))
+        self.assertEqual((3, 1, 0, 0, 1110, 1110), (progress_reports[-1].num_done, progress_reports[-1].num_failed,
+                                                    progress_reports[-1].num_running, progress_reports[-1].num_queued,
+                                                    progress_reports[-1].bytes_done,
+                                                    progress_reports[-1].bytes_total))
+        self.assertIn("3/3 done (1 failed)", ns_test.format_progress(progress_reports[-1]))
+    # endregion
+
+    # region ledger tests
+    def test_parallel_process_files_ledger(self):
+        for curr_index, curr_size in enumerate([10, 20]):
+            with open(os.path.join(self.temp_dir.name, "file{0}.txt".format(curr_index)), 'w') as curr_f:
+                curr_f.write("x" * curr_size)
+        call_log_fp = os.path.join(self.temp_dir.name, "calls.log")
+        ledger_fp = os.path.join(self.temp_dir.name, "ledger.jsonl")
+
+        first_output = ns_test.parallel_process_files(self.temp_dir.name, ".txt", 2, log_call, [call_log_fp],
+                                                      ledger_fp=ledger_fp)
+        second_output = ns_test.parallel_process_files(self.temp_dir.name, ".txt", 2, log_call, [call_log_fp],
+                                                       ledger_fp=ledger_fp)
+        self.assertListEqual(first_output, second_output)
+
+        # only a changed input is rerun
+        with open(os.path.join(self.temp_dir.name, "file1.txt"), 'a') as curr_f:
+            curr_f.write("y")
+        third_output = dict(ns_test.parallel_process_files(self.temp_dir.name, ".txt", 2, log_call, [call_log_fp],
+                                                           ledger_fp=ledger_fp))
+        self.assertEqual({"file0": 10, "file1": 21}, third_output)
+
+        with open(call_log_fp) as call_log_f:
+            self.assertListEqual(["file0.txt", "file1.txt", "file1.txt"], sorted(call_log_f.read().split()))
+
+    def test_get_task_key(self):
+        input_fp = os.path.join(self.temp_dir.name, "file0.txt")
+        with open(input_fp, 'w') as input_f:
+            input_f.write("x")
+
+        # dict fixed inputs are keyed on their contents, whatever their order
+        first_key = ns_test.get_task_key(("file0", get_file_size, False, {"a": 1, "b": 2}, input_fp), [input_fp])
+        second_key = ns_test.get_task_key(("file0", get_file_size, False, {"b": 2, "a": 1}, input_fp), [input_fp])
+        self.assertEqual(first_key, second_key)
+
+        # fixed inputs that can't be written as JSON need an explicit key
+        unkeyable_arguments = ("file0", get_file_size, False, object(), input_fp)
+        with self.assertRaises(ValueError):
+            ns_test.get_task_key(unkeyable_arguments, [input_fp])
+        self.assertEqual(ns_test.get_task_key(unkeyable_arguments, [input_fp], fixed_inputs_key="v1"),
+                         ns_test.get_task_key(("file0", get_file_size, False, object(), input_fp), [input_fp],
+                                              fixed_inputs_key="v1"))
+
+    def test_parallel_process_files_ledger_unkeyable_inputs(self):
+        with open(os.path.join(self.temp_dir.name, "file0.txt"), 'w') as curr_f:
+            curr_f.write("x" * 10)
+        ledger_fp = os.path.join(self.temp_dir.name, "ledger.jsonl")
+
+        with self.assertRaises(ValueError):
+            ns_test.parallel_process_files(self.temp_dir.name, ".txt", 1, get_file_size, [{1, 2}],
+                                           ledger_fp=ledger_fp)
+        self.assertFalse(os.path.exists(ledger_fp))
+
+        real_output = ns_test.parallel_process_files(self.temp_dir.name, ".txt", 1, get_file_size, [{1, 2}],
+                                                     ledger_fp=ledger_fp, ledger_fixed_inputs_key="set-1-2")
+        self.assertListEqual([("file0", ({1, 2}, 10))], real_output)
+
+    def test_task_ledger_ignores_truncated_entry(self):
+        ledger_fp = os.path.join(self.temp_dir.name, "ledger.jsonl")
+        ledger = ns_test.TaskLedger(ledger_fp)
+        ledger.record("key1", "sample1", {"count": 3})
+        with open(ledger_fp, 'a') as ledger_f:
+            ledger_f.write('{"key": "key2", "res')
+
+        reloaded_ledger = ns_test.TaskLedger(ledger_fp)
+        self.assertEqual(1, len(reloaded_ledger))
+        self.assertEqual({"count": 3}, reloaded_ledger.get_result("key1"))
+        self.assertNotIn("key2", reloaded_ledger)
+    # endregion
+
+    # region resource admission tests
+    def test_parallel_process_files_resource_budget(self):
+        for curr_index in range(3):
+            with open(os.path.join(self.temp_dir.name, "file{0}.txt".format(curr_index)), 'w') as curr_f:
+                curr_f.write("x" * (curr_index + 1))
+
+        # three workers are available, but the budget only has room for one 2-thread task at a time
+        real_output = ns_test.parallel_process_files(self.temp_dir.name, ".txt", 3, record_run_interval, [],
+                                                     task_resources=ns_test.TaskResources(2, 1),
+                                                     resource_budget=ns_test.TaskResources(3, 16))
+
+        self.assertListEqual([2, 2, 2], [x[1][0] for x in real_output])
+        intervals = sorted([x[1][1:] for x in real_output])
+        for curr_interval, next_interval in zip(intervals, intervals[1:]):
+            self.assertLessEqual(curr_interval[1], next_interval[0])
+
+    def test__pop_admissible_task(self):
+        resources_by_task = [ns_test.TaskResources(8, 1), ns_test.TaskResources(2, 30), ns_test.TaskResources(1, 1)]
+        budget = ns_test.TaskResources(4, 32)
+        pending_indices = collections.deque([0, 1, 2])
+
+        # the biggest task that fits goes first
+        in_use = ns_test.TaskResources(1, 1)
+        self.assertEqual(1, ns_test._pop_admissible_task(pending_indices, resources_by_task, in_use, budget, False))
+        self.assertEqual(2, ns_test._pop_admissible_task(pending_indices, resources_by_task, in_use, budget, False))
+        self.assertIsNone(ns_test._pop_admissible_task(pending_indices, resources_by_task, in_use, budget, False))
+
+        # a task bigger than the whole budget runs once nothing else is running
+        self.assertEqual(0, ns_test._pop_admissible_task(pending_indices, resources_by_task, in_use, budget, True))
+        self.assertEqual(0, len(pending_indices))
+    # endregion
+
+    # region metrics tests
+    def test_parallel_process_files_return_metrics(self):
+        for curr_index, curr_size in enumerate([10, 20]):
+            with open(os.path.join(self.temp_dir.name, "file{0}.txt".format(curr_index)), 'w') as curr_f:
+                curr_f.write("x" * curr_size)
+
+        results, task_metrics = ns_test.parallel_process_files(self.temp_dir.name, ".txt", 2, get_file_size,
+                                                               ["fixed"], return_metrics=True)
+        self.assertListEqual([x[0] for x in results], [x.process_name for x in task_metrics])
+        for curr_metrics in task_metrics:
+            self.assertGreaterEqual(curr_metrics.wall_seconds, 0)
+            self.assertGreaterEqual(curr_metrics.user_seconds, 0)
+            self.assertGreater(curr_metrics.max_rss_kb, 0)
+
+        metrics_df = ns_test.metrics_to_dataframe(task_metrics + [None])
+        self.assertEqual(2, len(metrics_df))
+        self.assertListEqual(list(ns_test.TaskMetrics._fields), list(metrics_df.columns))
+
+        metrics_fp = os.path.join(self.temp_dir.name, "metrics.jsonl")
+        ns_test.write_metrics_jsonl(task_metrics, metrics_fp)
+        with open(metrics_fp) as metrics_f:
+            metrics_dicts = [json.loads(x) for x in metrics_f]
+        self.assertEqual(task_metrics[0].process_name, metrics_dicts[0]["process_name"])
+
+    def test_serial_process_files_return_metrics(self):
+        results, task_metrics = ns_test.serial_process_files(self.temp_dir.name, "_R1_001.fastq", get_file_size,
+                                                             ["fixed"], return_metrics=True)
+        self.assertEqual(1, len(results))
+        self.assertEqual(results[0][0], task_metrics[0].process_name)
+
+    def test_measure_function_in_thread(self):
+        # a sleeping task measured in a thread isn't charged for a busy one running alongside it
+        with concurrent.futures.ThreadPoolExecutor(2) as thread_executor:
+            busy_future = thread_executor.submit(write_and_burn_cpu, os.path.join(self.temp_dir.name, "out.txt"))
+            sleep_future = thread_executor.submit(ns_test.measure_function, "sleeper", time.sleep, False, 0.3)
+            busy_future.result()
+            task_metrics, _ = sleep_future.result()
+
+        self.assertGreaterEqual(task_metrics.wall_seconds, 0.3)
+        self.assertEqual((None, None, None), (task_metrics.child_user_seconds, task_metrics.child_system_seconds,
+                                              task_metrics.child_max_rss_kb))
+        if hasattr(ns_test.resource, "RUSAGE_THREAD"):
+            self.assertLess(task_metrics.user_seconds, 0.1)
+        if os.path.exists("/proc/thread-self/io"):
+            self.assertLess(task_metrics.bytes_written, 1000000)
+
+    def test__get_io_counts_missing_file(self):
+        self.assertIsNone(ns_test._get_io_counts(os.path.join(self.temp_dir.name, "no_such_file")))
+    # endregion
+
+    # region executor tests
+    def test_parallel_process_files_executors(self):
+        for curr_index, curr_size in enumerate([10, 1000, 100]):
+            with open(os.path.join(self.temp_dir.name, "file{0}.txt".format(curr_index)), 'w') as curr_f:
+                curr_f.write("x" * curr_size)
+        expected_output = ns_test.parallel_process_files(self.temp_dir.name, ".txt", 2, get_file_size, ["fixed"])
+
+        with concurrent.futures.ThreadPoolExecutor(2) as thread_executor:
+            thread_output = ns_test.parallel_process_files(self.temp_dir.name, ".txt", 2, get_file_size, ["fixed"],
+                                                           executor=thread_executor)
+        self.assertListEqual(expected_output, thread_output)
+
+        socket_executor = SocketExecutor()
+        try:
+            start_local_workers(socket_executor, 2)
+            socket_output = ns_test.parallel_process_files(self.temp_dir.name, ".txt", 2, get_file_size, ["fixed"],
+                                                           executor=socket_executor)
+        finally:
+            socket_executor.shutdown()
+        self.assertListEqual(expected_output, socket_output)
+    # endregion
@@ -0,0 +1,67 @@
+# standard libraries
+import os
+import unittest
+
+# library under test
+import ccbb_pyutils.socket_executor as ns_test
+
+__author__ = "Amanda Birmingham"
+__maintainer__ = "Amanda Birmingham"
+__email__ = "abirmingham@ucsd.edu"
+__status__ = "development"
+
+
+def get_worker_pid(an_input, offset=0):
+    return an_input + offset, os.getpid()
+
+
+def raise_value_error(message):
+    raise ValueError(message)
+
+
+class TestSocketExecutor(unittest.TestCase):
+    def setUp(self):
+        self.executor = ns_test.SocketExecutor()
+        self.worker_processes = ns_test.start_local_workers(self.executor, 2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        for curr_process in self.worker_processes:
+            curr_process.join(timeout=5)
+
+    def test_submit(self):
+        futures = [self.executor.submit(get_worker_pid, x, offset=10) for x in range(6)]
+        results = [x.result(timeout=10) for x in futures]
+
+        self.assertListEqual(list(range(10, 16)), [x[0] for x in results])
+        self.assertNotIn(os.getpid(), [x[1] for x in results])
+
+    def test_map(self):
+        real_output = list(self.executor.map(get_worker_pid, [1, 2, 3], timeout=10))
+        self.assertListEqual([1, 2, 3], [x[0] for x in real_output])
+
+    def test_submit_error(self):
+        future = self.executor.submit(raise_value_error, "bad input")
+        with self.assertRaises(ValueError) as found_error:
+            future.result(timeout=10)
+        self.assertIn("bad input", found_error.exception.remote_traceback)
+
+        # the worker survives a failing task
+        self.assertEqual(5, self.executor.submit(get_worker_pid, 5).result(timeout=10)[0])
+
+    def test_shutdown_workers_exit(self):
+        self.executor.shutdown()
+        for curr_process in self.worker_processes:
+            curr_process.join(timeout=5)
+            self.assertFalse(curr_process.is_alive())
+
+        with self.assertRaises(RuntimeError):
+            self.executor.submit(get_worker_pid, 1)
+
+    def test_wrong_authkey_rejected(self):
+        other_executor = ns_test.SocketExecutor(authkey=b"right key")
+        try:
+            with self.assertRaises(Exception):
+                ns_test.run_socket_worker(other_executor.address, b"wrong key")
+        finally:
+            other_executor.shutdown()
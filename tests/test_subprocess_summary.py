@@ -0,0 +1,158 @@
+# standard libraries
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+# library under test
+import ccbb_pyutils.subprocess_summary as ns_test
+
+__author__ = "Amanda Birmingham"
+__maintainer__ = "Amanda Birmingham"
+__email__ = "abirmingham@ucsd.edu"
+__status__ = "development"
+
+
+class TestFunctions(unittest.TestCase):
+    # region call_subprocess tests
+    def test_call_subprocess(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            log_fp = os.path.join(temp_dir, "command.log")
+            command = "for i in 1 2 3 4 5; do echo out$i; echo err$i >&2; done; exit 2"
+
+            with self.assertLogs(level="INFO") as found_logs:
+                real_output = ns_test.call_subprocess(["sh", "-c", command], log_fp=log_fp, num_summary_lines=2)
+
+            self.assertEqual(2, real_output)
+            self.assertIn("INFO:root:out1", found_logs.output)
+            self.assertIn("INFO:root:err1", found_logs.output)
+            # only the tail is summarized
+            summary_index = found_logs.output.index("INFO:root:Last output of sh:") + 1
+            self.assertEqual(2, len(found_logs.output[summary_index].split("\n")))
+            with open(log_fp) as log_f:
+                self.assertListEqual(["err{0}".format(x) for x in range(1, 6)] +
+                                     ["out{0}".format(x) for x in range(1, 6)], sorted(log_f.read().split()))
+
+    def test_call_subprocess_stdout_fp(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            stdout_fp = os.path.join(temp_dir, "out.txt")
+            with self.assertLogs(level="INFO") as found_logs:
+                self.assertEqual(0, ns_test.call_subprocess(["echo", "hello"], stdout_fp=stdout_fp))
+            with open(stdout_fp) as stdout_f:
+                self.assertEqual("hello\n", stdout_f.read())
+            self.assertNotIn("INFO:root:hello", found_logs.output)
+    # endregion
+
+    # region call_subprocess_cached tests
+    def _call_cat_cached(self, input_fp, output_fp, cache_dir):
+        with self.assertLogs(level="INFO") as found_logs:
+            return_code = ns_test.call_subprocess_cached(["cat", input_fp], cache_dir, [input_fp], [],
+                                                         stdout_fp=output_fp)
+        self.assertEqual(0, return_code)
+        return any(["Skipping" in x for x in found_logs.output])
+
+    def test_call_subprocess_cached(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_dir = os.path.join(temp_dir, "cache")
+            input_fp = os.path.join(temp_dir, "in.txt")
+            output_fp = os.path.join(temp_dir, "out.txt")
+            with open(input_fp, 'w') as input_f:
+                input_f.write("abc\n")
+
+            self.assertFalse(self._call_cat_cached(input_fp, output_fp, cache_dir))
+            self.assertTrue(self._call_cat_cached(input_fp, output_fp, cache_dir))
+
+            # a changed input or a missing output means a rerun
+            with open(input_fp, 'a') as input_f:
+                input_f.write("def\n")
+            self.assertFalse(self._call_cat_cached(input_fp, output_fp, cache_dir))
+            with open(output_fp) as output_f:
+                self.assertEqual("abc\ndef\n", output_f.read())
+            os.remove(output_fp)
+            self.assertFalse(self._call_cat_cached(input_fp, output_fp, cache_dir))
+            self.assertTrue(self._call_cat_cached(input_fp, output_fp, cache_dir))
+
+    def test_call_subprocess_cached_failure_not_cached(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_dir = os.path.join(temp_dir, "cache")
+            with self.assertLogs(level="INFO"):
+                self.assertEqual(1, ns_test.call_subprocess_cached(["false"], cache_dir, [], []))
+            self.assertFalse(os.path.exists(cache_dir))
+
+    def test_get_subprocess_cache_key(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with open(os.path.join(temp_dir, "a.txt"), 'w') as a_f:
+                a_f.write("a")
+            key = ns_test.get_subprocess_cache_key(["cat", temp_dir], [temp_dir], tool_version="1.0")
+            self.assertEqual(key, ns_test.get_subprocess_cache_key(["cat", temp_dir], [temp_dir],
+                                                                   tool_version="1.0"))
+            self.assertNotEqual(key, ns_test.get_subprocess_cache_key(["cat", temp_dir], [temp_dir],
+                                                                      tool_version="2.0"))
+
+            # a directory input changes when a file under it does
+            with open(os.path.join(temp_dir, "a.txt"), 'a') as a_f:
+                a_f.write("b")
+            self.assertNotEqual(key, ns_test.get_subprocess_cache_key(["cat", temp_dir], [temp_dir],
+                                                                      tool_version="1.0"))
+    # endregion
+
+    # region run_subprocesses_concurrently tests
+    def test_run_subprocesses_concurrently(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            stdout_fp = os.path.join(temp_dir, "out.txt")
+            call_args_list = [["sh", "-c", "echo to_file; echo progress >&2"], ["echo", "to_log", 2]]
+
+            with self.assertLogs(level="INFO") as found_logs:
+                real_output = ns_test.run_subprocesses_concurrently(call_args_list, max_concurrent=1,
+                                                                    stdout_fps=[stdout_fp, None])
+
+            self.assertListEqual([0, 0], real_output)
+            with open(stdout_fp) as stdout_f:
+                self.assertEqual("to_file\n", stdout_f.read())
+            self.assertIn("INFO:root:[0] progress", found_logs.output)
+            self.assertIn("INFO:root:[1] to_log 2", found_logs.output)
+
+    def test_run_subprocesses_concurrently_failure(self):
+        call_args_list = [["sh", "-c", "echo first >&2; echo last >&2; exit 3"], ["true"], ["false"]]
+
+        with self.assertLogs(level="INFO"):
+            with self.assertRaises(ns_test.SubprocessesFailedError) as found_error:
+                ns_test.run_subprocesses_concurrently(call_args_list, max_concurrent=2)
+            failures = found_error.exception.failures
+            self.assertListEqual([3, 1], [x.returncode for x in failures])
+            self.assertEqual("first\nlast", failures[0].stderr)
+            self.assertListEqual(["false"], failures[1].cmd)
+
+            # without checking, exit codes are just returned
+            self.assertListEqual([3, 0, 1], ns_test.run_subprocesses_concurrently(call_args_list, check=False))
+
+    def test_run_subprocesses_concurrently_missing_tool(self):
+        call_args_list = [["sleep", "0.2"], ["no_such_tool_for_ccbb_pyutils_tests"]]
+        with self.assertLogs(level="INFO"):
+            with self.assertRaises(ns_test.SubprocessesFailedError) as found_error:
+                ns_test.run_subprocesses_concurrently(call_args_list)
+        self.assertListEqual([127], [x.returncode for x in found_error.exception.failures])
+        self.assertIn("no_such_tool_for_ccbb_pyutils_tests", found_error.exception.failures[0].stderr)
+
+    def test_run_subprocesses_async_cancelled(self):
+        async def run_and_cancel():
+            command_task = asyncio.ensure_future(ns_test.run_subprocesses_async([["sleep", "30"], ["sleep", "30"]]))
+            await asyncio.sleep(0.5)
+            command_task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await command_task
+
+        start_time = time.time()
+        with self.assertLogs(level="INFO"):
+            asyncio.run(run_and_cancel())
+        self.assertLess(time.time() - start_time, 10)
+
+    def test_run_subprocesses_concurrently_in_running_loop(self):
+        async def run_inside_loop():
+            return ns_test.run_subprocesses_concurrently([["true"]])
+
+        with self.assertRaises(RuntimeError) as found_error:
+            asyncio.run(run_inside_loop())
+        self.assertIn("await run_subprocesses_async", str(found_error.exception))
+    # endregion